@@ -5,6 +5,7 @@
 import logging
 import re
 from base64 import b64encode
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Annotated
 
@@ -52,9 +53,12 @@
 from taramail.db import db_transaction
 from taramail.deps import (
     DbDep,
+    F2BStreamDep,
     MemcachedDep,
     QueueDep,
     StoreDep,
+    get_async_redis_pool,
+    get_redis_pool,
 )
 from taramail.dkim import (
     DKIMAlreadyExistsError,
@@ -135,9 +139,22 @@
 )
 
 logger = logging.getLogger("uvicorn")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the Redis connection pools on startup, closing their connections on shutdown."""
+    redis_pool = get_redis_pool()
+    async_redis_pool = get_async_redis_pool()
+    yield
+    redis_pool.disconnect()
+    await async_redis_pool.disconnect()
+
+
 app = FastAPI(
     docs_url="/api/swagger",
     openapi_url="/api/openapi.json",
+    lifespan=lifespan,
 )
 
 env = Environment(
@@ -490,8 +507,11 @@ def get_rspamd_bcc(request: Request, bcc: RspamdBccDep) -> Response:
 
 
 @app.get("/rspamd/error", include_in_schema=False)
-async def get_rspamd_error(request: Request, queue: QueueDep) -> None:
-    await queue.publish("F2B_CHANNEL", f"Rspamd UI: Invalid password by {request.client.host}")
+async def get_rspamd_error(request: Request, queue: QueueDep, f2b_stream: F2BStreamDep) -> None:
+    message = f"Rspamd UI: Invalid password by {request.client.host}"
+    await queue.publish("F2B_CHANNEL", message)
+    if f2b_stream is not None:
+        await f2b_stream.publish(message)
     raise HTTPException(401, "Invalid password")
 
 
@@ -1,9 +1,11 @@
 """FastAPI dependencies."""
 
-from functools import partial
+import os
+from functools import cache
 from typing import Annotated
 
 from fastapi import Depends
+from redis.asyncio import StrictRedis
 from taraqueue import Queue
 from taraqueue.redis import RedisQueue
 
@@ -11,10 +13,15 @@
     DBSession,
     get_db_session,
 )
+from taramail.netfilter import F2BStream
 from taramail.store import (
+    AsyncRedisConnectionPool,
+    CachedStore,
     MemcachedStore,
+    RedisConnectionPool,
     RedisStore,
     Store,
+    instrument_store,
 )
 
 
@@ -22,13 +29,58 @@ async def get_db():
     with get_db_session() as db:
         yield db
 
+
 DbDep = Annotated[DBSession, Depends(get_db)]
 
-get_queue = RedisQueue.from_env
+
+@cache
+def get_redis_pool():
+    """Connection pool shared by the stores of every request."""
+    return RedisConnectionPool.from_env("store")
+
+
+@cache
+def get_async_redis_pool():
+    """Connection pool shared by the queues of every request."""
+    return AsyncRedisConnectionPool.from_env("async")
+
+
+def get_queue():
+    client = StrictRedis(connection_pool=get_async_redis_pool())
+    return RedisQueue(client, client.pubsub(ignore_subscribe_messages=True))
+
+
 QueueDep = Annotated[Queue, Depends(get_queue)]
 
-get_store = RedisStore.from_env
+
+@cache
+def get_f2b_stream():
+    """Stream of the fail2ban messages when netfilter reads them from it, None otherwise."""
+    if os.environ.get("NETFILTER_INGEST", "pubsub") != "stream":
+        return None
+
+    return F2BStream.from_env(client=StrictRedis(connection_pool=get_async_redis_pool()))
+
+
+F2BStreamDep = Annotated[F2BStream | None, Depends(get_f2b_stream)]
+
+
+@cache
+def get_store():
+    """Store shared by every request, with a near cache when REDIS_NEAR_CACHE is y."""
+    store = RedisStore.from_pool(get_redis_pool())
+    if os.environ.get("REDIS_NEAR_CACHE", "n") == "y":
+        store = CachedStore(store, ttl=float(os.environ.get("REDIS_NEAR_CACHE_TTL", "5"))).start()
+        return instrument_store(store, "cached+redis")
+
+    return instrument_store(store, "redis")
+
+
 StoreDep = Annotated[Store, Depends(get_store)]
 
-get_memcached = partial(MemcachedStore.from_host, "memcached")
+
+def get_memcached():
+    return instrument_store(MemcachedStore.from_host("memcached"), "memcached")
+
+
 MemcachedDep = Annotated[Store, Depends(get_memcached)]
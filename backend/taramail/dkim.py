@@ -61,12 +61,15 @@ def get_keys(self) -> dict[str, str]:
 
     def get_details(self, domain: DomainStr, privkey=False) -> DKIMDetails:
         """Get DKIM details for a domain."""
-        pubkey = self.store.hget("DKIM_PUB_KEYS", domain)
+        pipe = self.store.batch()
+        pipe.hget("DKIM_PUB_KEYS", domain)
+        pipe.hget("DKIM_SELECTORS", domain)
+        pubkey, dkim_selector = pipe.execute()
         if not pubkey:
             raise DKIMNotFoundError(f"DKIM key not found: {domain}")
 
         length = self._detect_key_length(pubkey)
-        dkim_selector = self.store.hget("DKIM_SELECTORS", domain) or "dkim"
+        dkim_selector = dkim_selector or "dkim"
         dkim_txt = f'v=DKIM1;k=rsa;t=s;s=email;p={pubkey}'
 
         # Include private key if requested
@@ -93,13 +96,14 @@ def create_key(self, dkim_create: DKIMCreate) -> str:
         public_lines = key_pair["public"].splitlines()
         public_key = ''.join(public_lines[1:-1])  # remove header/footer
 
-        self.store.hset("DKIM_PUB_KEYS", dkim_create.domain, public_key)
-        self.store.hset("DKIM_SELECTORS", dkim_create.domain, dkim_create.dkim_selector)
-        self.store.hset(
-            "DKIM_PRIV_KEYS",
-            f"{dkim_create.dkim_selector}.{dkim_create.domain}",
-            key_pair["private"],
-        )
+        with self.store.batch() as pipe:
+            pipe.hset("DKIM_PUB_KEYS", dkim_create.domain, public_key)
+            pipe.hset("DKIM_SELECTORS", dkim_create.domain, dkim_create.dkim_selector)
+            pipe.hset(
+                "DKIM_PRIV_KEYS",
+                f"{dkim_create.dkim_selector}.{dkim_create.domain}",
+                key_pair["private"],
+            )
 
         return public_key
 
@@ -114,13 +118,14 @@ def duplicate_key(self, dkim_duplicate: DKIMDuplicate) -> None:
             raise DKIMError(f"Invalid DKIM private key format: {e}") from e
 
         # Copy DKIM data
-        self.store.hset("DKIM_PUB_KEYS", dkim_duplicate.to_domain, from_domain_dkim.pubkey)
-        self.store.hset("DKIM_SELECTORS", dkim_duplicate.to_domain, from_domain_dkim.dkim_selector)
-        self.store.hset(
-            "DKIM_PRIV_KEYS",
-            f"{from_domain_dkim.dkim_selector}.{dkim_duplicate.to_domain}",
-            privkey_bytes.decode(),
-        )
+        with self.store.batch() as pipe:
+            pipe.hset("DKIM_PUB_KEYS", dkim_duplicate.to_domain, from_domain_dkim.pubkey)
+            pipe.hset("DKIM_SELECTORS", dkim_duplicate.to_domain, from_domain_dkim.dkim_selector)
+            pipe.hset(
+                "DKIM_PRIV_KEYS",
+                f"{from_domain_dkim.dkim_selector}.{dkim_duplicate.to_domain}",
+                privkey_bytes.decode(),
+            )
 
     def delete_key(self, domain: DomainStr) -> None:
         """Delete DKIM keys for a domain."""
@@ -128,10 +133,11 @@ def delete_key(self, domain: DomainStr) -> None:
         selector = self.store.hget("DKIM_SELECTORS", domain)
 
         # Delete all DKIM data for domain
-        self.store.hdel("DKIM_PUB_KEYS", domain)
-        self.store.hdel("DKIM_SELECTORS", domain)
-        if selector:
-            self.store.hdel("DKIM_PRIV_KEYS", f"{selector}.{domain}")
+        with self.store.batch() as pipe:
+            pipe.hdel("DKIM_PUB_KEYS", domain)
+            pipe.hdel("DKIM_SELECTORS", domain)
+            if selector:
+                pipe.hdel("DKIM_PRIV_KEYS", f"{selector}.{domain}")
 
     def _detect_key_length(self, pubkey: str) -> str:
         """Detect key length from base64-encoded public key size."""
@@ -295,8 +295,9 @@ def delete_domain(self, domain: DomainStr) -> None:
         self.db.execute(delete(SpamaliasModel).where(SpamaliasModel.address.like(f"%@{domain}")))
         self.db.execute(delete(BccMapsModel).where(BccMapsModel.local_dest == domain))
 
-        self.store.hdel("DOMAIN_MAP", domain)
-        self.store.hdel("RL_VALUE", domain)
+        with self.store.batch() as pipe:
+            pipe.hdel("DOMAIN_MAP", domain)
+            pipe.hdel("RL_VALUE", domain)
 
         self.dkim_manager.delete_key(domain)
 
@@ -52,27 +52,29 @@ def get_forwarding_hosts(self) -> list[ForwardingHostDetails]:
             return []
 
         result = []
-        for host, source in fwd_hosts.items():
-            keep_spam = "yes" if self.store.hget("KEEP_SPAM", host) else "no"
+        keep_spams = self.store.hmget("KEEP_SPAM", *fwd_hosts)
+        for (host, source), keep_spam in zip(fwd_hosts.items(), keep_spams, strict=True):
             result.append(ForwardingHostDetails(
                 host=host,
                 source=source,
-                keep_spam=keep_spam,
+                keep_spam="yes" if keep_spam else "no",
             ))
 
         return result
 
     def get_forwarding_host_details(self, host: str) -> ForwardingHostDetails:
         """Get details for a specific forwarding host."""
-        source = self.store.hget("WHITELISTED_FWD_HOST", host)
+        pipe = self.store.batch()
+        pipe.hget("WHITELISTED_FWD_HOST", host)
+        pipe.hget("KEEP_SPAM", host)
+        source, keep_spam = pipe.execute()
         if not source:
             raise ForwardingHostNotFoundError(f"Forwarding host {host} not found")
 
-        keep_spam = "yes" if self.store.hget("KEEP_SPAM", host) else "no"
         return ForwardingHostDetails(
             host=host,
             source=source,
-            keep_spam=keep_spam,
+            keep_spam="yes" if keep_spam else "no",
         )
 
     def add_forwarding_host(self, forwarding_host_create: ForwardingHostCreate) -> list[str]:
@@ -86,17 +88,17 @@ def add_forwarding_host(self, forwarding_host_create: ForwardingHostCreate) -> l
         if not hosts:
             raise ForwardingHostValidationError(f"Invalid host: {host}")
 
-        # Add each resolved host to Redis
-        for resolved_host in hosts:
-            self.store.hset("WHITELISTED_FWD_HOST", resolved_host, source)
+        # Add all resolved hosts to Redis
+        with self.store.batch() as pipe:
+            pipe.hset("WHITELISTED_FWD_HOST", mapping=dict.fromkeys(hosts, source))
 
             # Handle spam filtering setting
             if not forwarding_host_create.filter_spam:
                 # Keep spam (don't filter)
-                self.store.hset("KEEP_SPAM", resolved_host, "1")
+                pipe.hset("KEEP_SPAM", mapping=dict.fromkeys(hosts, "1"))
             else:
                 # Filter spam (remove from KEEP_SPAM if present)
-                self.store.hdel("KEEP_SPAM", resolved_host)
+                pipe.hdel("KEEP_SPAM", *hosts)
 
         logger.info("Added forwarding host(s): %s", ", ".join(hosts))
         return hosts
@@ -124,8 +126,9 @@ def delete_forwarding_host(self, host: str) -> None:
         Args:
             host: The host identifier to delete
         """
-        self.store.hdel("WHITELISTED_FWD_HOST", host)
-        self.store.hdel("KEEP_SPAM", host)
+        with self.store.batch() as pipe:
+            pipe.hdel("WHITELISTED_FWD_HOST", host)
+            pipe.hdel("KEEP_SPAM", host)
         logger.info("Deleted forwarding host: %s", host)
 
     def _resolve_host(self, host: str) -> list[str]:
@@ -1,24 +1,39 @@
 """Network filtering."""
 
 import asyncio
+import heapq
 import ipaddress
+import json
 import logging
 import os
 import re
 import signal
+import socket
 import sys
 import time
 import uuid
 from argparse import ArgumentParser
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, suppress
+from contextvars import ContextVar
+from functools import partial
 from itertools import product
 
 import dns.asyncresolver
 import dns.exception
 import dns.resolver
-from attrs import define, field
+from attrs import Factory, define, evolve, field, fields
 from more_itertools import partition
 from nftables import Nftables
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    start_http_server,
+)
+from redis.exceptions import ResponseError
 from taraqueue.redis import RedisQueue
 
 from taramail.logger import (
@@ -27,11 +42,96 @@
     setup_logger,
 )
 from taramail.store import (
-    RedisStore,
+    AsyncRedisStore,
 )
 
 logger = logging.getLogger(__name__)
 
+registry = CollectorRegistry()
+
+tracked_attempts = Gauge(
+    "netfilter_tracked_attempts",
+    "Number of networks with tracked failed attempts",
+    registry=registry,
+)
+tracked_attempts_bytes = Gauge(
+    "netfilter_tracked_attempts_bytes",
+    "Approximate memory used by the tracked failed attempts",
+    registry=registry,
+)
+executor_queue_depth = Gauge(
+    "netfilter_executor_queue_depth",
+    "Number of nft commands submitted to the executor and not done yet",
+    registry=registry,
+)
+removed_attempts = Counter(
+    "netfilter_removed_attempts",
+    "Number of tracked failed attempts removed (expired or evicted)",
+    ["reason"],
+    registry=registry,
+)
+dns_cache_lookups = Counter(
+    "netfilter_dns_cache_lookups",
+    "Number of host name lookups answered from the cache or not",
+    ["result"],
+    registry=registry,
+)
+address_refresh_seconds = Gauge(
+    "netfilter_address_refresh_seconds",
+    "Time taken by the last refresh of an address list",
+    ["list"],
+    registry=registry,
+)
+consumed_messages = Counter(
+    "netfilter_consumed_messages",
+    "Number of fail2ban messages consumed",
+    registry=registry,
+)
+rule_matches = Counter(
+    "netfilter_rule_matches",
+    "Number of fail2ban messages matched per rule id",
+    ["rule"],
+    registry=registry,
+)
+match_seconds = Histogram(
+    "netfilter_match_seconds",
+    "Time taken to match a fail2ban message against the rules",
+    buckets=(.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01),
+    registry=registry,
+)
+nft_seconds = Histogram(
+    "netfilter_nft_seconds",
+    "Time taken by nft commands per operation, transaction for several commands",
+    ["operation"],
+    registry=registry,
+)
+active_bans = Gauge(
+    "netfilter_active_bans",
+    "Number of networks currently banned",
+    registry=registry,
+)
+address_list_size = Gauge(
+    "netfilter_address_list_size",
+    "Number of addresses in the whitelist or blacklist",
+    ["list"],
+    registry=registry,
+)
+ingest_lag_seconds = Gauge(
+    "netfilter_ingest_lag_seconds",
+    "Age of the last stream entry read when ingesting from a stream",
+    registry=registry,
+)
+ingest_queue_depth = Gauge(
+    "netfilter_ingest_queue_depth",
+    "Number of fail2ban messages waiting to be matched",
+    registry=registry,
+)
+dropped_messages = Counter(
+    "netfilter_dropped_messages",
+    "Number of fail2ban messages dropped because the ingest queue was full",
+    registry=registry,
+)
+
 
 def get_ip(address):
     ip = ipaddress.ip_address(address)
@@ -52,39 +152,679 @@ def is_ip(address):
     return True
 
 
-async def resolve_addresses(addresses):
+@define
+class AddressResolver:
+    """Resolve host names concurrently, caching answers until their TTL expires.
+
+    Missing names are cached for `negative_ttl` seconds, errors and
+    timeouts are not cached at all.
+    """
+
+    resolver = field(factory=dns.asyncresolver.Resolver)
+    concurrency = field(default=10)
+    lifetime = field(default=3)
+    negative_ttl = field(default=60)
+    cache = field(factory=dict)
+    semaphore = field(default=Factory(lambda self: asyncio.Semaphore(self.concurrency), takes_self=True), init=False)
+
+    async def resolve(self, addresses):
+        """Return IPs from a list of addresses that might be host names."""
+        now = time.time()
+        self.cache = {key: value for key, value in self.cache.items() if value[0] > now}
+
+        hostnames, ips = map(list, partition(is_ip, addresses))
+        answers = await asyncio.gather(*(
+            self.lookup(hostname, rdtype)
+            for hostname, rdtype in product(hostnames, ["A", "AAAA"])
+        ))
+        for answer in answers:
+            ips.extend(answer)
+
+        return set(ips)
+
+    async def lookup(self, hostname, rdtype):
+        if (hostname, rdtype) in self.cache:
+            dns_cache_lookups.labels("hit").inc()
+            return self.cache[hostname, rdtype][1]
+
+        dns_cache_lookups.labels("miss").inc()
+        async with self.semaphore:
+            try:
+                answer = await self.resolver.resolve(qname=hostname, rdtype=rdtype, lifetime=self.lifetime)
+            except dns.exception.Timeout:
+                logger.info("Hostname %(hostname)s timedout on resolve", {"hostname": hostname})
+                return []
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                self.cache[hostname, rdtype] = (time.time() + self.negative_ttl, [])
+                return []
+            except dns.exception.DNSException:
+                logger.exception("DNS error")
+                return []
+
+        ips = [rdata.to_text() for rdata in answer]
+        self.cache[hostname, rdtype] = (answer.expiration, ips)
+        return ips
+
+
+async def resolve_addresses(addresses, resolver=None):
     """Return IPs from a list of addresses that might be host names."""
-    resolver = dns.asyncresolver.Resolver()
-    hostnames, ips = map(list, partition(is_ip, addresses))
-    for hostname, rdtype in product(hostnames, ["A", "AAAA"]):
-        try:
-            answer = await resolver.resolve(qname=hostname, rdtype=rdtype, lifetime=3)
-        except dns.exception.Timeout:
-            logger.info("Hostname %(hostname)s timedout on resolve", {"hostname": hostname})
-            continue
-        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
-            continue
-        except dns.exception.DNSException:
-            logger.exception("DNS error")
-            continue
+    return await (resolver or AddressResolver()).resolve(addresses)
+
+
+@define(frozen=True)
+class NetworkMatcher:
+    """Longest prefix match of addresses against a set of networks.
+
+    Networks are grouped by version and prefix length, keyed by their
+    network address shifted down to the prefix, so looking up an address
+    costs one dict lookup per distinct prefix length.
+    """
+
+    prefixes = field(factory=dict)
+
+    @classmethod
+    def from_networks(cls, networks):
+        prefixes = defaultdict(lambda: defaultdict(dict))
+        for network in networks:
+            try:
+                net = ipaddress.ip_network(network, strict=False)
+            except ValueError:
+                logger.warning("Skipping invalid network %(network)s", {"network": network})
+                continue
+
+            key = int(net.network_address) >> (net.max_prefixlen - net.prefixlen)
+            prefixes[net.version][net.prefixlen][key] = net
+
+        return cls({
+            version: sorted(lengths.items(), reverse=True)
+            for version, lengths in prefixes.items()
+        })
+
+    def lookup(self, address):
+        """Return the longest network containing the address, if any."""
+        ip = ipaddress.ip_address(address)
+        value = int(ip)
+        for prefixlen, networks in self.prefixes.get(ip.version, []):
+            if net := networks.get(value >> (ip.max_prefixlen - prefixlen)):
+                return net
+
+        return None
+
+    def covering(self, network):
+        """Return the longest network containing the whole network, if any."""
+        value = int(network.network_address)
+        for prefixlen, networks in self.prefixes.get(network.version, []):
+            if prefixlen <= network.prefixlen and (
+                net := networks.get(value >> (network.max_prefixlen - prefixlen))
+            ):
+                return net
+
+        return None
+
+
+@define
+class Attempt:
+    """Failed attempts of a network."""
+
+    attempts: int = 0
+    last_attempt: float = 0
+    ban_counter: int = 0
+    banned: bool = False
+
+
+@define
+class AttemptTracker:
+    """Bounded tracker of the failed attempts per network.
+
+    Networks are kept in the order of their last attempt, so expired
+    entries are pruned from the front and the least recently attempted
+    entry is evicted when the tracker is full. Banned networks are never
+    removed, and networks that were banned before are kept for the
+    maximum ban time so that their ban time keeps increasing.
+    """
+
+    max_size: int = 100000
+    entries: OrderedDict = field(factory=OrderedDict)
+    banned_nets: set = field(factory=set)
+    banned_prefixlens: defaultdict = field(factory=lambda: defaultdict(int))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, net):
+        return net in self.entries
+
+    def __getitem__(self, net):
+        return self.entries[net]
+
+    def attempt(self, net, retry_window, now=None, count=1):
+        """Count failed attempts for a network and return its record."""
+        if now is None:
+            now = time.time()
+
+        if (record := self.entries.get(net)) is None:
+            record = self.entries[net] = Attempt()
+            self.evict()
+        else:
+            self.entries.move_to_end(net)
+
+        if now - record.last_attempt > retry_window:
+            record.attempts = 0
+
+        record.attempts += count
+        record.last_attempt = now
+        return record
+
+    def ban(self, net):
+        self.entries.setdefault(net, Attempt()).banned = True
+        self.add_banned(net)
+
+    def unban(self, net):
+        record = self.entries[net]
+        record.attempts = 0
+        record.ban_counter += 1
+        record.banned = False
+        self.discard_banned(net)
+
+    def add_banned(self, net):
+        if net not in self.banned_nets:
+            self.banned_nets.add(net)
+            self.banned_prefixlens[int(net.rpartition("/")[2])] += 1
+
+    def discard_banned(self, net):
+        if net in self.banned_nets:
+            self.banned_nets.discard(net)
+            self.banned_prefixlens[int(net.rpartition("/")[2])] -= 1
+
+    def restore_entry(self, net, record):
+        """Restore the record of a network, None if it was not tracked."""
+        if record is None:
+            self.entries.pop(net, None)
+            self.discard_banned(net)
+            return
+
+        self.entries[net] = record
+        if record.banned:
+            self.add_banned(net)
+        else:
+            self.discard_banned(net)
+
+    def merge(self, net, members):
+        """Replace banned member networks by a banned covering network."""
+        records = [self.entries.pop(member) for member in members]
+        if (record := self.entries.pop(net, None)) is not None:
+            records.append(record)
+
+        for member in members:
+            self.discard_banned(member)
+        self.add_banned(net)
+        self.entries[net] = Attempt(
+            last_attempt=max(record.last_attempt for record in records),
+            ban_counter=max(record.ban_counter for record in records),
+            banned=True,
+        )
+
+    def banned(self):
+        """Return the banned networks with their record."""
+        return [(net, self.entries[net]) for net in self.banned_nets]
+
+    def prune(self, retry_window, max_ban_time, now=None):
+        """Remove the entries that expired and return how many were removed."""
+        if now is None:
+            now = time.time()
+
+        expired = []
+        for net, record in self.entries.items():
+            elapsed = now - record.last_attempt
+            if elapsed <= retry_window:
+                break
+            if record.banned or (record.ban_counter and elapsed <= max_ban_time):
+                continue
+            expired.append(net)
+
+        for net in expired:
+            del self.entries[net]
+
+        removed_attempts.labels("expired").inc(len(expired))
+        return len(expired)
+
+    def evict(self):
+        """Remove the least recently attempted entries above the maximum size."""
+        if len(self.entries) <= self.max_size:
+            return
+
+        evicted = []
+        for net, record in self.entries.items():
+            if len(self.entries) - len(evicted) <= self.max_size:
+                break
+            if not record.banned:
+                evicted.append(net)
+
+        for net in evicted:
+            del self.entries[net]
+
+        removed_attempts.labels("evicted").inc(len(evicted))
 
-        for rdata in answer:
-            ips.append(rdata.to_text())
+    def snapshot(self):
+        """Return the entries as compact lists, in the order of their last attempt."""
+        return [
+            [net, record.attempts, record.last_attempt, record.ban_counter, record.banned]
+            for net, record in self.entries.items()
+        ]
+
+    def restore(self, entries):
+        for net, attempts, last_attempt, ban_counter, banned in entries:
+            self.entries[net] = Attempt(attempts, last_attempt, ban_counter, False)
+            if banned:
+                self.ban(net)
+
+        self.evict()
+
+    def memory_usage(self):
+        """Return the approximate memory used by the entries in bytes."""
+        return sys.getsizeof(self.entries) + sum(
+            sys.getsizeof(net) + sys.getsizeof(record)
+            for net, record in self.entries.items()
+        )
+
+
+@define
+class BanScheduler:
+    """Min-heap of the ban deadlines.
+
+    Rescheduled or cancelled bans leave stale entries in the heap, they
+    are skipped when they reach the top.
+    """
+
+    deadlines: list = field(factory=list)
+    expiries: dict = field(factory=dict)
+    wakeup: asyncio.Event = field(factory=asyncio.Event)
+
+    def __len__(self):
+        return len(self.expiries)
+
+    def schedule(self, net, expires):
+        self.expiries[net] = expires
+        heapq.heappush(self.deadlines, (expires, net))
+        if self.deadlines[0] == (expires, net):
+            self.wakeup.set()
+
+    def cancel(self, net):
+        self.expiries.pop(net, None)
+
+    def restore(self, net, expires):
+        """Restore the deadline of a network, None if it was not scheduled."""
+        if expires is None:
+            self.cancel(net)
+        elif self.expiries.get(net) != expires:
+            self.schedule(net, expires)
+
+    def next_deadline(self):
+        while self.deadlines:
+            expires, net = self.deadlines[0]
+            if self.expiries.get(net) == expires:
+                return expires
+            heapq.heappop(self.deadlines)
+
+        return None
+
+    def pop_due(self, now=None):
+        """Remove and return the networks whose deadline passed."""
+        if now is None:
+            now = time.time()
+
+        due = []
+        while (deadline := self.next_deadline()) is not None and deadline <= now:
+            _, net = heapq.heappop(self.deadlines)
+            del self.expiries[net]
+            due.append(net)
+
+        return due
+
+    async def wait(self, max_delay):
+        """Wait until the next deadline, an earlier deadline is scheduled or the maximum delay."""
+        delay = max_delay
+        if (deadline := self.next_deadline()) is not None:
+            delay = min(max(deadline - time.time(), 0), max_delay)
+
+        self.wakeup.clear()
+        with suppress(TimeoutError):
+            await asyncio.wait_for(self.wakeup.wait(), delay)
 
-    return set(ips)
+
+# Seconds before its expiry when the kernel may already have removed a ban.
+UNBAN_MARGIN = 2
 
 
 class NetfilterError(Exception):
     """Raised when an unexpected error happens."""
 
 
-@define(frozen=True)
+def get_nftables():
+    """Return an nftables context echoing the handles of new objects."""
+    nft = Nftables()
+    nft.set_echo_output(True)
+    nft.set_handle_output(True)
+    return nft
+
+
+class FakeNftables:
+    """In-memory nftables for testing, modelling chains, rules, sets and their handles.
+
+    Like libnftables, the commands of a call run in a transaction, so the
+    commands before a failing one are undone.
+    """
+
+    def __init__(self):
+        self.handle = 0
+        self.chains = {}
+        self.rules = defaultdict(list)
+        self.sets = {}
+        self.elements = defaultdict(dict)
+
+    def next_handle(self):
+        self.handle += 1
+        return self.handle
+
+    def add_base_chain(self, family, table, name, hook, prio=0):
+        self.chains[family, table, name] = {
+            "family": family,
+            "table": table,
+            "name": name,
+            "handle": self.next_handle(),
+            "type": "nat" if table == "nat" else "filter",
+            "hook": hook,
+            "prio": prio,
+            "policy": "accept",
+        }
+
+    def json_cmd(self, json_root):
+        echo, undo = [], []
+        try:
+            for command in json_root["nftables"]:
+                for verb, obj in command.items():
+                    if verb == "metainfo":
+                        continue
+                    ((kind, spec),) = obj.items()
+                    result = getattr(self, f"{verb}_{kind}")(spec, undo)
+                    if verb == "list":
+                        echo.extend(result)
+                    elif result is not None:
+                        echo.append({verb: {kind: result}})
+        except (AttributeError, KeyError, ValueError) as e:
+            for action in reversed(undo):
+                action()
+            return 1, "", f"Error: {e!r}"
+
+        return 0, {"nftables": [{"metainfo": {"json_schema_version": 1}}, *echo]}, ""
+
+    def get_chain(self, spec):
+        return self.chains[spec["family"], spec["table"], spec.get("chain", spec.get("name"))]
+
+    def add_chain(self, spec, undo):
+        key = spec["family"], spec["table"], spec["name"]
+        if key not in self.chains:
+            self.chains[key] = {**spec, "handle": self.next_handle()}
+            undo.append(partial(self.chains.pop, key))
+        return self.chains[key]
+
+    def delete_chain(self, spec, undo):
+        key = spec["family"], spec["table"], spec["name"]
+        chain = self.chains[key]
+        if self.rules[key] or any(
+            rule["expr"][-1].get("jump", {}).get("target") == spec["name"]
+            for (family, table, _), rules in self.rules.items()
+            if (family, table) == key[:2]
+            for rule in rules
+        ):
+            raise ValueError(f"Chain {spec['name']} is not empty or still referenced")
+        del self.chains[key]
+        undo.append(partial(self.chains.__setitem__, key, chain))
+
+    def flush_chain(self, spec, undo):
+        chain = self.get_chain(spec)
+        key = chain["family"], chain["table"], chain["name"]
+        rules, self.rules[key] = self.rules[key], []
+        undo.append(partial(self.rules.__setitem__, key, rules))
+
+    def add_rule(self, spec, undo, position=None):
+        chain = self.get_chain(spec)
+        rules = self.rules[chain["family"], chain["table"], chain["name"]]
+        rule = {**spec, "handle": self.next_handle()}
+        rules.insert(len(rules) if position is None else position, rule)
+        undo.append(partial(rules.remove, rule))
+        return rule
+
+    def insert_rule(self, spec, undo):
+        return self.add_rule(spec, undo, position=0)
+
+    def delete_rule(self, spec, undo):
+        chain = self.get_chain(spec)
+        rules = self.rules[chain["family"], chain["table"], chain["name"]]
+        index = next(i for i, rule in enumerate(rules) if rule["handle"] == spec["handle"])
+        rule = rules.pop(index)
+        undo.append(partial(rules.insert, index, rule))
+
+    def add_set(self, spec, undo):
+        key = spec["family"], spec["table"], spec["name"]
+        if key not in self.sets:
+            self.sets[key] = {**spec, "handle": self.next_handle()}
+            undo.append(partial(self.sets.pop, key))
+        return self.sets[key]
+
+    def delete_set(self, spec, undo):
+        key = spec["family"], spec["table"], spec["name"]
+        if any(
+            f"@{spec['name']}" in json.dumps(rule["expr"])
+            for (family, table, _), rules in self.rules.items()
+            if (family, table) == key[:2]
+            for rule in rules
+        ):
+            raise ValueError(f"Set {spec['name']} is still referenced")
+        old_set, old_elements = self.sets.pop(key), self.elements.pop(key, {})
+        undo.append(partial(self.sets.__setitem__, key, old_set))
+        undo.append(partial(self.elements.__setitem__, key, old_elements))
+
+    def get_elements(self, spec):
+        key = spec["family"], spec["table"], spec["name"]
+        if key not in self.sets:
+            raise KeyError(spec["name"])
+
+        elements, now = self.elements[key], time.time()
+        for net in [net for net, expires in elements.items() if expires <= now]:
+            del elements[net]
+
+        return elements
+
+    def parse_element(self, elem):
+        timeout = None
+        if "elem" in elem:
+            elem, timeout = elem["elem"]["val"], elem["elem"].get("timeout")
+
+        net = ipaddress.ip_network(f"{elem['prefix']['addr']}/{elem['prefix']['len']}")
+        return net, time.time() + timeout if timeout else float("inf")
+
+    def add_element(self, spec, undo):
+        elements = self.get_elements(spec)
+        for elem in spec["elem"]:
+            net, expires = self.parse_element(elem)
+            covering = (str(net.supernet(new_prefix=prefixlen)) for prefixlen in range(net.prefixlen))
+            if any(key in elements for key in covering) or (
+                net.prefixlen < net.max_prefixlen
+                and any(ipaddress.ip_network(key).subnet_of(net) for key in elements if key != str(net))
+            ):
+                raise ValueError(f"Conflicting intervals for {net}")
+            if str(net) not in elements:
+                elements[str(net)] = expires
+                undo.append(partial(elements.pop, str(net)))
+
+    def delete_element(self, spec, undo):
+        elements = self.get_elements(spec)
+        for elem in spec["elem"]:
+            net, _ = self.parse_element(elem)
+            expires = elements.pop(str(net))
+            undo.append(partial(elements.__setitem__, str(net), expires))
+
+    def flush_set(self, spec, undo):
+        key = spec["family"], spec["table"], spec["name"]
+        self.get_elements(spec)
+        elements, self.elements[key] = self.elements[key], {}
+        undo.append(partial(self.elements.__setitem__, key, elements))
+
+    def list_chain(self, spec, undo):
+        chain = self.get_chain(spec)
+        return [
+            {"chain": chain},
+            *({"rule": rule} for rule in self.rules[chain["family"], chain["table"], chain["name"]]),
+        ]
+
+    def list_chains(self, spec, undo):
+        return [{"chain": chain} for chain in self.chains.values() if chain["family"] == spec["family"]]
+
+    def list_set(self, spec, undo):
+        key = spec["family"], spec["table"], spec["name"]
+        elements, now = self.get_elements(spec), time.time()
+        elem = []
+        for net, expires in elements.items():
+            network = ipaddress.ip_network(net)
+            if network.prefixlen == network.max_prefixlen:
+                val = str(network.network_address)
+            else:
+                val = {"prefix": {"addr": str(network.network_address), "len": network.prefixlen}}
+            elem.append(val if expires == float("inf") else {"elem": {"val": val, "expires": round(expires - now)}})
+
+        return [{"set": {**self.sets[key], "elem": elem}}]
+
+    def list_sets(self, spec, undo):
+        return [{"set": s} for s in self.sets.values() if s["family"] == spec["family"]]
+
+    def list_table(self, spec, undo):
+        family, table = spec["family"], spec["name"]
+        output = [{"table": {"family": family, "name": table}}]
+        for chain in self.chains.values():
+            if (chain["family"], chain["table"]) == (family, table):
+                output.extend(self.list_chain(chain, undo))
+        output.extend({"set": s} for s in self.sets.values() if (s["family"], s["table"]) == (family, table))
+        return output
+
+
+@define
+class NetfilterIndex:
+    """Local index of the chains, rules and set elements in the kernel.
+
+    Rules are only indexed, in their kernel order, for chains that were
+    listed completely, so a missing chain means the kernel must be listed
+    again. Elements are the
+    temporary bans to their expiry time, the blacklist holds the permanent
+    bans.
+    """
+
+    chains = field(factory=dict)
+    rules = field(factory=dict)
+    elements = field(factory=dict)
+    blacklist = field(factory=set)
+
+    def load(self, output, rules=True):
+        """Load the chains and, optionally, the rules listed by the kernel."""
+        for obj in (output or {}).get("nftables", []):
+            if chain := obj.get("chain"):
+                key = chain["table"], chain["name"]
+                self.chains[key] = chain.get("handle")
+                if rules:
+                    self.rules[key] = []
+            elif rules and (rule := obj.get("rule")):
+                self.add_rule(rule)
+
+    def update(self, output):
+        """Update with the chains and rules echoed by the kernel."""
+        for echo in (output or {}).get("nftables", []):
+            obj = echo.get("add") or echo.get("insert") or {}
+            if (chain := obj.get("chain")) and "handle" in chain:
+                self.chains[chain["table"], chain["name"]] = chain["handle"]
+                self.rules.setdefault((chain["table"], chain["name"]), [])
+            elif (rule := obj.get("rule")) and "handle" in rule:
+                if "position" in rule or "index" in rule:
+                    # Placed relative to another rule, list the chain again.
+                    self.forget_rules(rule["table"], rule["chain"])
+                else:
+                    self.add_rule(rule, 0 if "insert" in echo else None)
+
+    def add_rule(self, rule, position=None):
+        rules = self.rules.get((rule["table"], rule["chain"]))
+        if rules is not None and all(r["handle"] != rule["handle"] for r in rules):
+            rules.insert(len(rules) if position is None else position, rule)
+
+    def remove_rule(self, table, chain, handle):
+        if (rules := self.rules.get((table, chain))) is not None:
+            rules[:] = [rule for rule in rules if rule["handle"] != handle]
+
+    def forget_rules(self, table, chain=None):
+        """Forget the rules of a chain, or of every chain of a table, so that they are listed again."""
+        for key in [key for key in self.rules if key == (table, chain) or (chain is None and key[0] == table)]:
+            del self.rules[key]
+
+    def remove_chain(self, table, name):
+        self.chains.pop((table, name), None)
+        self.rules.pop((table, name), None)
+
+    def sync(self, output):
+        """Forget the chains that were deleted or recreated in the kernel.
+
+        :return: Whether the index drifted from the kernel.
+        """
+        current = {
+            (obj["chain"]["table"], obj["chain"]["name"]): obj["chain"].get("handle")
+            for obj in (output or {}).get("nftables", [])
+            if "chain" in obj
+        }
+        drifted = [key for key, handle in self.chains.items() if current.get(key) != handle]
+        for table, name in drifted:
+            self.remove_chain(table, name)
+
+        return bool(drifted)
+
+    def restore_element(self, net, expires):
+        """Restore the expiry time of a temporary ban, None if it was not banned."""
+        if expires is None:
+            self.elements.pop(net, None)
+        else:
+            self.elements[net] = expires
+
+    def restore_sets(self, elements, blacklist):
+        self.elements.clear()
+        self.elements.update(elements)
+        self.blacklist.clear()
+        self.blacklist.update(blacklist)
+
+    def invalidate(self):
+        """Forget the chains and rules, the kernel will be listed again."""
+        self.chains.clear()
+        self.rules.clear()
+
+
+@define
+class NetfilterBatch:
+    """Commands collected to run in a single transaction, with the index changes to undo if it fails."""
+
+    commands = field(factory=list)
+    undo = field(factory=list)
+    committed = field(default=False)
+
+    def rollback(self):
+        for action in reversed(self.undo):
+            action()
+
+        self.commands.clear()
+        self.undo.clear()
+
+
+@define
 class NetfilterTables:
 
     name = field()
     comment = field()
     family = field()
-    nft = field(factory=Nftables)
+    nft = field(factory=get_nftables)
     chains = field(
         factory=lambda: {
             "filter": {
@@ -96,6 +836,35 @@ class NetfilterTables:
             },
         }
     )
+    pending = field(default=None, init=False)
+    index = field(factory=NetfilterIndex, init=False)
+
+    @property
+    def set_name(self):
+        """Name of the set holding the banned networks."""
+        return f"{self.name}_BANS"
+
+    @property
+    def set_type(self):
+        return "ipv4_addr" if self.family == "ip" else "ipv6_addr"
+
+    @property
+    def set_comment(self):
+        return f"{self.comment} bans"
+
+    @property
+    def blacklist_set_name(self):
+        """Name of the set holding the blacklisted networks.
+
+        They are kept apart from the temporary bans, so that banning a
+        network inside a blacklisted one doesn't conflict, and unbanning
+        it doesn't remove the blacklisted one.
+        """
+        return f"{self.name}_BLACKLIST"
+
+    @property
+    def blacklist_set_comment(self):
+        return f"{self.comment} blacklist"
 
     @classmethod
     def from_current_chains(cls, name, family):
@@ -129,6 +898,8 @@ def insert_mail_chains(self):
         if all(obj.get("chain", {}).get("name") != self.name for obj in kernel_ruleset["nftables"]):
             self.add_chain(table="filter", name=self.name)
 
+        self.insert_mail_set(kernel_ruleset)
+
         input_jump_found, forward_jump_found = False, False
         for obj in kernel_ruleset["nftables"]:
             if rule := obj.get("rule"):
@@ -162,8 +933,63 @@ def insert_mail_rule(self, chain: str):
 
         self.insert_rule("filter", chain, expr, comment=self.comment)
 
+    def insert_mail_set(self, kernel_ruleset):
+        for name, flags, comment in [
+            (self.set_name, ["interval", "timeout"], self.set_comment),
+            (self.blacklist_set_name, ["interval"], self.blacklist_set_comment),
+        ]:
+            if all(obj.get("set", {}).get("name") != name for obj in kernel_ruleset["nftables"]):
+                self.add_set(
+                    table="filter",
+                    name=name,
+                    type=self.set_type,
+                    flags=flags,
+                )
+
+            if not any(
+                obj["rule"]["chain"] == self.name and obj["rule"].get("comment") == comment
+                for obj in kernel_ruleset["nftables"]
+                if "rule" in obj
+            ):
+                self.insert_set_rule(name, comment)
+
+    def insert_set_rule(self, name: str, comment: str):
+        expr = [
+            {
+                "match": {
+                    "op": "==",
+                    "left": {
+                        "payload": {
+                            "protocol": self.family,
+                            "field": "saddr",
+                        },
+                    },
+                    "right": f"@{name}",
+                },
+            },
+            {
+                "counter": {
+                    "family": self.family,
+                    "table": "filter",
+                    "packets": 0,
+                    "bytes": 0,
+                },
+            },
+            {
+                "drop": None,
+            },
+        ]
+
+        self.insert_rule("filter", self.name, expr, comment=comment)
+
+    def sync_index(self):
+        """Check the chain handles against the kernel to detect drift."""
+        if self.index.sync(self.run_cmd({"list": {"chains": {"family": self.family}}})):
+            logger.info("Netfilter %(family)s index drifted from the kernel", {"family": self.family})
+
     def check_chain_order(self):
         error = False
+        self.sync_index()
 
         for chain in ["input", "forward"]:
             position = self.check(chain)
@@ -200,14 +1026,9 @@ def check(self, chain: str):
         if not chain_name:
             return None
 
-        kernel_ruleset = self.list_chain(table="filter", name=chain_name)
-        position = 0
-        for obj in kernel_ruleset["nftables"]:
-            if "rule" not in obj:
-                continue
-            if obj["rule"].get("comment") == self.comment:
+        for position, rule in enumerate(self.get_rules("filter", chain_name)):
+            if rule.get("comment") == self.comment:
                 return position
-            position += 1
 
         return -1
 
@@ -270,6 +1091,13 @@ def clear(self):
         if chain_handle:
             self.delete_chain("filter", self.name, chain_handle)
 
+        for name in (self.set_name, self.blacklist_set_name):
+            if set_handle := self.get_set_handle("filter", name):
+                self.delete_set("filter", name, set_handle)
+
+        self.index.elements.clear()
+        self.index.blacklist.clear()
+
     def snat(self, snat_target: str, source_address: str):
         chain_name = self.chains["nat"]["postrouting"]
 
@@ -277,16 +1105,10 @@ def snat(self, snat_target: str, source_address: str):
         if not chain_name:
             return
 
-        # Command: nft list chain <family> nat <chain_name>
         rule_position = 0
         rule_handle = None
         rule_found = False
-        kernel_ruleset = self.list_chain(table="nat", name=chain_name)
-        for obj in kernel_ruleset["nftables"]:
-            if not obj.get("rule"):
-                continue
-
-            rule = obj["rule"]
+        for rule in self.get_rules("nat", chain_name):
             if rule.get("comment") != self.comment:
                 rule_position += 1
                 continue
@@ -304,7 +1126,7 @@ def snat(self, snat_target: str, source_address: str):
             daddr_ip = rule["expr"][1]["match"]["right"]["prefix"]["addr"]
             daddr_len = int(rule["expr"][1]["match"]["right"]["prefix"]["len"])
 
-            target_ip = rule["expr"][3]["snat"]["addr"]
+            target_ip = next(expr["snat"]["addr"] for expr in rule["expr"] if "snat" in expr)
 
             saddr_net = ipaddress.ip_network(f"{saddr_ip}/{saddr_len}", strict=False)
             daddr_net = ipaddress.ip_network(f"{daddr_ip}/{daddr_len}", strict=False)
@@ -405,6 +1227,9 @@ def snat(self, snat_target: str, source_address: str):
             )
 
     def get_chain_handle(self, table: str, name: str):
+        if (table, name) in self.index.chains:
+            return self.index.chains[table, name]
+
         expected = {
             "family": self.family,
             "table": table,
@@ -415,7 +1240,28 @@ def get_chain_handle(self, table: str, name: str):
             if "chain" in obj and all(obj["chain"][k] == v for k, v in expected.items()):
                 return obj["chain"]["handle"]
 
+    def get_rules(self, table: str, chain: str):
+        """Return the rules of a chain in their kernel order, listing it when it is not indexed."""
+        if (rules := self.index.rules.get((table, chain))) is not None:
+            return list(rules)
+
+        kernel_ruleset = self.list_chain(table=table, name=chain)
+        return [obj["rule"] for obj in kernel_ruleset["nftables"] if "rule" in obj]
+
+    def forget_rules(self, table: str, chain: str | None = None):
+        self.index.forget_rules(table, chain)
+
+    def forget_base_rules(self):
+        """Forget the rules of the base chains, other software may have changed them unnoticed."""
+        for table, chains in self.chains.items():
+            for chain_name in chains.values():
+                if chain_name:
+                    self.index.forget_rules(table, chain_name)
+
     def get_rule_handles(self, table: str, chain: str, comment: str):
+        if (rules := self.index.rules.get((table, chain))) is not None:
+            return [rule["handle"] for rule in rules if rule.get("comment") == comment]
+
         expected = {
             "family": self.family,
             "table": table,
@@ -429,68 +1275,96 @@ def get_rule_handles(self, table: str, chain: str, comment: str):
             if "rule" in obj and all(obj["rule"].get(k) == v for k, v in expected.items())
         ]
 
-    def ban(self, ipaddr: str):
+    def get_set_handle(self, table: str, name: str):
+        expected = {
+            "family": self.family,
+            "table": table,
+            "name": name,
+        }
+        kernel_ruleset = self.list_sets()
+        for obj in kernel_ruleset["nftables"]:
+            if "set" in obj and all(obj["set"][k] == v for k, v in expected.items()):
+                return obj["set"]["handle"]
+
+    def get_set_element(self, ipaddr: str, timeout: int | None = None):
         ipaddr_net = ipaddress.ip_network(ipaddr, strict=False)
-        expr = [
-            {
-                "match": {
-                    "op": "==",
-                    "left": {
-                        "payload": {
-                            "protocol": self.family,
-                            "field": "saddr",
-                        },
-                    },
-                    "right": {
-                        "prefix": {
-                            "addr": str(ipaddr_net.network_address),
-                            "len": int(ipaddr_net.prefixlen),
-                        },
-                    },
-                },
+        element = {
+            "prefix": {
+                "addr": str(ipaddr_net.network_address),
+                "len": int(ipaddr_net.prefixlen),
             },
-            {
-                "counter": {
-                    "family": self.family,
-                    "table": "filter",
-                    "packets": 0,
-                    "bytes": 0,
+        }
+        if timeout:
+            element = {
+                "elem": {
+                    "val": element,
+                    "timeout": int(timeout),
                 },
-            },
-            {"drop": "null"},
-        ]
+            }
 
-        return self.insert_rule("filter", self.name, expr)
+        return element
 
-    def unban(self, ipaddr: str):
-        kernel_ruleset = self.list_chain(table="filter", name=self.name)
-        for obj in kernel_ruleset["nftables"]:
-            if not obj.get("rule"):
-                continue
-
-            rule = obj["rule"]["expr"][0]["match"]
-            if "payload" not in rule["left"]:
-                continue
-            left_opt = rule["left"]["payload"]
-            if left_opt["protocol"] != self.family:
-                continue
-            if left_opt["field"] != "saddr":
-                continue
+    def ban(self, ipaddr: str, timeout: int | None = None):
+        """Add a network to the ban set, the kernel expires it after timeout seconds."""
+        self.add_element("filter", self.set_name, [self.get_set_element(ipaddr, timeout)])
+        net = str(ipaddress.ip_network(ipaddr, strict=False))
+        self.on_rollback(partial(self.index.restore_element, net, self.index.elements.get(net)))
+        self.index.elements[net] = float("inf") if not timeout else time.time() + timeout
+        return True
 
-            # ip currently banned
-            rule_right = rule["right"]
-            if isinstance(rule_right, dict):
-                current_rule_ip = rule_right["prefix"]["addr"] + "/" + str(rule_right["prefix"]["len"])
-            else:
-                current_rule_ip = rule_right
-            current_rule_net = ipaddress.ip_network(current_rule_ip)
-
-            # ip to unban
-            candidate_net = ipaddress.ip_network(ipaddr, strict=False)
-            if current_rule_net == candidate_net:
-                rule_handle = obj["rule"]["handle"]
-                self.delete_rule("filter", self.name, rule_handle)
-                break
+    def unban(self, ipaddr: str):
+        """Remove a network from the ban set, unless it was never banned."""
+        net = str(ipaddress.ip_network(ipaddr, strict=False))
+        expires = self.index.elements.pop(net, None)
+        if expires is None:
+            return False
+
+        self.on_rollback(partial(self.index.restore_element, net, expires))
+        with self.batch():
+            # Deleting an element the kernel already expired would fail the
+            # whole transaction, so those about to expire are added back first.
+            if expires - time.time() <= UNBAN_MARGIN:
+                self.add_element("filter", self.set_name, [self.get_set_element(ipaddr, UNBAN_MARGIN)])
+            self.delete_element("filter", self.set_name, [self.get_set_element(ipaddr)])
+
+        return True
+
+    def perm_ban(self, ipaddr: str):
+        """Add a network to the blacklist set, unless it is already there."""
+        net = str(ipaddress.ip_network(ipaddr, strict=False))
+        if net in self.index.blacklist:
+            return False
+
+        self.add_element("filter", self.blacklist_set_name, [self.get_set_element(net)])
+        self.index.blacklist.add(net)
+        self.on_rollback(partial(self.index.blacklist.discard, net))
+        return True
+
+    def perm_unban(self, ipaddr: str):
+        """Remove a network from the blacklist set, unless it was never blacklisted."""
+        net = str(ipaddress.ip_network(ipaddr, strict=False))
+        if net not in self.index.blacklist:
+            return False
+
+        self.delete_element("filter", self.blacklist_set_name, [self.get_set_element(net)])
+        self.index.blacklist.discard(net)
+        self.on_rollback(partial(self.index.blacklist.add, net))
+        return True
+
+    def sync_elements(self, expiries, blacklist=()):
+        """Make the sets hold exactly the bans to their expiry time and the blacklist, in one transaction."""
+        now = time.time()
+        with self.batch():
+            self.flush_set(table="filter", name=self.set_name)
+            self.flush_set(table="filter", name=self.blacklist_set_name)
+            self.on_rollback(partial(self.index.restore_sets, dict(self.index.elements), set(self.index.blacklist)))
+            self.index.elements.clear()
+            self.index.blacklist.clear()
+            for net in blacklist:
+                self.perm_ban(net)
+            for net, expires in expiries.items():
+                if expires > now:
+                    self.ban(net, max(round(expires - now), 1))
 
     def add_chain(self, **kwargs):
         return self.run_cmd({
@@ -502,72 +1376,149 @@ def add_chain(self, **kwargs):
             },
         })
 
-    def flush_chain(self, **kwargs):
+    def add_set(self, **kwargs):
         return self.run_cmd({
-            "flush": {
-                "chain": {
+            "add": {
+                "set": {
                     "family": self.family,
                     **kwargs,
                 },
             },
         })
 
-    def insert_rule(self, table: str, chain: str, expr, **kwargs):
+    def add_element(self, table: str, name: str, elem):
         return self.run_cmd({
-            "insert": {
-                "rule": {
+            "add": {
+                "element": {
                     "family": self.family,
                     "table": table,
-                    "chain": chain,
-                    "expr": expr,
-                    **kwargs,
+                    "name": name,
+                    "elem": elem,
                 },
             },
         })
 
-    def list_chain(self, **kwargs):
+    def delete_element(self, table: str, name: str, elem):
         return self.run_cmd({
-            "list": {
-                "chain": {
+            "delete": {
+                "element": {
                     "family": self.family,
-                    **kwargs,
+                    "table": table,
+                    "name": name,
+                    "elem": elem,
                 },
             },
         })
 
-    def list_chains(self):
+    def flush_set(self, **kwargs):
         return self.run_cmd({
-            "list": {
-                "chains": {
+            "flush": {
+                "set": {
                     "family": self.family,
+                    **kwargs,
                 },
             },
         })
 
-    def list_table(self, **kwargs):
-        return self.run_cmd({
-            "list": {
-                "table": {
+    def flush_chain(self, **kwargs):
+        output = self.run_cmd({
+            "flush": {
+                "chain": {
                     "family": self.family,
                     **kwargs,
                 },
             },
         })
+        if (key := (kwargs.get("table"), kwargs.get("name"))) in self.index.rules:
+            self.index.rules[key] = []
 
-    def delete_chain(self, table: str, name: str, handle: str):
+        return output
+
+    def insert_rule(self, table: str, chain: str, expr, **kwargs):
         return self.run_cmd({
-            "delete": {
-                "chain": {
-                    "family": self.family,
+            "insert": {
+                "rule": {
+                    "family": self.family,
+                    "table": table,
+                    "chain": chain,
+                    "expr": expr,
+                    **kwargs,
+                },
+            },
+        })
+
+    def list_chain(self, **kwargs):
+        output = self.run_cmd({
+            "list": {
+                "chain": {
+                    "family": self.family,
+                    **kwargs,
+                },
+            },
+        })
+        self.index.load(output)
+        return output
+
+    def list_chains(self):
+        output = self.run_cmd({
+            "list": {
+                "chains": {
+                    "family": self.family,
+                },
+            },
+        })
+        self.index.load(output, rules=False)
+        return output
+
+    def list_sets(self):
+        return self.run_cmd({
+            "list": {
+                "sets": {
+                    "family": self.family,
+                },
+            },
+        })
+
+    def list_table(self, **kwargs):
+        output = self.run_cmd({
+            "list": {
+                "table": {
+                    "family": self.family,
+                    **kwargs,
+                },
+            },
+        })
+        self.index.load(output)
+        return output
+
+    def delete_chain(self, table: str, name: str, handle: str):
+        output = self.run_cmd({
+            "delete": {
+                "chain": {
+                    "family": self.family,
                     "table": table,
                     "name": name,
                     "handle": handle,
                 },
             },
         })
+        self.index.remove_chain(table, name)
+        return output
 
-    def delete_rule(self, table: str, chain: str, handle: str):
+    def delete_set(self, table: str, name: str, handle: str):
         return self.run_cmd({
+            "delete": {
+                "set": {
+                    "family": self.family,
+                    "table": table,
+                    "name": name,
+                    "handle": handle,
+                },
+            },
+        })
+
+    def delete_rule(self, table: str, chain: str, handle: str):
+        output = self.run_cmd({
             "delete": {
                 "rule": {
                     "family": self.family,
@@ -577,11 +1528,65 @@ def delete_rule(self, table: str, chain: str, handle: str):
                 },
             },
         })
+        self.index.remove_rule(table, chain, handle)
+        return output
+
+    def on_rollback(self, action):
+        """Undo an index change when the pending batch is rolled back."""
+        if self.pending is not None:
+            self.pending.undo.append(action)
+
+    def commit(self, batch):
+        """Run the commands of a batch in a single transaction, undoing its index changes if it fails."""
+        try:
+            if batch.commands:
+                self.run_cmd(*batch.commands)
+        except BaseException:
+            batch.rollback()
+            raise
+
+        batch.committed = True
+
+    def run_in(self, batch, func, *args, **kwargs):
+        """Run a method collecting its commands in the batch."""
+        pending, self.pending = self.pending, batch
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.pending = pending
+
+    @contextmanager
+    def batch(self):
+        """Collect commands and run them in a single transaction on exit.
+
+        Listing commands still run immediately, so they don't see the
+        commands pending in the batch. Nested batches join the outer one.
+        """
+        if self.pending is not None:
+            yield self
+            return
+
+        batch = self.pending = NetfilterBatch()
+        try:
+            yield self
+        except BaseException:
+            batch.rollback()
+            raise
+        finally:
+            self.pending = None
+
+        self.commit(batch)
 
     def run_cmd(self, *obj):
+        if self.pending is not None and not any("list" in o for o in obj):
+            self.pending.commands.extend(obj)
+            return None
+
         cmd = {"nftables": [{"metainfo": {"json_schema_version": 1}}, *obj]}
         logger.info("Running nft commands: %(obj)s", {"obj": obj})
-        rc, output, error = self.nft.json_cmd(cmd)
+        operation = next(iter(obj[0])) if len(obj) == 1 else "transaction"
+        with nft_seconds.labels(operation).time():
+            rc, output, error = self.nft.json_cmd(cmd)
         if rc != 0:
             logger.critical(
                 "Nftables error for %(cmd)s: %(error)s",
@@ -590,128 +1595,510 @@ def run_cmd(self, *obj):
                     "error": error,
                 },
             )
+            self.index.invalidate()
             raise NetfilterError(error)
 
+        self.index.update(output)
         return output
 
 
+@define
+class AsyncNetfilterTables:
+    """Asynchronous facade running the netfilter tables in an executor.
+
+    libnftables is not thread safe, so the executor must have a single
+    thread shared by the tables of every family. Commands then run in
+    the order they were submitted, without blocking the event loop.
+    """
+
+    tables = field()
+    executor = field(factory=lambda: ThreadPoolExecutor(max_workers=1, thread_name_prefix="nftables"))
+    batches = field(factory=lambda: ContextVar("netfilter_batch", default=None), init=False)
+
+    def __getattr__(self, name):
+        attr = getattr(self.tables, name)
+        if not callable(attr):
+            return attr
+
+        return partial(self.run, attr)
+
+    async def run(self, func, *args, **kwargs):
+        if (batch := self.batches.get()) is not None:
+            func = partial(self.tables.run_in, batch, func)
+
+        executor_queue_depth.inc()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+        finally:
+            executor_queue_depth.dec()
+
+    @asynccontextmanager
+    async def batch(self):
+        """See `NetfilterTables.batch`.
+
+        The batch belongs to the current task, so the commands that other
+        tasks run while it awaits don't join it.
+        """
+        if self.batches.get() is not None:
+            yield self
+            return
+
+        batch = NetfilterBatch()
+        token = self.batches.set(batch)
+        try:
+            yield self
+        except BaseException:
+            self.batches.reset(token)
+            await self.run(batch.rollback)
+            raise
+
+        self.batches.reset(token)
+        commit = asyncio.ensure_future(self.run(self.tables.commit, batch))
+        try:
+            await asyncio.shield(commit)
+        except asyncio.CancelledError:
+            # The transaction keeps running in the executor, wait for it
+            # so that the batch tells whether it committed.
+            while not commit.done():
+                with suppress(asyncio.CancelledError):
+                    await asyncio.shield(commit)
+            # A failed transaction was already logged by run_cmd.
+            commit.exception()
+            raise
+
+
+@define
+class BanCluster:
+    """Attempts and ban decisions shared by the netfilter nodes.
+
+    Attempts are counted in the store, so the node reaching the maximum
+    attempts publishes the ban on the F2B_BANS stream and every node,
+    including itself, applies it from there.
+    """
+
+    store = field()
+    client = field()
+    name = field(default="F2B_BANS")
+    maxlen = field(default=10000)
+    last_id = field(default="$")
+
+    @classmethod
+    def from_env(cls, store, env=os.environ):
+        queue = RedisQueue.from_env(env)
+        return cls(store, queue.client)
+
+    async def attempt(self, net, retry_window, count=1):
+        """Count failed attempts for a network and return the attempts in the retry window."""
+        return await self.store.incr(f"F2B_ATTEMPTS:{net}", retry_window, count)
+
+    async def ban_counter(self, net, max_ban_time):
+        """Count a ban for a network and return how many times it was banned before."""
+        return await self.store.incr(f"F2B_BAN_COUNTER:{net}", max_ban_time) - 1
+
+    async def publish(self, action, net, expires=0):
+        await self.client.xadd(
+            self.name,
+            {"action": action, "net": net, "expires": expires},
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+
+    async def seek(self):
+        """Start reading after the last published decision."""
+        entries = await self.client.xrevrange(self.name, count=1)
+        self.last_id = entries[0][0] if entries else "0"
+
+    async def receive(self, timeout=0):
+        """Return the decisions published since the last call."""
+        block = int(timeout * 1000) or None
+        response = await self.client.xread({self.name: self.last_id}, block=block)
+        entries = response[0][1] if response else []
+        if entries:
+            self.last_id = entries[-1][0]
+
+        return [fields for _, fields in entries]
+
+
+@define
+class F2BOptions:
+    """Fail2ban options, overridden by the fields of the F2B_OPTIONS hash.
+
+    Writers of the hash increment the F2B_OPTIONS_VERSION key, so that
+    refreshing only reads the hash again when the version changed.
+    """
+
+    ban_time: int = 1800
+    max_ban_time: int = 10000
+    ban_time_increment: bool = True
+    max_attempts: int = 10
+    retry_window: int = 600
+    netban_ipv4: int = 32
+    netban_ipv6: int = 128
+    aggregate_ipv4: int = 24
+    aggregate_ipv6: int = 64
+    aggregate_threshold: int = 16
+    banlist_id: str = field(factory=lambda: str(uuid.uuid4()))
+    manage_external: bool = False
+    version: str | None = None
+
+    @classmethod
+    def from_mapping(cls, mapping, **kwargs):
+        """Make options from string values, skipping unknown or invalid ones."""
+        types = {a.name: a.type for a in fields(cls)}
+        for name, value in mapping.items():
+            if types.get(name) not in (int, bool, str):
+                logger.warning("Skipping unknown fail2ban option %(name)s", {"name": name})
+                continue
+
+            try:
+                if types[name] is bool:
+                    kwargs[name] = str(value).lower() in ("1", "true", "y", "yes")
+                else:
+                    kwargs[name] = types[name](value)
+            except ValueError:
+                logger.warning(
+                    "Skipping invalid fail2ban option %(name)s: %(value)s",
+                    {
+                        "name": name,
+                        "value": value,
+                    },
+                )
+
+        return cls(**kwargs)
+
+    @classmethod
+    async def from_store(cls, store):
+        version = await store.get("F2B_OPTIONS_VERSION")
+        return cls.from_mapping(await store.hgetall("F2B_OPTIONS"), version=version)
+
+    async def refresh(self, store):
+        """Return the options from the store if their version changed, else these options."""
+        if await store.get("F2B_OPTIONS_VERSION") == self.version:
+            return self
+
+        return evolve(await F2BOptions.from_store(store), banlist_id=self.banlist_id)
+
+
+@define
+class NetfilterChanges:
+    """Changes of a netfilter batch, per IP version.
+
+    Changes to the tracker and the scheduler are undone if the transaction
+    of their family fails, actions such as writes to the store only run
+    once it commits.
+    """
+
+    undo = field(factory=lambda: defaultdict(list))
+    actions = field(factory=lambda: defaultdict(list))
+
+    def rollback(self, versions):
+        for version in versions:
+            for action in reversed(self.undo.pop(version, [])):
+                action()
+            self.actions.pop(version, None)
+
+    async def commit(self, versions):
+        for version in versions:
+            self.undo.pop(version, None)
+            for action in self.actions.pop(version, []):
+                await action()
+
+
 @define
 class Netfilter:
 
     store = field()
     ipv4_tables = field()
     ipv6_tables = field()
-    bans = field(factory=dict)
+    bans = field(factory=AttemptTracker)
+    options = field(factory=F2BOptions)
+    cluster = field(default=None)
     blacklist = field(factory=set)
+    blacklist_matcher = field(factory=NetworkMatcher)
     whitelist = field(factory=set)
-    lock = field(factory=asyncio.Lock)
+    whitelist_matcher = field(factory=NetworkMatcher)
+    scheduler = field(factory=BanScheduler)
+    resolver = field(factory=AddressResolver)
+    changes = field(factory=lambda: ContextVar("netfilter_changes", default=None), init=False)
 
     @classmethod
     def from_env(cls, env=os.environ):
-        store = RedisStore.from_env(env)
+        store = AsyncRedisStore.from_env(env)
         name = env.get("NETFILTER_CHAIN_NAME", "MAIL")
         comment = env.get("NETFILTER_CHAIN_COMMENT", "mail")
-        ipv4_tables = NetfilterTables(name, comment, "ip").init_chains()
-        ipv6_tables = NetfilterTables(name, comment, "ip6").init_chains()
-        return cls(store, ipv4_tables, ipv6_tables)
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nftables")
+        ipv4_tables = AsyncNetfilterTables(NetfilterTables(name, comment, "ip").init_chains(), executor)
+        ipv6_tables = AsyncNetfilterTables(NetfilterTables(name, comment, "ip6").init_chains(), executor)
+        bans = AttemptTracker(int(env.get("NETFILTER_MAX_TRACKED", "100000")))
+        cluster = BanCluster.from_env(store, env) if env.get("NETFILTER_CLUSTER", "n") == "y" else None
+        return cls(store, ipv4_tables, ipv6_tables, bans, cluster=cluster)
+
+    @asynccontextmanager
+    async def batch(self):
+        """Run the commands for both families in one transaction per family.
+
+        See `NetfilterChanges` for the state changed in the batch. Nested
+        batches join the outer one.
+        """
+        if self.changes.get() is not None:
+            yield self
+            return
 
-    @property
-    def f2boptions(self):
-        return {
-            "ban_time": 1800,
-            "max_ban_time": 10000,
-            "ban_time_increment": True,
-            "max_attempts": 10,
-            "retry_window": 600,
-            "netban_ipv4": 32,
-            "netban_ipv6": 128,
-            "banlist_id": str(uuid.uuid4()),
-            "manage_external": 0,
-        }
+        changes = NetfilterChanges()
+        token = self.changes.set(changes)
+        batches = {}
+        try:
+            async with self.ipv4_tables.batch(), self.ipv6_tables.batch():
+                batches = {4: self.ipv4_tables.batches.get(), 6: self.ipv6_tables.batches.get()}
+                yield self
+        finally:
+            self.changes.reset(token)
+            committed = {version for version, batch in batches.items() if batch.committed}
+            changes.rollback({4, 6} - committed)
+            active_bans.set(len(self.bans.banned_nets))
+            await changes.commit(committed)
+
+    def on_rollback(self, net, action):
+        """Undo a change for a network if the transaction of its family fails."""
+        if (changes := self.changes.get()) is not None:
+            changes.undo[ipaddress.ip_network(net, strict=False).version].append(action)
+
+    async def on_commit(self, net, action):
+        """Run an action for a network once the transaction of its family commits, now outside a batch."""
+        if (changes := self.changes.get()) is not None:
+            changes.actions[ipaddress.ip_network(net, strict=False).version].append(action)
+        else:
+            await action()
+
+    def save_ban(self, net):
+        """Save the tracker record and the deadline of a network, to restore them on rollback."""
+        record = self.bans.entries.get(net)
+        self.on_rollback(net, partial(
+            self.restore_ban,
+            net,
+            None if record is None else evolve(record),
+            self.scheduler.expiries.get(net),
+        ))
+
+    def restore_ban(self, net, record, expires):
+        self.bans.restore_entry(net, record)
+        self.scheduler.restore(net, expires)
 
     def calc_net_ban_time(self, ban_counter):
-        ban_time = self.f2boptions["ban_time"]
-        max_ban_time = self.f2boptions["max_ban_time"]
-        ban_time_increment = self.f2boptions["ban_time_increment"]
+        ban_time = self.options.ban_time
+        max_ban_time = self.options.max_ban_time
+        ban_time_increment = self.options.ban_time_increment
         net_ban_time = ban_time if not ban_time_increment else ban_time * 2**ban_counter
         net_ban_time = max([ban_time, min([net_ban_time, max_ban_time])])
         return net_ban_time
 
-    async def ban(self, address):
-        max_attempts = self.f2boptions["max_attempts"]
-        retry_window = self.f2boptions["retry_window"]
-        netban_ipv4 = f"/{self.f2boptions['netban_ipv4']}"
-        netban_ipv6 = f"/{self.f2boptions['netban_ipv6']}"
+    async def ban(self, address, count=1):
+        """Count failed attempts from an address, banning its network once there are too many."""
+        if net := self.ban_network(address):
+            await self.attempt(net, count)
+
+    async def ban_all(self, addresses):
+        """Count failed attempts from addresses at once per network, in one transaction."""
+        counts = defaultdict(int)
+        for address in addresses:
+            if net := self.ban_network(address):
+                counts[net] += 1
+
+        async with self.batch():
+            for net, count in counts.items():
+                await self.attempt(net, count)
+
+    def ban_network(self, address):
+        """Return the network banned for the failed attempts of an address, None if it is private or whitelisted."""
+        options = self.options
+        netban_ipv4 = f"/{options.netban_ipv4}"
+        netban_ipv6 = f"/{options.netban_ipv6}"
 
         ip = get_ip(address)
         if not ip:
-            return
+            return None
 
         address = str(ip)
-        self_network = ipaddress.ip_network(address)
-
-        async with self.lock:
-            whitelist = self.whitelist
-
-        if whitelist:
-            for wl_key in whitelist:
-                wl_net = ipaddress.ip_network(wl_key, False)
-                if wl_net.overlaps(self_network):
-                    logger.info(
-                        "Address %(network)s is whitelisted by rule %(rule)s",
-                        {
-                            "network": self_network,
-                            "rule": wl_net,
-                        },
-                    )
-                    return
+        if wl_net := self.whitelist_matcher.lookup(ip):
+            logger.info(
+                "Address %(network)s is whitelisted by rule %(rule)s",
+                {
+                    "network": ipaddress.ip_network(address),
+                    "rule": wl_net,
+                },
+            )
+            return None
 
-        net = ipaddress.ip_network(
+        return ipaddress.ip_network(
             (address + (netban_ipv4 if type(ip) is ipaddress.IPv4Address else netban_ipv6)), strict=False
         )
-        net = str(net)
-        if net not in self.bans:
-            self.bans[net] = {"attempts": 0, "last_attempt": 0, "ban_counter": 0}
-
-        current_attempt = time.time()
-        if current_attempt - self.bans[net]["last_attempt"] > retry_window:
-            self.bans[net]["attempts"] = 0
 
-        self.bans[net]["attempts"] += 1
-        self.bans[net]["last_attempt"] = current_attempt
+    async def attempt(self, net, count=1):
+        """Count failed attempts from a network, banning it once there are too many."""
+        options = self.options
+        max_attempts = options.max_attempts
+        retry_window = options.retry_window
+        if covering := self.covering_ban(net):
+            logger.info("%(net)s is already banned by %(covering)s", {"net": net, "covering": covering})
+            return
 
-        if self.bans[net]["attempts"] >= max_attempts:
-            cur_time = round(time.time())
-            net_ban_time = self.calc_net_ban_time(self.bans[net]["ban_counter"])
-            logger.critical(
-                "Banning %(net)s for %(minutes)d minutes",
-                {
-                    "net": net,
-                    "minutes": net_ban_time / 60,
-                },
-            )
-            if type(ip) is ipaddress.IPv4Address and self.f2boptions["manage_external"] != 1:
-                async with self.lock:
-                    self.ipv4_tables.ban(net)
-            elif self.f2boptions["manage_external"] != 1:
-                async with self.lock:
-                    self.ipv6_tables.ban(net)
-
-            self.store.hset("F2B_ACTIVE_BANS", net, cur_time + net_ban_time)
+        net = str(net)
+        if self.cluster:
+            attempts = await self.cluster.attempt(net, retry_window, count)
         else:
+            record = self.bans.attempt(net, retry_window, count=count)
+            attempts = record.attempts
+
+        if attempts < max_attempts:
             logger.warning(
                 "%(attempts)d more attempts in the next %(seconds)d seconds until %(net)s is banned",
                 {
-                    "attempts": max_attempts - self.bans[net]["attempts"],
+                    "attempts": max_attempts - attempts,
                     "seconds": retry_window,
                     "net": net,
                 },
             )
+        elif not self.cluster:
+            await self.apply_ban(net, round(time.time()) + self.calc_net_ban_time(record.ban_counter))
+        elif attempts - count < max_attempts:
+            # Only the node reaching the maximum publishes, later attempts are already being banned.
+            ban_counter = await self.cluster.ban_counter(net, options.max_ban_time)
+            await self.cluster.publish("ban", net, round(time.time()) + self.calc_net_ban_time(ban_counter))
+
+    async def apply_ban(self, net, expires):
+        """Ban a network locally until the expiry time."""
+        cur_time = round(time.time())
+        logger.critical(
+            "Banning %(net)s for %(minutes)d minutes",
+            {
+                "net": net,
+                "minutes": (expires - cur_time) / 60,
+            },
+        )
+        if not self.options.manage_external:
+            tables = self.ipv4_tables if ipaddress.ip_network(net).version == 4 else self.ipv6_tables
+            await tables.ban(net, max(expires - cur_time, 1))
+
+        self.save_ban(net)
+        self.bans.ban(net)
+        self.scheduler.schedule(net, expires)
+        await self.on_commit(net, partial(self.store.hset, "F2B_ACTIVE_BANS", net, expires))
+        active_bans.set(len(self.bans.banned_nets))
+
+    async def apply(self, decision):
+        """Apply a ban or unban decision published by a node of the cluster."""
+        net = decision["net"]
+        if decision["action"] == "ban":
+            expires = int(decision["expires"])
+            if self.scheduler.expiries.get(net) != expires and expires > time.time():
+                await self.apply_ban(net, expires)
+        elif decision["action"] == "unban":
+            await self.unban(net)
+
+    async def reconcile(self):
+        """Apply the active bans of the cluster, then follow the decisions published after them."""
+        await self.cluster.seek()
+        cur_time = time.time()
+        async with self.batch():
+            for net, expires in (await self.store.hgetall("F2B_ACTIVE_BANS")).items():
+                if int(expires) > cur_time and net not in self.bans.banned_nets:
+                    await self.apply_ban(net, int(expires))
+
+    def covering_ban(self, network):
+        """Return the blacklisted network containing the given network, or the banned one strictly containing it."""
+        if blacklisted := self.blacklist_matcher.covering(network):
+            return str(blacklisted)
+
+        for prefixlen, count in self.bans.banned_prefixlens.items():
+            if (
+                count
+                and prefixlen < network.prefixlen
+                and (net := str(network.supernet(new_prefix=prefixlen))) in self.bans.banned_nets
+            ):
+                return net
+
+        return None
+
+    def aggregates(self):
+        """Return the dense networks covering banned networks, with their members.
+
+        Banned networks are grouped by their prefix at the aggregate prefix
+        length, groups with at least the threshold of members are collapsed
+        into covering networks, excluding those overlapping a whitelisted
+        or blacklisted network.
+        """
+        threshold = self.options.aggregate_threshold
+        if not threshold:
+            return {}
+
+        groups = defaultdict(list)
+        for net, _ in self.bans.banned():
+            network = ipaddress.ip_network(net)
+            prefixlen = getattr(self.options, f"aggregate_ipv{network.version}")
+            if network.prefixlen > prefixlen:
+                groups[network.supernet(new_prefix=prefixlen)].append(network)
+
+        excluded = []
+        for net in self.whitelist | self.blacklist:
+            with suppress(ValueError):
+                excluded.append(ipaddress.ip_network(net, strict=False))
+
+        dense = [
+            supernet
+            for supernet, members in groups.items()
+            if len(members) >= threshold and not any(supernet.overlaps(net) for net in excluded)
+        ]
+        aggregates = {}
+        for version in (4, 6):
+            for aggregate in ipaddress.collapse_addresses(net for net in dense if net.version == version):
+                aggregates[aggregate] = [
+                    member
+                    for supernet in dense
+                    if supernet.subnet_of(aggregate)
+                    for member in groups[supernet]
+                ]
+
+        return aggregates
+
+    async def aggregate(self):
+        """Swap dense banned networks for their covering network."""
+        if self.options.manage_external:
+            return
+
+        cur_time = round(time.time())
+        for aggregate, members in self.aggregates().items():
+            nets = [str(member) for member in members]
+            expires = max(self.scheduler.expiries.get(net, cur_time) for net in nets)
+            logger.critical(
+                "Banning %(net)s for %(minutes)d minutes, aggregating %(num)d banned networks",
+                {
+                    "net": aggregate,
+                    "minutes": (expires - cur_time) / 60,
+                    "num": len(nets),
+                },
+            )
+            tables = self.ipv4_tables if aggregate.version == 4 else self.ipv6_tables
+            for net in nets:
+                await tables.unban(net)
+
+            await tables.ban(str(aggregate), max(expires - cur_time, 1))
+            await self.on_commit(str(aggregate), partial(self.merge_bans, str(aggregate), nets, expires))
+
+    async def merge_bans(self, aggregate, nets, expires):
+        """Track the ban of an aggregate in place of the bans of its members."""
+        self.bans.merge(aggregate, nets)
+        for net in nets:
+            self.scheduler.cancel(net)
+        self.scheduler.schedule(aggregate, expires)
+        await self.store.hdel("F2B_ACTIVE_BANS", *nets)
+        await self.store.hset("F2B_ACTIVE_BANS", aggregate, expires)
+        active_bans.set(len(self.bans.banned_nets))
 
     async def unban(self, net):
         if net not in self.bans:
             logger.info("%(net)s is not banned, skipping unban and deleting from queue (if any)", {"net": net})
-            self.store.hdel("F2B_QUEUE_UNBAN", net)
+            await self.store.hdel("F2B_QUEUE_UNBAN", net)
             return
 
         logger.info(
@@ -721,36 +2108,33 @@ async def unban(self, net):
             },
         )
         if type(ipaddress.ip_network(net)) is ipaddress.IPv4Network:
-            async with self.lock:
-                self.ipv4_tables.unban(net)
+            await self.ipv4_tables.unban(net)
         else:
-            async with self.lock:
-                self.ipv6_tables.unban(net)
+            await self.ipv6_tables.unban(net)
 
-        self.store.hdel("F2B_ACTIVE_BANS", net)
-        self.store.hdel("F2B_QUEUE_UNBAN", net)
-        if net in self.bans:
-            self.bans[net]["attempts"] = 0
-            self.bans[net]["ban_counter"] += 1
+        self.save_ban(net)
+        await self.on_commit(net, partial(self.store.hdel, "F2B_ACTIVE_BANS", net))
+        await self.on_commit(net, partial(self.store.hdel, "F2B_QUEUE_UNBAN", net))
+        self.scheduler.cancel(net)
+        self.bans.unban(net)
+        active_bans.set(len(self.bans.banned_nets))
 
     async def perm_ban(self, net, unban=False):
         is_unbanned = False
         is_banned = False
         if type(ipaddress.ip_network(net, strict=False)) is ipaddress.IPv4Network:
-            async with self.lock:
-                if unban:
-                    is_unbanned = self.ipv4_tables.unban(net)
-                elif self.f2boptions["manage_external"] != 1:
-                    is_banned = self.ipv4_tables.ban(net)
+            if unban:
+                is_unbanned = await self.ipv4_tables.perm_unban(net)
+            elif not self.options.manage_external:
+                is_banned = await self.ipv4_tables.perm_ban(net)
         else:
-            async with self.lock:
-                if unban:
-                    is_unbanned = self.ipv6_tables.unban(net)
-                elif self.f2boptions["manage_external"] != 1:
-                    is_banned = self.ipv6_tables.ban(net)
+            if unban:
+                is_unbanned = await self.ipv6_tables.perm_unban(net)
+            elif not self.options.manage_external:
+                is_banned = await self.ipv6_tables.perm_ban(net)
 
         if is_unbanned:
-            self.store.hdel("F2B_PERM_BANS", net)
+            await self.on_commit(net, partial(self.store.hdel, "F2B_PERM_BANS", net))
             logger.critical(
                 "Removed host/network %(net)s from blacklist",
                 {
@@ -758,7 +2142,7 @@ async def perm_ban(self, net, unban=False):
                 },
             )
         elif is_banned:
-            self.store.hset("F2B_PERM_BANS", net, round(time.time()))
+            await self.on_commit(net, partial(self.store.hset, "F2B_PERM_BANS", net, round(time.time())))
             logger.critical(
                 "Added host/network %(net)s to blacklist",
                 {
@@ -766,67 +2150,430 @@ async def perm_ban(self, net, unban=False):
                 },
             )
 
-    async def autopurge(self):
-        max_attempts = self.f2boptions["max_attempts"]
-        queue_unban = self.store.hgetall("F2B_QUEUE_UNBAN")
-        if queue_unban:
+    async def unban_queued(self):
+        queue_unban = await self.store.hkeys("F2B_QUEUE_UNBAN")
+        if self.cluster:
+            for net in queue_unban:
+                await self.cluster.publish("unban", net)
+                await self.store.hdel("F2B_QUEUE_UNBAN", net)
+            return
+
+        async with self.batch():
             for net in queue_unban:
                 await self.unban(str(net))
-        for net in self.bans.copy():
-            if self.bans[net]["attempts"] >= max_attempts:
-                net_ban_time = self.calc_net_ban_time(self.bans[net]["ban_counter"])
-                time_since_last_attempt = time.time() - self.bans[net]["last_attempt"]
-                if time_since_last_attempt > net_ban_time:
-                    await self.unban(net)
+
+    async def autopurge(self):
+        async with self.batch():
+            for net in self.scheduler.pop_due():
+                # Still due if the transaction fails, so the next purge retries it.
+                self.on_rollback(net, partial(self.scheduler.schedule, net, time.time()))
+                await self.unban(net)
+            await self.aggregate()
+
+        self.bans.prune(self.options.retry_window, self.options.max_ban_time)
+        tracked_attempts.set(len(self.bans))
+        tracked_attempts_bytes.set(self.bans.memory_usage())
+        active_bans.set(len(self.bans.banned_nets))
 
     async def chain_order(self):
-        async with self.lock:
-            self.ipv4_tables.check_chain_order()
-            self.ipv6_tables.check_chain_order()
+        await self.ipv4_tables.check_chain_order()
+        await self.ipv6_tables.check_chain_order()
+
+    async def forget_rules(self, chains):
+        """Forget the indexed rules of the chains changed in the kernel."""
+        for family, table, chain in chains:
+            tables = self.ipv4_tables if family == "ip" else self.ipv6_tables
+            await tables.forget_rules(table, chain)
+
+    async def forget_base_rules(self):
+        await self.ipv4_tables.forget_base_rules()
+        await self.ipv6_tables.forget_base_rules()
+
+    async def update_options(self):
+        options = await self.options.refresh(self.store)
+        if options is not self.options:
+            self.options = options
+            logger.info("Fail2ban options were changed to version %(version)s", {"version": options.version})
 
     async def update_blacklist(self):
-        blacklist = set(self.store.hgetall("F2B_BLACKLIST"))
-        new_blacklist = await resolve_addresses(blacklist)
+        blacklist = set(await self.store.hgetall("F2B_BLACKLIST"))
+        with address_refresh_seconds.labels("blacklist").time():
+            new_blacklist = await resolve_addresses(blacklist, self.resolver)
         if new_blacklist != self.blacklist:
             addban = new_blacklist.difference(self.blacklist)
             delban = self.blacklist.difference(new_blacklist)
+            blacklist_matcher = NetworkMatcher.from_networks(new_blacklist)
+            async with self.batch():
+                for net in addban:
+                    await self.perm_ban(net=net)
+                for net in delban:
+                    await self.perm_ban(net=net, unban=True)
+                # Temporary bans covered by the blacklist are redundant.
+                for net, _ in self.bans.banned():
+                    if blacklist_matcher.covering(ipaddress.ip_network(net)):
+                        await self.unban(net)
+
+            # Only once committed, so that a failed update is tried again.
             self.blacklist = new_blacklist
+            self.blacklist_matcher = blacklist_matcher
+            address_list_size.labels("blacklist").set(len(new_blacklist))
             logger.info(
                 "Blacklist was changed, it has %(num)s entries",
                 {
                     "num": len(self.blacklist),
                 },
             )
-            for net in addban:
-                await self.perm_ban(net=net)
-            for net in delban:
-                await self.perm_ban(net=net, unban=True)
 
     async def update_whitelist(self):
-        whitelist = set(self.store.hgetall("F2B_WHITELIST"))
-        new_whitelist = await resolve_addresses(whitelist)
-        async with self.lock:
-            if new_whitelist != self.whitelist:
-                self.whitelist = new_whitelist
-                logger.info(
-                    "Whitelist was changed, it has %(num)s entries",
-                    {
-                        "num": len(self.whitelist),
-                    },
-                )
+        whitelist = set(await self.store.hgetall("F2B_WHITELIST"))
+        with address_refresh_seconds.labels("whitelist").time():
+            new_whitelist = await resolve_addresses(whitelist, self.resolver)
+        if new_whitelist != self.whitelist:
+            self.whitelist = new_whitelist
+            self.whitelist_matcher = NetworkMatcher.from_networks(new_whitelist)
+            address_list_size.labels("whitelist").set(len(new_whitelist))
+            logger.info(
+                "Whitelist was changed, it has %(num)s entries",
+                {
+                    "num": len(self.whitelist),
+                },
+            )
+
+    async def snapshot(self):
+        """Save the attempts, bans and blacklist to the store, for a warm start."""
+        snapshot = {
+            "time": time.time(),
+            "attempts": self.bans.snapshot(),
+            "expiries": self.scheduler.expiries,
+            "blacklist": sorted(self.blacklist),
+        }
+        await self.store.set("F2B_SNAPSHOT", json.dumps(snapshot), self.options.max_ban_time)
+        logger.info(
+            "Saved %(num)d tracked networks to the snapshot",
+            {
+                "num": len(snapshot["attempts"]),
+            },
+        )
+
+    async def restore(self):
+        """Restore the state saved in the snapshot, returning whether there was one."""
+        if not (payload := await self.store.get("F2B_SNAPSHOT")):
+            return False
+
+        await self.store.delete("F2B_SNAPSHOT")
+        try:
+            snapshot = json.loads(payload)
+            self.bans.restore(snapshot["attempts"])
+            for net, expires in snapshot["expiries"].items():
+                self.scheduler.schedule(net, expires)
+            self.blacklist = set(snapshot["blacklist"])
+            self.blacklist_matcher = NetworkMatcher.from_networks(self.blacklist)
+        except (ValueError, KeyError, TypeError):
+            logger.exception("Invalid snapshot, starting from scratch")
+            self.bans = AttemptTracker(self.bans.max_size)
+            self.scheduler = BanScheduler()
+            self.blacklist = set()
+            self.blacklist_matcher = NetworkMatcher()
+            return False
+
+        active = await self.store.hgetall("F2B_ACTIVE_BANS")
+        if stale := [net for net in active if net not in self.scheduler.expiries]:
+            await self.store.hdel("F2B_ACTIVE_BANS", *stale)
+
+        logger.info(
+            "Restored %(num)d tracked networks saved %(seconds)d seconds ago",
+            {
+                "num": len(self.bans),
+                "seconds": time.time() - snapshot["time"],
+            },
+        )
+        return True
+
+    async def sync_bans(self):
+        """Reconcile the ban sets of the kernel with the restored bans and blacklist."""
+        blacklist = {4: set(), 6: set()}
+        for net in self.blacklist:
+            with suppress(ValueError):
+                network = ipaddress.ip_network(net, strict=False)
+                blacklist[network.version].add(str(network))
+
+        expiries = {4: {}, 6: {}}
+        for net, expires in self.scheduler.expiries.items():
+            expiries[ipaddress.ip_network(net).version][net] = expires
+
+        if not self.options.manage_external:
+            await self.ipv4_tables.sync_elements(expiries[4], blacklist[4])
+            await self.ipv6_tables.sync_elements(expiries[6], blacklist[6])
 
     async def clear(self):
         logger.info("Clearing all bans")
-        for net in self.bans.copy():
-            await self.unban(net)
-        async with self.lock:
-            self.ipv4_tables.clear()
-            self.ipv6_tables.clear()
+        async with self.batch():
+            if not self.cluster:
+                for net, _ in self.bans.banned():
+                    await self.unban(net)
+            await self.ipv4_tables.clear()
+            await self.ipv6_tables.clear()
+
+        if self.cluster:
+            # The other nodes still enforce the bans in the store.
+            self.bans = AttemptTracker(self.bans.max_size)
+            self.scheduler = BanScheduler()
+            return
+
+        try:
+            await self.store.delete("F2B_ACTIVE_BANS")
+            await self.store.delete("F2B_PERM_BANS")
+        except Exception:
+            logger.exception("Error clearing store keys F2B_ACTIVE_BANS and F2B_PERM_BANS")
+
+
+F2B_REGEX = {
+    "1": "mail UI: Invalid password for .+ by ([0-9a-f\\.:]+)",
+    "2": "Rspamd UI: Invalid password by ([0-9a-f\\.:]+)",
+    "3": (
+        "warning: .*\\[([0-9a-f\\.:]+)\\]: SASL .+ authentication failed: (?!.*Connection lost to"
+        " authentication server).+"
+    ),
+    "4": "warning: non-SMTP command from .*\\[([0-9a-f\\.:]+)]:.+",
+    "5": "NOQUEUE: reject: RCPT from \\[([0-9a-f\\.:]+)].+Protocol error.+",
+    "6": "-login: Disconnected.+ \\(auth failed, .+\\): user=.*, method=.+, rip=([0-9a-f\\.:]+),",
+    "7": "-login: Aborted login.+ \\(auth failed .+\\): user=.+, rip=([0-9a-f\\.:]+), lip.+",
+    "8": "-login: Aborted login.+ \\(tried to use disallowed .+\\): user=.+, rip=([0-9a-f\\.:]+), lip.+",
+    "9": "SOGo.+ Login from '([0-9a-f\\.:]+)' for user .+ might not have worked",
+    "10": '([0-9a-f\\.:]+) "GET \\/SOGo\\/.* HTTP.+" 403 .+',
+}
+
+
+@define(frozen=True)
+class F2BMatcher:
+    """Match messages against all the fail2ban rules in a single pass.
+
+    The rules are combined into one alternation where each rule is
+    wrapped in a named group, so the first group inside the rule must
+    capture the address. When many rules match, the leftmost match wins.
+    """
+
+    rules = field(factory=dict)
+    pattern = field(default=None)
+    groups = field(factory=dict)
+
+    @classmethod
+    def from_rules(cls, rules):
+        valid_rules, alternatives, groups = {}, [], {}
+        for rule_id, rule_regex in rules.items():
+            group = f"rule{len(groups)}"
+            alternative = f"(?P<{group}>{rule_regex})"
             try:
-                self.store.delete("F2B_ACTIVE_BANS")
-                self.store.delete("F2B_PERM_BANS")
-            except Exception:
-                logger.exception("Error clearing store keys F2B_ACTIVE_BANS and F2B_PERM_BANS")
+                compiled = re.compile(alternative)
+            except re.error:
+                logger.warning("Skipping invalid rule id %(rule_id)s", {"rule_id": rule_id})
+                continue
+
+            if compiled.groups < 2:
+                logger.warning("Skipping rule id %(rule_id)s without an address group", {"rule_id": rule_id})
+                continue
+
+            valid_rules[rule_id] = rule_regex
+            alternatives.append(alternative)
+            groups[group] = rule_id
+
+        pattern = re.compile("|".join(alternatives)) if alternatives else None
+        return cls(valid_rules, pattern, groups)
+
+    def match(self, message):
+        """Return the rule id and the address matched by the message, if any."""
+        if self.pattern and (result := self.pattern.search(message)):
+            return self.groups[result.lastgroup], result.group(result.lastindex + 1)
+
+        return None
+
+
+@define
+class RulesetMonitor:
+    """Wake up reconcilers when `nft monitor` reports changes to the tables they check.
+
+    Polling remains as a safety net, at the fast delay while the monitor
+    is not running and at the slow delay while it is. Listeners are
+    awaited with the changed chains before the reconcilers wake up.
+    """
+
+    tables = field(default=("filter", "nat"))
+    ignore_chains = field(factory=set)
+    command = field(default=("nft", "-j", "monitor", "ruleset"))
+    debounce = field(default=0.5)
+    events = field(factory=list)
+    listeners = field(factory=list)
+    running = field(default=False)
+
+    def subscribe(self):
+        event = asyncio.Event()
+        self.events.append(event)
+        return event
+
+    def is_relevant(self, line):
+        """Whether a monitor line changes a table, chain or rule checked by the reconcilers."""
+        return bool(self.changed_chains(line))
+
+    def changed_chains(self, line):
+        """Return the family, table and chain changed by a monitor line, the chain is None for a table."""
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return set()
+
+        chains = set()
+        for change in message.values():
+            if not isinstance(change, dict):
+                continue
+            for kind in ("table", "chain", "rule"):
+                if (obj := change.get(kind)) is None:
+                    continue
+                table = obj.get("name") if kind == "table" else obj.get("table")
+                chain = obj.get("name") if kind == "chain" else obj.get("chain")
+                if (
+                    obj.get("family") in ("ip", "ip6")
+                    and table in self.tables
+                    and chain not in self.ignore_chains
+                ):
+                    chains.add((obj["family"], table, chain))
+
+        return chains
+
+    async def run(self):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *self.command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except OSError:
+            logger.warning("Failed to run nft monitor, polling instead")
+            return
+
+        self.running = True
+        try:
+            while line := await process.stdout.readline():
+                if chains := self.changed_chains(line):
+                    for listener in self.listeners:
+                        await listener(chains)
+                    for event in self.events:
+                        event.set()
+        finally:
+            self.running = False
+            if process.returncode is None:
+                with suppress(ProcessLookupError):
+                    process.kill()
+            await process.wait()
+
+        logger.warning("nft monitor exited with %(code)s, polling instead", {"code": process.returncode})
+
+    async def wait(self, event, delay, safety_delay):
+        """Wait for a relevant change, or for the polling delay.
+
+        :return: Whether a change was reported, otherwise changes may
+            have gone unnoticed.
+        """
+        changed = False
+        with suppress(TimeoutError):
+            await asyncio.wait_for(event.wait(), safety_delay if self.running else delay)
+            await asyncio.sleep(self.debounce)
+            changed = True
+
+        event.clear()
+        return changed
+
+
+@define
+class F2BStream:
+    """Read fail2ban messages from a Redis stream through a consumer group.
+
+    Entries stay pending until acknowledged, so messages written while the
+    service is down or busy are read again on the next start. Entries left
+    pending for longer than the claim interval, by a failed batch or by a
+    consumer that went away, are claimed and read again.
+    """
+
+    client = field()
+    name = field(default="F2B_STREAM")
+    group = field(default="netfilter")
+    consumer = field(factory=socket.gethostname)
+    count = field(default=100)
+    maxlen = field(default=100000)
+    claim_interval = field(default=60)
+    pending = field(default=True, init=False)
+    claim_id = field(default="0-0", init=False)
+    next_claim = field(default=Factory(lambda self: time.monotonic() + self.claim_interval, takes_self=True), init=False)
+
+    @classmethod
+    def from_env(cls, env=os.environ, client=None):
+        if client is None:
+            client = RedisQueue.from_env(env).client
+        count = int(env.get("NETFILTER_STREAM_COUNT", "100"))
+        maxlen = int(env.get("NETFILTER_STREAM_MAXLEN", "100000"))
+        return cls(client, count=count, maxlen=maxlen)
+
+    async def subscribe(self):
+        """Create the consumer group, unless it already exists.
+
+        A new group starts at the end of the stream, so that entries
+        written before the stream was read are not taken as new attempts.
+        """
+        try:
+            await self.client.xgroup_create(self.name, self.group, id="$", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+        self.pending = True
+
+    async def receive(self, timeout=0):
+        """Read a batch of (id, message) entries, pending entries first.
+
+        Stale pending entries are claimed every claim interval. Returns an
+        empty list when nothing arrives within the timeout.
+        """
+        if self.pending:
+            response = await self.client.xreadgroup(self.group, self.consumer, {self.name: "0"}, count=self.count)
+        elif self.claim_id != "0-0" or time.monotonic() >= self.next_claim:
+            response = [[self.name, await self.claim()]]
+        else:
+            block = int(timeout * 1000) or None
+            response = await self.client.xreadgroup(
+                self.group, self.consumer, {self.name: ">"}, count=self.count, block=block,
+            )
+
+        entries = response[0][1] if response else []
+        if self.pending and not entries:
+            self.pending = False
+        elif entries:
+            ingest_lag_seconds.set(time.time() - int(entries[-1][0].split("-")[0]) / 1000)
+
+        return [(entry_id, (fields or {}).get("message", "")) for entry_id, fields in entries]
+
+    async def claim(self):
+        """Claim a batch of the entries pending for longer than the claim interval, from any consumer."""
+        response = await self.client.xautoclaim(
+            self.name,
+            self.group,
+            self.consumer,
+            int(self.claim_interval * 1000),
+            self.claim_id,
+            count=self.count,
+        )
+        self.claim_id, entries = response[0], response[1]
+        if self.claim_id == "0-0":
+            self.next_claim = time.monotonic() + self.claim_interval
+
+        return entries
+
+    async def ack(self, entry_ids):
+        """Acknowledge entries in bulk and keep the stream capped."""
+        if entry_ids:
+            await self.client.xack(self.name, self.group, *entry_ids)
+            await self.client.xtrim(self.name, maxlen=self.maxlen, approximate=True)
+
+    async def publish(self, message):
+        await self.client.xadd(self.name, {"message": message}, maxlen=self.maxlen, approximate=True)
 
 
 @define
@@ -837,96 +2584,291 @@ class NetfilterService:
     stop_event = field(factory=asyncio.Event)
     exit_code = field(default=0)
     clear_before_exit = field(default=False)
+    matcher = field(factory=lambda: F2BMatcher.from_rules(F2B_REGEX))
+    stream = field(default=None)
+    monitor = field(factory=RulesetMonitor)
+    warm_start = field(default=False)
+    queue_size = field(default=10000)
+    queue_policy = field(default="block")
+    sample_rate = field(default=10)
+    coalesce_window = field(default=0.05)
+    messages = field(default=Factory(lambda self: asyncio.Queue(self.queue_size), takes_self=True), init=False)
+    hits = field(factory=asyncio.Queue)
+    overflow = field(default=0)
 
     @classmethod
     def from_env(cls, netfilter: Netfilter, env=os.environ):
         queue = RedisQueue.from_env(env)
-        return cls(netfilter, queue)
-
-    @property
-    def f2bregex(self):
-        return {
-            1: "mail UI: Invalid password for .+ by ([0-9a-f\\.:]+)",
-            2: "Rspamd UI: Invalid password by ([0-9a-f\\.:]+)",
-            3: (
-                "warning: .*\\[([0-9a-f\\.:]+)\\]: SASL .+ authentication failed: (?!.*Connection lost to"
-                " authentication server).+"
-            ),
-            4: "warning: non-SMTP command from .*\\[([0-9a-f\\.:]+)]:.+",
-            5: "NOQUEUE: reject: RCPT from \\[([0-9a-f\\.:]+)].+Protocol error.+",
-            6: "-login: Disconnected.+ \\(auth failed, .+\\): user=.*, method=.+, rip=([0-9a-f\\.:]+),",
-            7: "-login: Aborted login.+ \\(auth failed .+\\): user=.+, rip=([0-9a-f\\.:]+), lip.+",
-            8: "-login: Aborted login.+ \\(tried to use disallowed .+\\): user=.+, rip=([0-9a-f\\.:]+), lip.+",
-            9: "SOGo.+ Login from '([0-9a-f\\.:]+)' for user .+ might not have worked",
-            10: '([0-9a-f\\.:]+) "GET \\/SOGo\\/.* HTTP.+" 403 .+',
-        }
+        stream = F2BStream.from_env(env) if env.get("NETFILTER_INGEST") == "stream" else None
+        monitor = RulesetMonitor(
+            ignore_chains={env.get("NETFILTER_CHAIN_NAME", "MAIL")},
+            listeners=[netfilter.forget_rules],
+        )
+        warm_start = env.get("NETFILTER_WARM_START", "n") == "y"
+        queue_policy = env.get("NETFILTER_QUEUE_POLICY", "block")
+        if queue_policy not in ("block", "drop", "sample"):
+            raise ValueError(f"Unknown netfilter queue policy: {queue_policy}")
+
+        return cls(
+            netfilter,
+            queue,
+            stream=stream,
+            monitor=monitor,
+            warm_start=warm_start,
+            queue_size=int(env.get("NETFILTER_QUEUE_SIZE", "10000")),
+            queue_policy=queue_policy,
+        )
 
     async def watch(self):
+        """Pass the messages of the channel, or of the stream, through the matcher and the ban applier."""
+        workers = [
+            asyncio.create_task(self.match_messages()),
+            asyncio.create_task(self.apply_hits()),
+        ]
+        try:
+            if self.stream:
+                await self.watch_stream()
+            else:
+                await self.watch_channel()
+
+            await self.messages.join()
+            await self.hits.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def watch_channel(self):
         logger.info("Watching Redis channel F2B_CHANNEL")
         await self.queue.subscribe("F2B_CHANNEL")
 
         while not self.stop_event.is_set():
             try:
-                while True:
-                    if message := await self.queue.receive(timeout=60):
-                        for rule_id, rule_regex in self.f2bregex.items():
-                            if result := re.search(rule_regex, message):
-                                addr = result.group(1)
-                                if get_ip(addr):
-                                    logger.warning(
-                                        "%(addr)s matched rule id %(rule_id)s (%(data)s)",
-                                        {
-                                            "addr": addr,
-                                            "rule_id": rule_id,
-                                            "data": message,
-                                        },
-                                    )
-                                    await self.netfilter.ban(addr)
-                                    break
-
-                    if self.stop_event.is_set():
-                        break
+                if message := await self.queue.receive(timeout=60):
+                    await self.enqueue(message)
             except Exception:
                 logger.exception("Watch error")
                 self.stop_event.set()
                 self.exit_code = 2
 
-    async def chain_order(self):
+    async def enqueue(self, message):
+        """Queue a message for the matcher, applying the queue policy when it is full.
+
+        The block policy waits for room, so the channel or the stream
+        buffers the messages instead. The drop policy drops the new message,
+        and the sample policy keeps one in sample_rate of the overflowing
+        messages in place of the oldest queued one.
+        """
+        if self.queue_policy == "block":
+            await self.messages.put(message)
+        elif not self.messages.full():
+            self.messages.put_nowait(message)
+        else:
+            self.overflow += 1
+            if self.queue_policy == "sample" and self.overflow % self.sample_rate == 0:
+                self.messages.get_nowait()
+                self.messages.task_done()
+                self.messages.put_nowait(message)
+            dropped_messages.inc()
+
+        ingest_queue_depth.set(self.messages.qsize())
+
+    async def watch_stream(self):
+        """Queue batches of stream entries, acknowledging each batch once its bans are done.
+
+        A failed ban stops the service, so its batch stays pending.
+        """
+        logger.info("Reading Redis stream %(name)s", {"name": self.stream.name})
+        await self.stream.subscribe()
+
+        while not self.stop_event.is_set():
+            try:
+                entries = await self.stream.receive(timeout=60)
+                for _, message in entries:
+                    await self.enqueue(message)
+
+                await self.messages.join()
+                await self.hits.join()
+                if entries and not self.exit_code:
+                    await self.stream.ack([entry_id for entry_id, _ in entries])
+            except Exception:
+                logger.exception("Watch error")
+                self.stop_event.set()
+                self.exit_code = 2
+
+    async def match_messages(self):
+        """Match the queued messages, passing the matched addresses to the ban applier."""
+        while True:
+            message = await self.messages.get()
+            try:
+                if addr := self.match(message):
+                    self.hits.put_nowait(addr)
+            except Exception:
+                logger.exception("Match error")
+            finally:
+                self.messages.task_done()
+                ingest_queue_depth.set(self.messages.qsize())
+
+    async def apply_hits(self):
+        """Ban from the matched addresses, counting the hits within the coalesce window at once per network."""
+        while True:
+            hits = [await self.hits.get()]
+            await asyncio.sleep(self.coalesce_window)
+            while not self.hits.empty():
+                hits.append(self.hits.get_nowait())
+
+            try:
+                await self.netfilter.ban_all(hits)
+            except Exception:
+                logger.exception("Ban error")
+                self.stop_event.set()
+                self.exit_code = 2
+            finally:
+                for _ in hits:
+                    self.hits.task_done()
+
+    def match(self, message):
+        """Return the address of a message matching a rule, or None."""
+        consumed_messages.inc()
+        with match_seconds.time():
+            match = self.matcher.match(message)
+        if not match:
+            return None
+
+        rule_id, addr = match
+        rule_matches.labels(rule_id).inc()
+        if not get_ip(addr):
+            return None
+
+        logger.warning(
+            "%(addr)s matched rule id %(rule_id)s (%(data)s)",
+            {
+                "addr": addr,
+                "rule_id": rule_id,
+                "data": message,
+            },
+        )
+        return addr
+
+    async def cluster(self):
+        """Apply the decisions published by the nodes of the cluster."""
+        cluster = self.netfilter.cluster
+        logger.info("Following Redis stream %(name)s", {"name": cluster.name})
+        await self.netfilter.reconcile()
+
+        while not self.stop_event.is_set():
+            try:
+                decisions = await cluster.receive(timeout=60)
+                async with self.netfilter.batch():
+                    for decision in decisions:
+                        await self.netfilter.apply(decision)
+            except Exception:
+                logger.exception("Cluster error")
+                self.stop_event.set()
+                self.exit_code = 2
+
+    async def chain_order(self, delay=10, safety_delay=300):
+        changed = self.monitor.subscribe()
         while not self.stop_event.is_set():
-            await asyncio.sleep(10)
+            polled = not await self.monitor.wait(changed, delay, safety_delay)
             try:
+                if polled:
+                    await self.netfilter.forget_base_rules()
                 await self.netfilter.chain_order()
             except NetfilterError:
                 self.stop_event.set()
                 self.exit_code = 2
+            except Exception:
+                logger.exception("Chain order error")
 
-    async def snat4(self, snat_target, delay=10):
+    async def snat4(self, snat_target, delay=10, safety_delay=300):
+        changed = self.monitor.subscribe()
         while not self.stop_event.is_set():
-            await asyncio.sleep(delay)
-            async with self.netfilter.lock:
-                self.netfilter.ipv4_tables.snat(snat_target, os.getenv("IPV4_NETWORK", "172.22.1") + ".0/24")
+            polled = not await self.monitor.wait(changed, delay, safety_delay)
+            try:
+                if polled:
+                    await self.netfilter.ipv4_tables.forget_base_rules()
+                await self.netfilter.ipv4_tables.snat(snat_target, os.getenv("IPV4_NETWORK", "172.22.1") + ".0/24")
+            except Exception:
+                logger.exception("SNAT error")
+
+    async def snat6(self, snat_target, delay=10, safety_delay=300):
+        changed = self.monitor.subscribe()
+        while not self.stop_event.is_set():
+            polled = not await self.monitor.wait(changed, delay, safety_delay)
+            try:
+                if polled:
+                    await self.netfilter.ipv6_tables.forget_base_rules()
+                await self.netfilter.ipv6_tables.snat(snat_target, os.getenv("IPV6_NETWORK", "fd4d:6169:6c63:6f77::/64"))
+            except Exception:
+                logger.exception("SNAT error")
+
+    async def autopurge(self, delay=60):
+        while not self.stop_event.is_set():
+            await self.netfilter.scheduler.wait(delay)
+            try:
+                await self.netfilter.autopurge()
+            except Exception:
+                logger.exception("Autopurge error")
+
+    async def unban(self, delay=10.0):
+        """Unban the networks queued in F2B_QUEUE_UNBAN.
+
+        Writers of the hash don't notify on a channel, so it is polled.
+        """
+        while not self.stop_event.is_set():
+            start_time = time.time()
+            try:
+                await self.netfilter.unban_queued()
+            except Exception:
+                logger.exception("Unban error")
+            await asyncio.sleep(delay - ((time.time() - start_time) % delay))
+
+    async def update_f2bregex(self):
+        rules = {**F2B_REGEX, **await self.netfilter.store.hgetall("F2B_REGEX")}
+        if rules != self.matcher.rules:
+            self.matcher = F2BMatcher.from_rules(rules)
+            logger.info(
+                "Fail2ban rules were changed, there are %(num)s rules",
+                {
+                    "num": len(self.matcher.rules),
+                },
+            )
 
-    async def snat6(self, snat_target, delay=10):
+    async def f2bregex(self, delay=60.0):
         while not self.stop_event.is_set():
-            await asyncio.sleep(delay)
-            async with self.netfilter.lock:
-                self.netfilter.ipv6_tables.snat(snat_target, os.getenv("IPV6_NETWORK", "fd4d:6169:6c63:6f77::/64"))
+            start_time = time.time()
+            try:
+                await self.update_f2bregex()
+            except Exception:
+                logger.exception("Fail2ban rules update error")
+            await asyncio.sleep(delay - ((time.time() - start_time) % delay))
 
-    async def autopurge(self, delay=10):
+    async def options(self, delay=10.0):
         while not self.stop_event.is_set():
-            await asyncio.sleep(delay)
-            await self.netfilter.autopurge()
+            start_time = time.time()
+            try:
+                await self.netfilter.update_options()
+            except Exception:
+                logger.exception("Options update error")
+            await asyncio.sleep(delay - ((time.time() - start_time) % delay))
 
     async def whitelist(self, delay=60.0):
         while not self.stop_event.is_set():
             start_time = time.time()
-            await self.netfilter.update_whitelist()
+            try:
+                await self.netfilter.update_whitelist()
+            except Exception:
+                logger.exception("Whitelist update error")
             await asyncio.sleep(delay - ((time.time() - start_time) % delay))
 
     async def blacklist(self, delay=60.0):
         while not self.stop_event.is_set():
             start_time = time.time()
-            await self.netfilter.update_blacklist()
+            try:
+                await self.netfilter.update_blacklist()
+            except Exception:
+                logger.exception("Blacklist update error")
             await asyncio.sleep(delay - ((time.time() - start_time) % delay))
 
     def handle_sigterm(self):
@@ -934,7 +2876,10 @@ def handle_sigterm(self):
         self.stop_event.set()
 
     async def before_exit(self):
-        if self.clear_before_exit:
+        if self.clear_before_exit and self.warm_start:
+            # Keep the kernel bans in place until the next start reconciles them.
+            await self.netfilter.snapshot()
+        elif self.clear_before_exit:
             await self.netfilter.clear()
         await self.queue.unsubscribe("F2B_CHANNEL")
 
@@ -957,26 +2902,41 @@ async def _main(argv=None):  # pragma: no cover
 
     setup_logger(args.log_level, args.log_file)
 
-    netfilter = Netfilter.from_env()
-    await netfilter.clear()
+    if metrics_port := int(os.getenv("NETFILTER_METRICS_PORT", "9177")):
+        # The service runs on the host network, listen on the bridge gateway only.
+        metrics_addr = os.getenv("NETFILTER_METRICS_ADDR") or os.getenv("IPV4_NETWORK", "172.22.1") + ".1"
+        start_http_server(metrics_port, metrics_addr, registry=registry)
 
+    netfilter = Netfilter.from_env()
+    netfilter.options = await F2BOptions.from_store(netfilter.store)
     service = NetfilterService.from_env(netfilter)
+    if not (service.warm_start and await netfilter.restore()):
+        await netfilter.clear()
 
     loop = asyncio.get_running_loop()
     loop.add_signal_handler(signal.SIGTERM, service.handle_sigterm)
 
-    netfilter.ipv4_tables.insert_mail_chains()
-    netfilter.ipv6_tables.insert_mail_chains()
-    netfilter.ipv4_tables.create_isolation_rule("br-taramail", [6379])
+    await netfilter.ipv4_tables.insert_mail_chains()
+    await netfilter.ipv6_tables.insert_mail_chains()
+    if service.warm_start:
+        await netfilter.sync_bans()
+    await netfilter.ipv4_tables.create_isolation_rule("br-taramail", [6379])
 
     tasks = [
+        asyncio.create_task(service.monitor.run()),
         asyncio.create_task(service.watch()),
         asyncio.create_task(service.autopurge()),
+        asyncio.create_task(service.unban()),
         asyncio.create_task(service.chain_order()),
         asyncio.create_task(service.blacklist()),
         asyncio.create_task(service.whitelist()),
+        asyncio.create_task(service.f2bregex()),
+        asyncio.create_task(service.options()),
     ]
 
+    if netfilter.cluster:
+        tasks.append(asyncio.create_task(service.cluster()))
+
     if snat4_ip := os.getenv("SNAT_TO_SOURCE"):
         snat4_ipo = ipaddress.ip_address(snat4_ip)
         if type(snat4_ipo) is ipaddress.IPv4Address:
@@ -61,10 +61,13 @@ def get_policy(self) -> PasswordPolicy:
             return self.default.model_copy()
 
     def update_policy(self, policy_update: PasswordPolicyUpdate) -> PasswordPolicy:
-        for policy in PasswordPolicy.model_fields:
-            value = getattr(policy_update, policy)
-            if value is not None:
-                self.store.hset("PASSWORD_POLICY", policy, value)
+        mapping = {
+            policy: value
+            for policy in PasswordPolicy.model_fields
+            if (value := getattr(policy_update, policy)) is not None
+        }
+        if mapping:
+            self.store.hset("PASSWORD_POLICY", mapping=mapping)
 
         return self.get_policy()
 
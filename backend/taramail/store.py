@@ -1,37 +1,83 @@
 """Key/value store abstraction layer."""
 
+import asyncio
+import heapq
 import json
+import logging
 import os
+import re
+import struct
+import threading
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from contextlib import suppress
 from functools import wraps
-from time import time
+from hashlib import blake2b
+from secrets import token_hex
+from time import sleep, time
 from typing import Any
 
 from attrs import define, field
+from prometheus_client import Counter, Gauge, Histogram
 from pymemcache.client.hash import HashClient
-from redis import StrictRedis
-from redis.exceptions import ResponseError
+from pymemcache.exceptions import MemcacheClientError
+from redis import BlockingConnectionPool, StrictRedis
+from redis.asyncio import BlockingConnectionPool as AsyncBlockingConnectionPool
+from redis.asyncio import StrictRedis as AsyncStrictRedis
+from redis.exceptions import RedisError, ResponseError
 from yarl import URL
 
 from taramail.registry import registry_load
 
+logger = logging.getLogger(__name__)
+
+redis_pool_wait_seconds = Histogram(
+    "redis_pool_wait_seconds",
+    "Time waiting to check out a connection from a Redis pool",
+    ["pool"],
+)
+store_operation_seconds = Histogram(
+    "store_operation_seconds",
+    "Time spent in store operations, counting every call",
+    ["backend", "method", "prefix"],
+)
+store_errors = Counter(
+    "store_errors",
+    "Number of store operations raising an error",
+    ["backend", "method", "prefix"],
+)
+redis_pool_connections_in_use = Gauge(
+    "redis_pool_connections_in_use",
+    "Number of connections checked out from a Redis pool",
+    ["pool"],
+)
+
 
 @define
 class Store(ABC):
 
     @classmethod
-    def from_url(cls, url: URL | str, registry=None) -> "Store":
+    def from_url(cls, url: URL | str, registry=None, env=os.environ) -> "Store":
+        """Make a store from a URL, instrumented with ?metrics=y or when STORE_METRICS is y."""
         if registry is None:
             registry = registry_load("taramail_store")
-        scheme = URL(url).scheme
-        storage_cls = registry["taramail_store"][scheme]
-        return storage_cls.from_url(url)
+        url = URL(url)
+        storage_cls = registry["taramail_store"][url.scheme]
+        store = storage_cls.from_url(url.without_query_params("metrics"))
+        return instrument_store(store, url.scheme, url.query.get("metrics"), env)
+
+    def batch(self) -> "StoreBatch":
+        """Queue calls to run at once, in a single round trip when the store supports it."""
+        return StoreBatch(self)
 
     @abstractmethod
     def get(self, key: str) -> str:
         """Get the value of key."""
 
+    @abstractmethod
+    def mget(self, *keys: str) -> list[str | None]:
+        """Get the values of keys, None for missing keys or keys not holding a string."""
+
     @abstractmethod
     def set(self, key: str, value: str, ttl: int | None = None) -> bool:
         """Set key to hold the string value."""
@@ -40,17 +86,32 @@ def set(self, key: str, value: str, ttl: int | None = None) -> bool:
     def delete(self, *keys: str) -> int:
         """Removes the specified keys."""
 
+    @abstractmethod
+    def incr(self, key: str, ttl: int | None = None, amount: int = 1) -> int:
+        """Increments the number stored at key by amount, expiring after ttl from its creation."""
+
     @abstractmethod
     def hget(self, key: str, field: str) -> str | None:
         """Returns the value associated with field in the hash stored at key."""
 
+    @abstractmethod
+    def hmget(self, key: str, *fields: str) -> list[str | None]:
+        """Returns the values associated with fields in the hash stored at key."""
+
     @abstractmethod
     def hgetall(self, key: str) -> dict[str, Any]:
         """Returns all fields and values of the hash stored at key."""
 
     @abstractmethod
-    def hset(self, key: str, field: str, value: str, ttl: int | None = None) -> int:
-        """Sets the specified field to a value in the hash stored at key."""
+    def hset(
+        self,
+        key: str,
+        field: str | None = None,
+        value: str | None = None,
+        ttl: int | None = None,
+        mapping: dict[str, str] | None = None,
+    ) -> int:
+        """Sets the specified field, or the fields of mapping, to a value in the hash stored at key."""
 
     @abstractmethod
     def hdel(self, key: str, *fields) -> int:
@@ -65,33 +126,189 @@ def flushall(self) -> None:
         """Delete all the keys of all the existing databases, not just the currently selected one."""
 
 
+BATCH_COMMANDS = {
+    "delete",
+    "get",
+    "hdel",
+    "hget",
+    "hgetall",
+    "hkeys",
+    "hmget",
+    "hset",
+    "incr",
+    "mget",
+    "set",
+}
+
+
+def hash_fields(field=None, mapping=None):
+    """Return the fields set by a call to `Store.hset`."""
+    return ([] if field is None else [field]) + list(mapping or {})
+
+
+@define
+class StoreBatch:
+    """Store calls queued to run at once, on execute or when leaving the context."""
+
+    store: Store = field()
+    calls: list = field(factory=list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def __getattr__(self, name):
+        if name not in BATCH_COMMANDS:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self) -> list:
+        """Run the queued calls, returning their results."""
+        calls, self.calls = self.calls, []
+        return [getattr(self.store, name)(*args, **kwargs) for name, args, kwargs in calls]
+
+
+class StoreConflictError(Exception):
+    """Raised when an update kept conflicting with concurrent updates."""
+
+
+HASH_MAGIC = b"\x00H"
+HASH_HEADER = struct.Struct(">2sBI")
+HASH_ENTRY = struct.Struct(">HI")
+HASH_SHARDED = 1
+
+# Memcached takes expiry times above 30 days as absolute Unix times.
+MEMCACHED_MAX_RELATIVE_EXPIRE = 30 * 24 * 3600
+
+
+@define
+class MemcachedHash:
+    """Hash stored in a single Memcached value.
+
+    The value is a header with the flags and the absolute expiry time,
+    0 for none, followed by the length prefixed fields and values. A
+    sharded hash holds the field names with the version of their values,
+    each value being stored in its own key.
+    """
+
+    fields: dict[str, str] = field(factory=dict)
+    expires: int = field(default=0)
+    sharded: bool = field(default=False)
+
+    @classmethod
+    def decode(cls, payload: bytes) -> "MemcachedHash":
+        """Decode a hash, also reading the legacy JSON encoding."""
+        if not payload.startswith(HASH_MAGIC):
+            try:
+                data = json.loads(payload)
+            except ValueError as e:
+                raise TypeError("Wrong type") from e
+
+            if not isinstance(data, dict):
+                raise TypeError("Wrong type")
+
+            return cls(data)
+
+        _, flags, expires = HASH_HEADER.unpack_from(payload)
+        fields = {}
+        offset = HASH_HEADER.size
+        view = memoryview(payload)
+        while offset < len(payload):
+            field_length, value_length = HASH_ENTRY.unpack_from(payload, offset)
+            offset += HASH_ENTRY.size
+            name = str(view[offset:offset + field_length], "utf-8")
+            offset += field_length
+            fields[name] = str(view[offset:offset + value_length], "utf-8")
+            offset += value_length
+
+        return cls(fields, expires, bool(flags & HASH_SHARDED))
+
+    @staticmethod
+    def is_hash(payload: bytes) -> bool:
+        """Return whether a Memcached value holds a hash."""
+        if payload.startswith(HASH_MAGIC):
+            return True
+
+        with suppress(ValueError):
+            return isinstance(json.loads(payload), dict)
+
+        return False
+
+    def encode(self) -> bytes:
+        chunks = [HASH_HEADER.pack(HASH_MAGIC, HASH_SHARDED if self.sharded else 0, self.expires)]
+        for name, value in self.fields.items():
+            name, value = name.encode("utf-8"), value.encode("utf-8")
+            chunks.extend([HASH_ENTRY.pack(len(name), len(value)), name, value])
+
+        return b"".join(chunks)
+
+    @property
+    def expire(self) -> int:
+        """Memcached expiry time of the hash."""
+        if not self.expires:
+            return 0
+
+        remaining = self.expires - int(time())
+        return max(remaining, 1) if remaining <= MEMCACHED_MAX_RELATIVE_EXPIRE else self.expires
+
+
 @define(frozen=True)
 class MemcachedStore(Store):
-    """Memcached implementation of a store."""
+    """Memcached implementation of a store.
+
+    Hashes are updated with gets and cas, so concurrent writers don't
+    lose updates. When shard_threshold is set, hashes with more fields
+    are sharded into a key per field, so that reading or writing a
+    field doesn't grow with the size of the hash.
+    """
 
     client = field()
+    shard_threshold: int | None = field(default=None)
+    cas_retries: int = field(default=10)
 
     @classmethod
-    def from_host(cls, host: str, port: int = 11211) -> "MemcachedStore":
+    def from_host(cls, host: str, port: int = 11211, **kwargs) -> "MemcachedStore":
         server = f"{host}:{port}"
-        return cls.from_server(server)
+        return cls.from_server(server, **kwargs)
 
     @classmethod
-    def from_server(cls, server: str) -> "MemcachedStore":
-        return cls.from_servers([server])
+    def from_server(cls, server: str, **kwargs) -> "MemcachedStore":
+        return cls.from_servers([server], **kwargs)
 
     @classmethod
-    def from_servers(cls, servers: list[str]) -> "MemcachedStore":
+    def from_servers(cls, servers: list[str], **kwargs) -> "MemcachedStore":
         parsed = []
         for server in servers:
             host, port = server.rsplit(":", 1)
             parsed.append((host, int(port)))
         client = HashClient(parsed, no_delay=True)
-        return cls(client)
+        return cls(client, **kwargs)
 
     @classmethod
     def from_url(cls, url: URL | str) -> "MemcachedStore":
-        return cls.from_host(url.host, url.port)
+        url = URL(url)
+        kwargs = {}
+        if "shard_threshold" in url.query:
+            kwargs["shard_threshold"] = int(url.query["shard_threshold"])
+
+        return cls.from_host(url.host, url.port, **kwargs)
+
+    @staticmethod
+    def field_key(key: str, field: str, version: str) -> str:
+        """Return the key holding a version of a field of a sharded hash."""
+        return f"{key}:{blake2b(field.encode('utf-8'), digest_size=16).hexdigest()}:{version}"
+
+    def shard_keys(self, key: str, fields: dict[str, str]) -> dict[str, str]:
+        """Return the fields of a sharded hash by the keys holding their values."""
+        return {self.field_key(key, f, version): f for f, version in fields.items()}
 
     def get(self, key: str) -> str:
         """See `Store.get`."""
@@ -99,13 +316,24 @@ def get(self, key: str) -> str:
         if value is None:
             return None
 
-        with suppress(ValueError):
-            data = json.loads(value)
-            if isinstance(data, dict):
-                raise TypeError("Wrong type")
+        if MemcachedHash.is_hash(value):
+            raise TypeError("Wrong type")
 
         return value.decode("utf-8")
 
+    def mget(self, *keys: str) -> list[str | None]:
+        """See `Store.mget`."""
+        values = self.client.get_many(keys)
+        result = []
+        for key in keys:
+            value = values.get(key)
+            if value is None or MemcachedHash.is_hash(value):
+                result.append(None)
+            else:
+                result.append(value.decode("utf-8"))
+
+        return result
+
     def set(self, key: str, value: str, ttl: int | None = None) -> bool:
         """See `Store.set`."""
         expire = 0 if ttl is None else ttl
@@ -114,82 +342,185 @@ def set(self, key: str, value: str, ttl: int | None = None) -> bool:
 
     def delete(self, *keys: str) -> int:
         """See `Store.delete`."""
-        return sum(self.client.delete(key, noreply=False) for key in keys)
+        shards = []
+        for key, payload in self.client.get_many(keys).items():
+            if payload.startswith(HASH_MAGIC) and (data := MemcachedHash.decode(payload)).sharded:
+                shards.extend(self.shard_keys(key, data.fields))
 
-    def hget(self, key: str, field: str) -> str | None:
-        """See `Store.hget`."""
-        payload = self.client.get(key)
-        if payload is None:
-            payload = "{}"
+        count = sum(self.client.delete(key, noreply=False) for key in keys)
+        if shards:
+            self.client.delete_many(shards)
 
+        return count
+
+    def incr(self, key: str, ttl: int | None = None, amount: int = 1) -> int:
+        """See `Store.incr`."""
+        expire = 0 if ttl is None else ttl
+        self.client.add(key, "0", expire=expire, noreply=False)
         try:
-            data = json.loads(payload)
-        except ValueError as e:
+            return self.client.incr(key, amount, noreply=False)
+        except MemcacheClientError as e:
             raise TypeError(str(e)) from e
 
-        return data.get(field)
-
-    def hgetall(self, key: str) -> dict[str, Any]:
-        """See `Store.hgetall`."""
+    def load_hash(self, key: str) -> MemcachedHash:
         payload = self.client.get(key)
-        if payload is None:
-            payload = "{}"
+        return MemcachedHash() if payload is None else MemcachedHash.decode(payload)
+
+    def update_hash(self, key: str, update, ttl: int | None = None):
+        """Update the hash stored at key in a gets and cas loop, returning the result of update.
+
+        The update function modifies the hash in place and returns its
+        result with the values to store in field keys, or None when the
+        hash is left unchanged. The values are stored under new versions
+        of their field keys before the hash, so that neither readers nor
+        concurrent updates see them change, and the versions the hash no
+        longer refers to are deleted once it is stored. A hash left
+        without fields is removed.
+        """
+        for _ in range(self.cas_retries):
+            payload, cas = self.client.gets(key)
+            data = MemcachedHash() if payload is None else MemcachedHash.decode(payload)
+            old_shards = self.shard_keys(key, data.fields) if data.sharded else {}
+            result, shards = update(data)
+            if shards is None:
+                return result
+
+            if ttl is not None:
+                data.expires = int(time()) + ttl
+
+            new_shards = {self.field_key(key, f, data.fields[f]): v for f, v in shards.items()}
+            if new_shards:
+                self.client.set_many(new_shards, expire=data.expire)
+
+            # A negative expiry time removes the hash, unless it changed concurrently.
+            expire = data.expire if data.fields else -1
+            if payload is None:
+                stored = self.client.add(key, data.encode(), expire=expire, noreply=False)
+            else:
+                stored = self.client.cas(key, data.encode(), cas, expire=expire, noreply=False)
+            if stored:
+                stale = old_shards.keys() - self.shard_keys(key, data.fields).keys()
+                if stale:
+                    self.client.delete_many(list(stale))
+                return result
 
-        with suppress(ValueError):
-            return json.loads(payload)
+            if new_shards:
+                self.client.delete_many(list(new_shards))
 
-        raise TypeError("Wrong type")
+        raise StoreConflictError(f"Too many concurrent updates of {key}")
 
-    def hset(self, key: str, field: str, value: str, ttl: int | None = None) -> int:  # F402
-        """See `Store.hset`."""
-        payload = self.client.get(key)
-        if payload is None:
-            payload = "{}"
+    def hget(self, key: str, field: str) -> str | None:
+        """See `Store.hget`."""
+        return self.hmget(key, field)[0]
+
+    def hmget(self, key: str, *fields: str) -> list[str | None]:
+        """See `Store.hmget`."""
+        data = self.load_hash(key)
+        if not data.sharded:
+            return [data.fields.get(f) for f in fields]
+
+        field_keys = [self.field_key(key, f, data.fields[f]) if f in data.fields else None for f in fields]
+        values = self.client.get_many([k for k in field_keys if k is not None])
+        self.drop_evicted(key, data, [f for f, k in zip(fields, field_keys, strict=True) if k is not None and k not in values])
+        return [
+            value.decode("utf-8") if (value := values.get(field_key)) is not None else None
+            for field_key in field_keys
+        ]
 
-        try:
-            data = json.loads(payload)
-        except ValueError as e:
-            raise TypeError(str(e)) from e
+    def hgetall(self, key: str) -> dict[str, Any]:
+        """See `Store.hgetall`."""
+        data = self.load_hash(key)
+        if not data.sharded:
+            return data.fields
+
+        field_keys = self.shard_keys(key, data.fields)
+        values = self.client.get_many(list(field_keys))
+        self.drop_evicted(key, data, [f for k, f in field_keys.items() if k not in values])
+        return {field_keys[k]: value.decode("utf-8") for k, value in values.items()}
+
+    def drop_evicted(self, key: str, data: MemcachedHash, fields: list[str]) -> None:
+        """Drop fields whose key was evicted from a sharded hash, unless they changed since it was read.
+
+        Their values are lost, so the hash must not list them anymore.
+        """
+        if not fields:
+            return
+
+        logger.warning("Dropping evicted fields %(fields)s of %(key)s", {"fields": sorted(fields), "key": key})
+        versions = {f: data.fields[f] for f in fields}
+
+        def update(current):
+            dropped = [f for f, version in versions.items() if current.fields.get(f) == version]
+            for f in dropped:
+                del current.fields[f]
+            return None, {} if dropped else None
+
+        self.update_hash(key, update)
+
+    def hset(
+        self,
+        key: str,
+        field: str | None = None,
+        value: str | None = None,
+        ttl: int | None = None,
+        mapping: dict[str, str] | None = None,
+    ) -> int:  # F402
+        """See `Store.hset`."""
+        values = {} if field is None else {field: str(value)}
+        values.update((f, str(v)) for f, v in (mapping or {}).items())
+
+        def update(data):
+            count = len(values.keys() - data.fields.keys())
+            if not data.sharded and (
+                not self.shard_threshold or len(data.fields) + count <= self.shard_threshold
+            ):
+                data.fields.update(values)
+                return count, {}
+
+            version = token_hex(8)
+            if data.sharded:
+                shards = values
+                data.fields.update(dict.fromkeys(values, version))
+            else:
+                # Move the values of a hash becoming sharded to their field keys.
+                shards = {**data.fields, **values}
+                data.fields = dict.fromkeys(shards, version)
+                data.sharded = True
+            return count, shards
 
-        count = 0 if field in data else 1
-        data[field] = str(value)
-        self.set(key, json.dumps(data), ttl)
-        return count
+        return self.update_hash(key, update, ttl)
 
     def hdel(self, key, *fields) -> int:
         """See `Store.hdel`."""
-        count = 0
-        data = self.hgetall(key)
-        for f in fields:
-            with suppress(KeyError):
-                del data[f]
-                count += 1
-
-        if count:
-            self.set(key, json.dumps(data))
+        def update(data):
+            deleted = sum(data.fields.pop(f, None) is not None for f in fields)
+            return deleted, {} if deleted else None
 
-        return count
+        return self.update_hash(key, update)
 
     def hkeys(self, key: str) -> list[str]:
         """See `Store.hkeys`."""
-        data = self.hgetall(key)
-        return list(data.keys())
+        return list(self.load_hash(key).fields)
 
     def flushall(self) -> None:
         """See `Store.flushall`."""
         self.client.flush_all()
 
 
-@define(frozen=True)
+@define
 class MemoryRecord:
+    """Value of a memory store key, with the expiry times of the key and of the hash fields."""
 
     data: str | dict[str, str]
     expires: float
+    field_expires: dict[str, float] = field(factory=dict)
+    size: int = field(default=0)
 
     @classmethod
     def from_ttl(cls, data, ttl=None):
         expires = float('inf') if ttl is None else time() + ttl
-        return cls(data, expires)
+        size = sum(len(f) + len(v) for f, v in data.items()) if isinstance(data, dict) else len(data)
+        return cls(data, expires, size=size)
 
     @property
     def expired(self):
@@ -199,26 +530,157 @@ def expired(self):
     def is_dict(self):
         return isinstance(self.data, dict)
 
+    def next_expires(self):
+        """Return the time when the key or one of its fields expires next."""
+        return min(self.expires, min(self.field_expires.values(), default=self.expires))
 
-@define(frozen=True)
-class MemoryStore(Store):
-    """Memory implementation of a store."""
+    def set_field(self, field, value, expires=None):
+        """Set a field of the hash, returning 1 when the field is new."""
+        old = self.data.get(field)
+        self.data[field] = value
+        if expires is None:
+            self.field_expires.pop(field, None)
+        else:
+            self.field_expires[field] = expires
+
+        if old is None:
+            self.size += len(field) + len(value)
+            return 1
+
+        self.size += len(value) - len(old)
+        return 0
+
+    def del_field(self, field):
+        """Delete a field of the hash, returning 1 when the field existed."""
+        self.field_expires.pop(field, None)
+        if (old := self.data.pop(field, None)) is None:
+            return 0
 
-    records : dict[str, MemoryRecord] = field(factory=dict)
+        self.size -= len(field) + len(old)
+        return 1
+
+    def expire_fields(self, now):
+        """Delete the expired fields of the hash."""
+        for f, expires in list(self.field_expires.items()):
+            if expires < now:
+                self.del_field(f)
+
+
+@define
+class MemoryStore(Store):
+    """Memory implementation of a store.
+
+    Keys are kept in the order of their last use, so the least recently
+    used keys are evicted above max_entries keys or about max_bytes of
+    keys and values. Expiry times are kept in a min-heap swept a few
+    entries at a time on writes, so expired keys are removed even when
+    they are not read again. Rescheduled expiries leave stale entries in
+    the heap, they are skipped when they reach the top.
+    """
+
+    records: OrderedDict[str, MemoryRecord] = field(factory=OrderedDict)
+    max_entries: int | None = field(default=None)
+    max_bytes: int | None = field(default=None)
+    sweep_size: int = field(default=20)
+    deadlines: list = field(factory=list)
+    size: int = field(default=0)
+    hits: int = field(default=0)
+    misses: int = field(default=0)
+    evictions: int = field(default=0)
+    expirations: int = field(default=0)
 
     @classmethod
     def from_url(cls, url: URL | str) -> "MemoryStore":
-        return cls()
+        url = URL(url)
+        kwargs = {}
+        for name in ("max_entries", "max_bytes"):
+            if name in url.query:
+                kwargs[name] = int(url.query[name])
 
-    def get(self, key: str) -> str:
-        """See `Store.get`."""
-        try:
-            record = self.records[key]
-        except KeyError:
+        return cls(**kwargs)
+
+    def lookup(self, key: str) -> MemoryRecord | None:
+        """Return the record of a key when it didn't expire, counting hits and misses."""
+        record = self.records.get(key)
+        if record is not None and self.expire(key, record, time()):
+            record = None
+
+        if record is None:
+            self.misses += 1
             return None
 
-        if record.expired:
-            self.delete(key)
+        self.hits += 1
+        self.records.move_to_end(key)
+        return record
+
+    def expire(self, key, record, now) -> bool:
+        """Remove the expired fields of a record or the record itself, returning whether it was removed."""
+        if record.field_expires:
+            size = record.size
+            record.expire_fields(now)
+            self.size += record.size - size
+
+        if record.expires < now or (record.is_dict and not record.data):
+            self.remove(key)
+            self.expirations += 1
+            return True
+
+        return False
+
+    def remove(self, key):
+        record = self.records.pop(key)
+        self.size -= len(key) + record.size
+
+    def store(self, key: str, record: MemoryRecord):
+        """Store a new record for a key."""
+        with suppress(KeyError):
+            self.remove(key)
+
+        self.records[key] = record
+        self.size += len(key) + record.size
+        self.schedule(key, record)
+
+    def schedule(self, key, record):
+        """Add the next expiry time of a record to the heap."""
+        expires = record.next_expires()
+        if expires != float("inf"):
+            heapq.heappush(self.deadlines, (expires, key))
+
+    def sweep(self, now=None):
+        """Remove the keys and fields at the top of the heap whose expiry passed."""
+        if now is None:
+            now = time()
+
+        # Compact the heap when stale entries outnumber the keys.
+        if len(self.deadlines) > 2 * len(self.records) + self.sweep_size:
+            self.deadlines = [(e, k) for k, r in self.records.items() if (e := r.next_expires()) != float("inf")]
+            heapq.heapify(self.deadlines)
+
+        for _ in range(self.sweep_size):
+            if not self.deadlines or self.deadlines[0][0] >= now:
+                break
+
+            expires, key = heapq.heappop(self.deadlines)
+            record = self.records.get(key)
+            if record is None or record.next_expires() != expires:
+                continue
+
+            if not self.expire(key, record, now):
+                self.schedule(key, record)
+
+    def evict(self):
+        """Remove the least recently used keys above the maximum entries or bytes."""
+        while self.records and (
+            (self.max_entries is not None and len(self.records) > self.max_entries)
+            or (self.max_bytes is not None and self.size > self.max_bytes)
+        ):
+            self.remove(next(iter(self.records)))
+            self.evictions += 1
+
+    def get(self, key: str) -> str:
+        """See `Store.get`."""
+        record = self.lookup(key)
+        if record is None:
             return None
 
         if record.is_dict:
@@ -226,10 +688,22 @@ def get(self, key: str) -> str:
 
         return record.data
 
+    def mget(self, *keys: str) -> list[str | None]:
+        """See `Store.mget`."""
+        result = []
+        for key in keys:
+            try:
+                result.append(self.get(key))
+            except TypeError:
+                result.append(None)
+
+        return result
+
     def set(self, key: str, value: str, ttl: int | None = None) -> bool:
         """See `Store.set`."""
-        record = MemoryRecord.from_ttl(str(value), ttl)
-        self.records[key] = record
+        self.sweep()
+        self.store(key, MemoryRecord.from_ttl(str(value), ttl))
+        self.evict()
         return True
 
     def delete(self, *keys: str) -> int:
@@ -237,58 +711,94 @@ def delete(self, *keys: str) -> int:
         count = 0
         for key in keys:
             with suppress(KeyError):
-                del self.records[key]
+                self.remove(key)
                 count += 1
 
         return count
 
-    def hget(self, key: str, field: str) -> str | None:
-        """See `Store.hget`."""
-        try:
-            record = self.records[key]
-        except KeyError:
-            return None
-
-        if record.expired:
-            self.delete(key)
-            return None
+    def incr(self, key: str, ttl: int | None = None, amount: int = 1) -> int:
+        """See `Store.incr`."""
+        self.sweep()
+        record = self.records.get(key)
+        if record is None or self.expire(key, record, time()):
+            record = MemoryRecord.from_ttl("0", ttl)
 
-        if not record.is_dict:
+        if record.is_dict or not record.data.lstrip("-").isdigit():
             raise TypeError("Wrong type")
 
-        return record.data.get(field)
+        value = str(int(record.data) + amount)
+        self.store(key, MemoryRecord(value, record.expires, size=len(value)))
+        self.evict()
+        return int(value)
+
+    def hget(self, key: str, field: str) -> str | None:
+        """See `Store.hget`."""
+        return self.hmget(key, field)[0]
+
+    def hmget(self, key: str, *fields: str) -> list[str | None]:
+        """See `Store.hmget`."""
+        data = self.hgetall(key)
+        return [data.get(f) for f in fields]
 
     def hgetall(self, key: str) -> dict[str, Any]:
         """See `Store.hgetall`."""
-        try:
-            record = self.records[key]
-        except KeyError:
-            return {}
-
-        if record.expired:
-            self.delete(key)
+        record = self.lookup(key)
+        if record is None:
             return {}
 
         if not record.is_dict:
             raise TypeError("Wrong type")
 
-        return record.data
+        return dict(record.data)
+
+    def hset(
+        self,
+        key: str,
+        field: str | None = None,
+        value: str | None = None,
+        ttl: int | None = None,
+        mapping: dict[str, str] | None = None,
+    ) -> int:  # F402
+        """See `Store.hset`.
+
+        Like Redis, the expiration applies to the set fields, and setting
+        a field without expiration clears its expiration.
+        """
+        self.sweep()
+        now = time()
+        record = self.records.get(key)
+        if record is None or self.expire(key, record, now):
+            record = MemoryRecord.from_ttl({})
+            self.store(key, record)
 
-    def hset(self, key: str, field: str, value: str, ttl: int | None = None) -> int:  # F402
-        """See `Store.hset`."""
-        record = self.records.setdefault(key, MemoryRecord.from_ttl({}, ttl))
-        count = 0 if field in record.data else 1
-        record.data[field] = str(value)
+        if not record.is_dict:
+            raise TypeError("Wrong type")
+
+        values = {} if field is None else {field: value}
+        values.update(mapping or {})
+        expires = None if ttl is None else now + ttl
+        size = record.size
+        count = sum(record.set_field(f, str(v), expires) for f, v in values.items())
+        self.size += record.size - size
+        self.records.move_to_end(key)
+        self.schedule(key, record)
+        self.evict()
         return count
 
     def hdel(self, key, *fields) -> int:
         """See `Store.hdel`."""
-        count = 0
-        data = self.hgetall(key)
-        for f in fields:
-            with suppress(KeyError):
-                del data[f]
-                count += 1
+        record = self.lookup(key)
+        if record is None:
+            return 0
+
+        if not record.is_dict:
+            raise TypeError("Wrong type")
+
+        size = record.size
+        count = sum(record.del_field(f) for f in fields)
+        self.size += record.size - size
+        if not record.data:
+            self.remove(key)
 
         return count
 
@@ -300,6 +810,76 @@ def hkeys(self, key: str) -> list[str]:
     def flushall(self) -> None:
         """See `Store.flushall`."""
         self.records.clear()
+        self.deadlines.clear()
+        self.size = 0
+
+
+def redis_address_from_env(env=os.environ):
+    """Return the host, port and password of Redis from the environment."""
+    host = env.get("REDIS_SLAVEOF_IP", "") or env.get("IPV4_NETWORK", "172.22.1") + ".249"
+    port = int(env.get("REDIS_SLAVEOF_PORT", "") or "6379")
+    password = env.get("REDIS_PASSWORD")
+    return host, port, password
+
+
+def redis_pool_kwargs_from_env(env=os.environ):
+    """Return the arguments of a Redis connection pool from the environment."""
+    host, port, password = redis_address_from_env(env)
+    return {
+        "host": host,
+        "port": port,
+        "password": password,
+        "db": 0,
+        "decode_responses": True,
+        "max_connections": int(env.get("REDIS_MAX_CONNECTIONS", "50")),
+        "timeout": float(env.get("REDIS_POOL_TIMEOUT", "5")),
+        "health_check_interval": int(env.get("REDIS_HEALTH_CHECK_INTERVAL", "30")),
+        "socket_keepalive": True,
+    }
+
+
+class RedisConnectionPool(BlockingConnectionPool):
+    """Connection pool waiting for a free connection, exporting its waits and connections in use."""
+
+    def __init__(self, name="redis", **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+
+    @classmethod
+    def from_env(cls, name="redis", env=os.environ) -> "RedisConnectionPool":
+        return cls(name, **redis_pool_kwargs_from_env(env))
+
+    def get_connection(self, *args, **kwargs):
+        with redis_pool_wait_seconds.labels(self.name).time():
+            connection = super().get_connection(*args, **kwargs)
+        redis_pool_connections_in_use.labels(self.name).inc()
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        redis_pool_connections_in_use.labels(self.name).dec()
+
+
+class AsyncRedisConnectionPool(AsyncBlockingConnectionPool):
+    """See `RedisConnectionPool`."""
+
+    def __init__(self, name="redis", **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+
+    @classmethod
+    def from_env(cls, name="redis", env=os.environ) -> "AsyncRedisConnectionPool":
+        return cls(name, **redis_pool_kwargs_from_env(env))
+
+    async def get_connection(self, *args, **kwargs):
+        with redis_pool_wait_seconds.labels(self.name).time():
+            connection = await super().get_connection(*args, **kwargs)
+        redis_pool_connections_in_use.labels(self.name).inc()
+        return connection
+
+    async def release(self, connection):
+        await super().release(connection)
+        redis_pool_connections_in_use.labels(self.name).dec()
 
 
 def wrap_response_error(func):
@@ -322,9 +902,7 @@ class RedisStore(StrictRedis, Store):
 
     @classmethod
     def from_env(cls, env=os.environ) -> "RedisStore":
-        host = env.get("REDIS_SLAVEOF_IP", "") or env.get("IPV4_NETWORK", "172.22.1") + ".249"
-        port = int(env.get("REDIS_SLAVEOF_PORT", "") or "6379")
-        password = env.get("REDIS_PASSWORD")
+        host, port, password = redis_address_from_env(env)
         return cls.from_host(host, port, password=password)
 
     @classmethod
@@ -337,22 +915,705 @@ def from_host(cls, host: str, port: int = 6379, password: str | None = None) ->
             password=password,
         )
 
+    @classmethod
+    def from_pool(cls, pool: RedisConnectionPool) -> "RedisStore":
+        """Make a store sharing the connections of the pool."""
+        return cls(connection_pool=pool)
+
     @classmethod
     def from_url(cls, url: URL | str) -> "RedisStore":
         url = URL(url)
         return cls.from_host(url.host, url.port, password=url.password)
 
-    def hset(self, key: str, field: str, value: str, ttl: int | None = None) -> int:  # F402
+    def batch(self) -> "RedisStoreBatch":
+        """See `Store.batch`."""
+        return RedisStoreBatch(self)
+
+    def incr(self, key: str, ttl: int | None = None, amount: int = 1) -> int:
+        """See `Store.incr`."""
+        with self.pipeline() as pipe:
+            if ttl is not None:
+                pipe.set(key, 0, ex=ttl, nx=True)
+            pipe.incr(key, amount)
+            try:
+                return pipe.execute()[-1]
+            except ResponseError as e:
+                raise TypeError(str(e)) from e
+
+    def hset(
+        self,
+        key: str,
+        field: str | None = None,
+        value: str | None = None,
+        ttl: int | None = None,
+        mapping: dict[str, str] | None = None,
+    ) -> int:  # F402
         """See `Store.hset`."""
-        ret = self._hset(key, field, value)
+        ret = self._hset(key, field, value, mapping=mapping)
         if ttl is not None:
-            self._hexpire(key, ttl, field)
+            self._hexpire(key, ttl, *hash_fields(field, mapping))
 
         return ret
 
+    def mget(self, *keys: str) -> list[str | None]:
+        """See `Store.mget`."""
+        return StrictRedis.mget(self, keys)
+
     get = wrap_response_error(StrictRedis.get)
     hget = wrap_response_error(StrictRedis.hget)
+    hmget = wrap_response_error(StrictRedis.hmget)
     hgetall = wrap_response_error(StrictRedis.hgetall)
     hkeys = wrap_response_error(StrictRedis.hkeys)
     _hset = wrap_response_error(StrictRedis.hset)
     _hexpire = wrap_response_error(StrictRedis.hexpire)
+
+
+@define
+class RedisStoreBatch(StoreBatch):
+    """Store calls queued in a Redis transaction, run in a single round trip."""
+
+    def execute(self) -> list:
+        """See `StoreBatch.execute`."""
+        calls, self.calls = self.calls, []
+        pipe = self.store.pipeline()
+        spans = []
+        for name, args, kwargs in calls:
+            start = len(pipe)
+            self.queue_command(pipe, name, *args, **kwargs)
+            spans.append((name, start, len(pipe)))
+
+        results = pipe.execute(raise_on_error=False)
+        for result in results:
+            if isinstance(result, ResponseError):
+                if "WRONGTYPE" in str(result):
+                    raise TypeError(str(result)) from result
+                raise result
+
+        # Store calls queue more than one command, incr returns the last result.
+        return [results[end - 1] if name == "incr" else results[start] for name, start, end in spans]
+
+    def queue_command(self, pipe, name, *args, **kwargs):
+        if name == "hset":
+            self.queue_hset(pipe, *args, **kwargs)
+        elif name == "incr":
+            self.queue_incr(pipe, *args, **kwargs)
+        elif name == "mget":
+            pipe.mget(args)
+        else:
+            getattr(pipe, name)(*args, **kwargs)
+
+    def queue_hset(self, pipe, key, field=None, value=None, ttl=None, mapping=None):
+        pipe.hset(key, field, value, mapping=mapping)
+        if ttl is not None:
+            pipe.hexpire(key, ttl, *hash_fields(field, mapping))
+
+    def queue_incr(self, pipe, key, ttl=None, amount=1):
+        if ttl is not None:
+            pipe.set(key, 0, ex=ttl, nx=True)
+        pipe.incr(key, amount)
+
+
+NEAR_CACHE_KEYS = ("DKIM_SELECTORS", "DOMAIN_MAP", "PASSWORD_POLICY")
+
+
+@define
+class CachedStore(Store):
+    """Store keeping hot keys in memory, in front of another store.
+
+    Only the given keys are cached, whole hashes at a time, for at most
+    ttl seconds and up to max_size keys, evicting the least recently
+    read. Writes go through to the other store. In front of Redis, keys
+    changed by any client are also invalidated as soon as Redis
+    broadcasts it with client side caching.
+    """
+
+    store: Store = field()
+    keys: frozenset[str] = field(default=frozenset(NEAR_CACHE_KEYS), converter=frozenset)
+    max_size: int = field(default=1000)
+    ttl: float = field(default=5.0)
+    entries: OrderedDict = field(factory=OrderedDict, init=False)
+    version: int = field(default=0, init=False)
+    lock: threading.Lock = field(factory=threading.Lock, init=False)
+
+    @classmethod
+    def from_url(cls, url: URL | str) -> "CachedStore":
+        """Make a cached store from a URL like cached+redis://host:port?ttl=5&max_size=1000&keys=A,B."""
+        url = URL(url)
+        # The cache needs the store itself, to track the changes of the keys.
+        store = Store.from_url(url.with_scheme(url.scheme.removeprefix("cached+")).update_query(metrics="n"))
+        query = url.query
+        keys = query["keys"].split(",") if "keys" in query else NEAR_CACHE_KEYS
+        max_size = int(query.get("max_size", "1000"))
+        ttl = float(query.get("ttl", "5"))
+        return cls(store, keys, max_size, ttl).start()
+
+    def start(self) -> "CachedStore":
+        """Start tracking the changes of the cached keys, when the store supports it."""
+        if isinstance(self.store, RedisStore):
+            threading.Thread(target=self.track, name="store-tracking", daemon=True).start()
+
+        return self
+
+    def track(self):
+        """Invalidate the keys changed in Redis, listening again after errors."""
+        while True:
+            try:
+                self.listen()
+            except RedisError:
+                logger.warning("Lost Redis invalidations, falling back to expiring cached keys", exc_info=True)
+
+            self.clear()
+            sleep(self.ttl)
+
+    def listen(self):
+        """Listen to the invalidations broadcast by Redis for the cached keys.
+
+        A tracking connection redirects the invalidations to a listening
+        connection subscribed to them, and is pinged whenever the listening
+        connection is idle so that a broken tracking connection is noticed.
+        """
+        pool = self.store.connection_pool
+        listener = pool.connection_class(**pool.connection_kwargs)
+        tracker = pool.connection_class(**pool.connection_kwargs)
+        try:
+            listener.send_command("CLIENT", "ID", check_health=False)
+            client_id = listener.read_response()
+            listener.send_command("SUBSCRIBE", "__redis__:invalidate", check_health=False)
+            listener.read_response()
+            prefixes = [arg for key in sorted(self.keys) for arg in ("PREFIX", key)]
+            tracker.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST", *prefixes, check_health=False)
+            tracker.read_response()
+
+            # Keys cached before tracking started may have changed unnoticed.
+            self.clear()
+            while True:
+                if not listener.can_read(timeout=self.ttl):
+                    tracker.send_command("PING", check_health=False)
+                    tracker.read_response()
+                    continue
+
+                kind, _, keys = listener.read_response()
+                if kind != "message":
+                    continue
+                if keys is None:
+                    self.clear()
+                else:
+                    self.invalidate(*keys)
+        finally:
+            listener.disconnect()
+            tracker.disconnect()
+
+    def cached(self, key, kind, load):
+        """Return the value of a cached key, loading it when missing or expired."""
+        now = time()
+        with self.lock:
+            if (entry := self.entries.get((key, kind))) and entry[0] > now:
+                self.entries.move_to_end((key, kind))
+                return entry[1]
+
+            version = self.version
+
+        value = load(key)
+        with self.lock:
+            # Don't cache a value invalidated while it was loading.
+            if version == self.version:
+                self.entries[key, kind] = (now + self.ttl, value)
+                self.entries.move_to_end((key, kind))
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self, *keys: str) -> None:
+        """Forget the cached values of keys."""
+        with self.lock:
+            self.version += 1
+            for key in keys:
+                self.entries.pop((key, "string"), None)
+                self.entries.pop((key, "hash"), None)
+
+    def clear(self) -> None:
+        """Forget all the cached values."""
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+
+    def batch(self) -> "CachedStoreBatch":
+        """See `Store.batch`."""
+        return CachedStoreBatch(self)
+
+    def get(self, key: str) -> str:
+        """See `Store.get`."""
+        if key not in self.keys:
+            return self.store.get(key)
+
+        return self.cached(key, "string", self.store.get)
+
+    def mget(self, *keys: str) -> list[str | None]:
+        """See `Store.mget`."""
+        if self.keys.isdisjoint(keys):
+            return self.store.mget(*keys)
+
+        result = []
+        for key in keys:
+            try:
+                result.append(self.get(key))
+            except TypeError:
+                result.append(None)
+
+        return result
+
+    def set(self, key: str, value: str, ttl: int | None = None) -> bool:
+        """See `Store.set`."""
+        result = self.store.set(key, value, ttl)
+        self.invalidate(key)
+        return result
+
+    def delete(self, *keys: str) -> int:
+        """See `Store.delete`."""
+        result = self.store.delete(*keys)
+        self.invalidate(*keys)
+        return result
+
+    def incr(self, key: str, ttl: int | None = None, amount: int = 1) -> int:
+        """See `Store.incr`."""
+        result = self.store.incr(key, ttl, amount)
+        self.invalidate(key)
+        return result
+
+    def hget(self, key: str, field: str) -> str | None:
+        """See `Store.hget`."""
+        if key not in self.keys:
+            return self.store.hget(key, field)
+
+        return self.hgetall(key).get(field)
+
+    def hmget(self, key: str, *fields: str) -> list[str | None]:
+        """See `Store.hmget`."""
+        if key not in self.keys:
+            return self.store.hmget(key, *fields)
+
+        data = self.hgetall(key)
+        return [data.get(f) for f in fields]
+
+    def hgetall(self, key: str) -> dict[str, Any]:
+        """See `Store.hgetall`."""
+        if key not in self.keys:
+            return self.store.hgetall(key)
+
+        return dict(self.cached(key, "hash", lambda key: dict(self.store.hgetall(key))))
+
+    def hset(
+        self,
+        key: str,
+        field: str | None = None,
+        value: str | None = None,
+        ttl: int | None = None,
+        mapping: dict[str, str] | None = None,
+    ) -> int:  # F402
+        """See `Store.hset`."""
+        result = self.store.hset(key, field, value, ttl, mapping)
+        self.invalidate(key)
+        return result
+
+    def hdel(self, key: str, *fields) -> int:
+        """See `Store.hdel`."""
+        result = self.store.hdel(key, *fields)
+        self.invalidate(key)
+        return result
+
+    def hkeys(self, key: str) -> list[str]:
+        """See `Store.hkeys`."""
+        if key not in self.keys:
+            return self.store.hkeys(key)
+
+        return list(self.hgetall(key))
+
+    def flushall(self) -> None:
+        """See `Store.flushall`."""
+        self.store.flushall()
+        self.clear()
+
+
+@define
+class CachedStoreBatch(StoreBatch):
+    """Store calls queued in the batch of the store behind the cache."""
+
+    def execute(self) -> list:
+        """See `StoreBatch.execute`."""
+        calls, self.calls = self.calls, []
+        batch = self.store.store.batch()
+        batch.calls = list(calls)
+        try:
+            return batch.execute()
+        finally:
+            self.store.invalidate(*(
+                key
+                for name, args, _ in calls
+                if name in ("delete", "hdel", "hset", "incr", "set")
+                for key in (args if name == "delete" else args[:1])
+            ))
+
+
+# Keys are labelled by their name without the dynamic part after a colon,
+# other keys share a label to bound the number of series.
+KEY_PREFIX_RE = re.compile(r"[A-Z0-9_]+")
+
+
+def key_prefix(key: str) -> str:
+    """Return the label of a key in the store metrics."""
+    prefix = key.partition(":")[0]
+    return prefix if KEY_PREFIX_RE.fullmatch(prefix) else "other"
+
+
+def instrument_store(store: Store, backend: str, metrics: str | None = None, env=os.environ) -> Store:
+    """Wrap a store in an `InstrumentedStore` when metrics, or STORE_METRICS by default, is y."""
+    if metrics is None:
+        metrics = env.get("STORE_METRICS", "n")
+
+    return InstrumentedStore(store, backend) if metrics == "y" else store
+
+
+@define(frozen=True)
+class InstrumentedStore(Store):
+    """Store recording the latency and errors of the calls to another store.
+
+    The calls are labelled by backend, method and key prefix, so the
+    histogram counts also give the number of calls.
+    """
+
+    store: Store = field()
+    backend: str = field()
+
+    def call(self, method: str, key: str, func, *args, **kwargs):
+        """Call func, recording its latency and errors under the method and key labels."""
+        labels = (self.backend, method, key_prefix(key))
+        with (
+            store_operation_seconds.labels(*labels).time(),
+            store_errors.labels(*labels).count_exceptions(),
+        ):
+            return func(*args, **kwargs)
+
+    def batch(self) -> "InstrumentedStoreBatch":
+        """See `Store.batch`."""
+        return InstrumentedStoreBatch(self)
+
+    def get(self, key: str) -> str:
+        """See `Store.get`."""
+        return self.call("get", key, self.store.get, key)
+
+    def mget(self, *keys: str) -> list[str | None]:
+        """See `Store.mget`."""
+        return self.call("mget", keys[0] if keys else "", self.store.mget, *keys)
+
+    def set(self, key: str, value: str, ttl: int | None = None) -> bool:
+        """See `Store.set`."""
+        return self.call("set", key, self.store.set, key, value, ttl)
+
+    def delete(self, *keys: str) -> int:
+        """See `Store.delete`."""
+        return self.call("delete", keys[0] if keys else "", self.store.delete, *keys)
+
+    def incr(self, key: str, ttl: int | None = None, amount: int = 1) -> int:
+        """See `Store.incr`."""
+        return self.call("incr", key, self.store.incr, key, ttl, amount)
+
+    def hget(self, key: str, field: str) -> str | None:
+        """See `Store.hget`."""
+        return self.call("hget", key, self.store.hget, key, field)
+
+    def hmget(self, key: str, *fields: str) -> list[str | None]:
+        """See `Store.hmget`."""
+        return self.call("hmget", key, self.store.hmget, key, *fields)
+
+    def hgetall(self, key: str) -> dict[str, Any]:
+        """See `Store.hgetall`."""
+        return self.call("hgetall", key, self.store.hgetall, key)
+
+    def hset(
+        self,
+        key: str,
+        field: str | None = None,
+        value: str | None = None,
+        ttl: int | None = None,
+        mapping: dict[str, str] | None = None,
+    ) -> int:  # F402
+        """See `Store.hset`."""
+        return self.call("hset", key, self.store.hset, key, field, value, ttl, mapping=mapping)
+
+    def hdel(self, key, *fields) -> int:
+        """See `Store.hdel`."""
+        return self.call("hdel", key, self.store.hdel, key, *fields)
+
+    def hkeys(self, key: str) -> list[str]:
+        """See `Store.hkeys`."""
+        return self.call("hkeys", key, self.store.hkeys, key)
+
+    def flushall(self) -> None:
+        """See `Store.flushall`."""
+        return self.call("flushall", "", self.store.flushall)
+
+
+@define
+class InstrumentedStoreBatch(StoreBatch):
+    """Store calls queued in the batch of the instrumented store, timed as a whole."""
+
+    def execute(self) -> list:
+        """See `StoreBatch.execute`."""
+        calls, self.calls = self.calls, []
+        batch = self.store.store.batch()
+        batch.calls = list(calls)
+        key = calls[0][1][0] if calls and calls[0][1] else ""
+        return self.store.call("batch", key, batch.execute)
+
+
+@define
+class AsyncStore(ABC):
+    """Asynchronous key/value store, mirroring `Store`."""
+
+    @classmethod
+    def from_url(cls, url: URL | str, registry=None) -> "AsyncStore":
+        if registry is None:
+            registry = registry_load("taramail_store_async")
+        scheme = URL(url).scheme
+        storage_cls = registry["taramail_store_async"][scheme]
+        return storage_cls.from_url(url)
+
+    @abstractmethod
+    async def get(self, key: str) -> str:
+        """See `Store.get`."""
+
+    @abstractmethod
+    async def mget(self, *keys: str) -> list[str | None]:
+        """See `Store.mget`."""
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: int | None = None) -> bool:
+        """See `Store.set`."""
+
+    @abstractmethod
+    async def delete(self, *keys: str) -> int:
+        """See `Store.delete`."""
+
+    @abstractmethod
+    async def incr(self, key: str, ttl: int | None = None, amount: int = 1) -> int:
+        """See `Store.incr`."""
+
+    @abstractmethod
+    async def hget(self, key: str, field: str) -> str | None:
+        """See `Store.hget`."""
+
+    @abstractmethod
+    async def hmget(self, key: str, *fields: str) -> list[str | None]:
+        """See `Store.hmget`."""
+
+    @abstractmethod
+    async def hgetall(self, key: str) -> dict[str, Any]:
+        """See `Store.hgetall`."""
+
+    @abstractmethod
+    async def hset(
+        self,
+        key: str,
+        field: str | None = None,
+        value: str | None = None,
+        ttl: int | None = None,
+        mapping: dict[str, str] | None = None,
+    ) -> int:
+        """See `Store.hset`."""
+
+    @abstractmethod
+    async def hdel(self, key: str, *fields) -> int:
+        """See `Store.hdel`."""
+
+    @abstractmethod
+    async def hkeys(self, key: str) -> list[str]:
+        """See `Store.hkeys`."""
+
+    @abstractmethod
+    async def flushall(self) -> None:
+        """See `Store.flushall`."""
+
+
+@define(frozen=True)
+class AsyncStoreProxy(AsyncStore):
+    """Asynchronous store proxying the calls to a synchronous store."""
+
+    store: Store = field()
+
+    async def run(self, func, *args):
+        """Run a method of the synchronous store."""
+        return func(*args)
+
+    async def get(self, key: str) -> str:
+        """See `Store.get`."""
+        return await self.run(self.store.get, key)
+
+    async def mget(self, *keys: str) -> list[str | None]:
+        """See `Store.mget`."""
+        return await self.run(self.store.mget, *keys)
+
+    async def set(self, key: str, value: str, ttl: int | None = None) -> bool:
+        """See `Store.set`."""
+        return await self.run(self.store.set, key, value, ttl)
+
+    async def delete(self, *keys: str) -> int:
+        """See `Store.delete`."""
+        return await self.run(self.store.delete, *keys)
+
+    async def incr(self, key: str, ttl: int | None = None, amount: int = 1) -> int:
+        """See `Store.incr`."""
+        return await self.run(self.store.incr, key, ttl, amount)
+
+    async def hget(self, key: str, field: str) -> str | None:
+        """See `Store.hget`."""
+        return await self.run(self.store.hget, key, field)
+
+    async def hmget(self, key: str, *fields: str) -> list[str | None]:
+        """See `Store.hmget`."""
+        return await self.run(self.store.hmget, key, *fields)
+
+    async def hgetall(self, key: str) -> dict[str, Any]:
+        """See `Store.hgetall`."""
+        return await self.run(self.store.hgetall, key)
+
+    async def hset(
+        self,
+        key: str,
+        field: str | None = None,
+        value: str | None = None,
+        ttl: int | None = None,
+        mapping: dict[str, str] | None = None,
+    ) -> int:  # F402
+        """See `Store.hset`."""
+        return await self.run(self.store.hset, key, field, value, ttl, mapping)
+
+    async def hdel(self, key: str, *fields) -> int:
+        """See `Store.hdel`."""
+        return await self.run(self.store.hdel, key, *fields)
+
+    async def hkeys(self, key: str) -> list[str]:
+        """See `Store.hkeys`."""
+        return await self.run(self.store.hkeys, key)
+
+    async def flushall(self) -> None:
+        """See `Store.flushall`."""
+        return await self.run(self.store.flushall)
+
+
+@define(frozen=True)
+class AsyncMemcachedStore(AsyncStoreProxy):
+    """Memcached implementation of an asynchronous store.
+
+    pymemcache only blocks, so the calls run in threads with a pooled
+    client instead.
+    """
+
+    store: MemcachedStore = field()
+
+    @classmethod
+    def from_host(cls, host: str, port: int = 11211) -> "AsyncMemcachedStore":
+        client = HashClient([(host, port)], no_delay=True, use_pooling=True)
+        return cls(MemcachedStore(client))
+
+    @classmethod
+    def from_url(cls, url: URL | str) -> "AsyncMemcachedStore":
+        url = URL(url)
+        return cls.from_host(url.host, url.port)
+
+    async def run(self, func, *args):
+        """Run a method of the synchronous store in a thread."""
+        return await asyncio.to_thread(func, *args)
+
+
+@define(frozen=True)
+class AsyncMemoryStore(AsyncStoreProxy):
+    """Memory implementation of an asynchronous store."""
+
+    store: MemoryStore = field(factory=MemoryStore)
+
+    @classmethod
+    def from_url(cls, url: URL | str) -> "AsyncMemoryStore":
+        return cls()
+
+
+def wrap_async_response_error(func):
+    """Wrap a Redis ResponseError as a TypeError, for coroutines."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except ResponseError as e:
+            if "WRONGTYPE" in str(e):
+                raise TypeError(str(e)) from e
+            else:
+                raise
+
+    return wrapper
+
+
+class AsyncRedisStore(AsyncStrictRedis, AsyncStore):
+    """Redis implementation of an asynchronous store."""
+
+    @classmethod
+    def from_env(cls, env=os.environ) -> "AsyncRedisStore":
+        host, port, password = redis_address_from_env(env)
+        return cls.from_host(host, port, password=password)
+
+    @classmethod
+    def from_host(cls, host: str, port: int = 6379, password: str | None = None) -> "AsyncRedisStore":
+        return cls(
+            host=host,
+            port=port,
+            decode_responses=True,
+            db=0,
+            password=password,
+        )
+
+    @classmethod
+    def from_pool(cls, pool: AsyncRedisConnectionPool) -> "AsyncRedisStore":
+        """Make a store sharing the connections of the pool."""
+        return cls(connection_pool=pool)
+
+    @classmethod
+    def from_url(cls, url: URL | str) -> "AsyncRedisStore":
+        url = URL(url)
+        return cls.from_host(url.host, url.port, password=url.password)
+
+    async def incr(self, key: str, ttl: int | None = None, amount: int = 1) -> int:
+        """See `Store.incr`."""
+        async with self.pipeline() as pipe:
+            if ttl is not None:
+                pipe.set(key, 0, ex=ttl, nx=True)
+            pipe.incr(key, amount)
+            try:
+                return (await pipe.execute())[-1]
+            except ResponseError as e:
+                raise TypeError(str(e)) from e
+
+    async def hset(
+        self,
+        key: str,
+        field: str | None = None,
+        value: str | None = None,
+        ttl: int | None = None,
+        mapping: dict[str, str] | None = None,
+    ) -> int:  # F402
+        """See `Store.hset`."""
+        ret = await self._hset(key, field, value, mapping=mapping)
+        if ttl is not None:
+            await self._hexpire(key, ttl, *hash_fields(field, mapping))
+
+        return ret
+
+    async def mget(self, *keys: str) -> list[str | None]:
+        """See `Store.mget`."""
+        return await AsyncStrictRedis.mget(self, keys)
+
+    get = wrap_async_response_error(AsyncStrictRedis.get)
+    hget = wrap_async_response_error(AsyncStrictRedis.hget)
+    hmget = wrap_async_response_error(AsyncStrictRedis.hmget)
+    hgetall = wrap_async_response_error(AsyncStrictRedis.hgetall)
+    hkeys = wrap_async_response_error(AsyncStrictRedis.hkeys)
+    _hset = wrap_async_response_error(AsyncStrictRedis.hset)
+    _hexpire = wrap_async_response_error(AsyncStrictRedis.hexpire)
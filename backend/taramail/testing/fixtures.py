@@ -10,6 +10,7 @@
 from taramail.api import app as _api_app
 from taramail.deps import (
     get_db,
+    get_f2b_stream,
     get_memcached,
     get_queue,
     get_store,
@@ -23,6 +24,7 @@
 def api_app(db_session, memcached_store, redis_queue, redis_store):
     """API testing app."""
     _api_app.dependency_overrides[get_db] = lambda: db_session
+    _api_app.dependency_overrides[get_f2b_stream] = lambda: None
     _api_app.dependency_overrides[get_memcached] = lambda: memcached_store
     _api_app.dependency_overrides[get_queue] = lambda: redis_queue
     _api_app.dependency_overrides[get_store] = lambda: redis_store
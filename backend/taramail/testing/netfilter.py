@@ -0,0 +1,202 @@
+"""Netfilter fixtures and replay harness.
+
+The harness replays a corpus of fail2ban messages through the netfilter
+service, with a fake nftables, a memory store and a memory queue, and
+reports the throughput, the ban and unban latencies and the memory growth.
+"""
+
+import asyncio
+import ipaddress
+import logging
+import os
+import statistics
+import sys
+import time
+from argparse import ArgumentParser
+
+import pytest
+from attrs import define, field
+from taraqueue.memory import MemoryQueue
+
+from taramail.netfilter import (
+    AsyncNetfilterTables,
+    FakeNftables,
+    Netfilter,
+    NetfilterService,
+    NetfilterTables,
+)
+from taramail.store import AsyncMemoryStore
+
+SASL_FAILURE = "warning: unknown[{ip}]: SASL LOGIN authentication failed: UGFzc3dvcmQ6"
+
+
+@pytest.fixture
+def fake_nftables():
+    """Fake nftables fixture with the base chains created by Docker."""
+    return make_fake_nftables()
+
+
+def make_fake_nftables():
+    nft = FakeNftables()
+    for family in ("ip", "ip6"):
+        nft.add_base_chain(family, "filter", "INPUT", "input")
+        nft.add_base_chain(family, "filter", "FORWARD", "forward")
+        nft.add_base_chain(family, "nat", "POSTROUTING", "postrouting", 100)
+
+    return nft
+
+
+def synthetic_corpus(attackers, attempts=10, template=SASL_FAILURE):
+    """Generate messages for distinct attackers, interleaved like a distributed attack.
+
+    Attackers are spread over 11.0.0.0/8 one per /24, so their bans
+    are not aggregated.
+    """
+    ips = [ipaddress.IPv4Address(0x0B000000 + i * 257) for i in range(attackers)]
+    for _ in range(attempts):
+        for ip in ips:
+            yield template.format(ip=ip)
+
+
+def resident_memory():
+    """Return the resident memory of the process in bytes, or 0 when unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def percentile(values, n):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+
+    return statistics.quantiles(values, n=100, method="inclusive")[n - 1]
+
+
+@define
+class TimedNetfilter:
+    """Netfilter proxy timing the attempts that end up banning a network."""
+
+    netfilter = field()
+    latencies = field(factory=list)
+
+    def __getattr__(self, name):
+        return getattr(self.netfilter, name)
+
+    async def ban_all(self, addresses):
+        banned = len(self.netfilter.bans.banned_nets)
+        start_time = time.perf_counter()
+        await self.netfilter.ban_all(addresses)
+        latency = time.perf_counter() - start_time
+        self.latencies.extend([latency] * (len(self.netfilter.bans.banned_nets) - banned))
+
+
+@define
+class ReplayService(NetfilterService):
+    """Service stopping once it received the given number of messages."""
+
+    remaining = field(default=0)
+
+    async def enqueue(self, message):
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.stop_event.set()
+
+        await super().enqueue(message)
+
+
+@define(frozen=True)
+class ReplayReport:
+
+    lines: int
+    bans: int
+    seconds: float
+    ban_p50: float
+    ban_p99: float
+    unban_p50: float
+    unban_p99: float
+    memory_growth: int
+
+    @property
+    def lines_per_second(self):
+        return self.lines / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.lines} lines, {self.bans} bans: {self.lines_per_second:.0f} lines/s, "
+            f"ban p50 {self.ban_p50 * 1000:.2f} ms p99 {self.ban_p99 * 1000:.2f} ms, "
+            f"unban p50 {self.unban_p50 * 1000:.2f} ms p99 {self.unban_p99 * 1000:.2f} ms, "
+            f"memory +{self.memory_growth // 1024} KiB"
+        )
+
+
+async def replay(messages, nft=None):
+    """Replay messages through the watch loop of the service, then unban everything."""
+    nft = nft or make_fake_nftables()
+    ipv4_tables = AsyncNetfilterTables(NetfilterTables("MAIL", "mail", "ip", nft).init_chains())
+    ipv6_tables = AsyncNetfilterTables(NetfilterTables("MAIL", "mail", "ip6", nft).init_chains(), ipv4_tables.executor)
+    netfilter = Netfilter(AsyncMemoryStore(), ipv4_tables, ipv6_tables)
+    await ipv4_tables.insert_mail_chains()
+    await ipv6_tables.insert_mail_chains()
+
+    queue = MemoryQueue()
+    timed = TimedNetfilter(netfilter)
+    messages = list(messages)
+    service = ReplayService(timed, queue, remaining=len(messages))
+    await queue.subscribe("F2B_CHANNEL")
+    for message in messages:
+        await queue.publish("F2B_CHANNEL", message)
+
+    memory = resident_memory()
+    start_time = time.perf_counter()
+    await service.watch()
+    seconds = time.perf_counter() - start_time
+    memory_growth = resident_memory() - memory
+
+    unban_latencies = []
+    for net, _ in netfilter.bans.banned():
+        start_time = time.perf_counter()
+        await netfilter.unban(net)
+        unban_latencies.append(time.perf_counter() - start_time)
+
+    return ReplayReport(
+        lines=len(messages),
+        bans=len(timed.latencies),
+        seconds=seconds,
+        ban_p50=percentile(timed.latencies, 50),
+        ban_p99=percentile(timed.latencies, 99),
+        unban_p50=percentile(unban_latencies, 50),
+        unban_p99=percentile(unban_latencies, 99),
+        memory_growth=memory_growth,
+    )
+
+
+def main(argv=None):  # pragma: no cover
+    parser = ArgumentParser(description="Replay fail2ban messages through the netfilter service.")
+    parser.add_argument(
+        "--attackers",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="Numbers of distinct attacker IPs to replay (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--corpus",
+        help="File with one recorded F2B_CHANNEL message per line, instead of a synthetic corpus",
+    )
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    if args.corpus:
+        with open(args.corpus) as f:
+            print(asyncio.run(replay(line.rstrip("\n") for line in f)))
+        return
+
+    for attackers in args.attackers:
+        report = asyncio.run(replay(synthetic_corpus(attackers)))
+        print(f"{attackers} attackers: {report}")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -3,7 +3,7 @@
 import pytest
 from yarl import URL
 
-from taramail.store import Store
+from taramail.store import AsyncStore, Store
 
 
 @pytest.fixture
@@ -45,3 +45,44 @@ def redis_store(redis_service, env_vars):
 def store(request):
     """Store fixture."""
     return request.getfixturevalue(request.param)
+
+
+@pytest.fixture
+def async_memcached_store(memcached_service):
+    """Asynchronous Memcached store fixture."""
+    url = URL.build(
+        scheme="memcached",
+        host=memcached_service.ip,
+        port=11211,
+    )
+    return AsyncStore.from_url(url)
+
+
+@pytest.fixture
+def async_memory_store():
+    """Asynchronous memory store fixture."""
+    return AsyncStore.from_url("memory:/")
+
+
+@pytest.fixture
+def async_redis_store(redis_service, env_vars):
+    """Asynchronous Redis store fixture."""
+    url = URL.build(
+        scheme="redis",
+        host=redis_service.ip,
+        port=6379,
+        password=env_vars["REDIS_PASSWORD"],
+    )
+    return AsyncStore.from_url(url)
+
+
+@pytest.fixture(
+    params=[
+        "async_memcached_store",
+        "async_memory_store",
+        "async_redis_store",
+    ],
+)
+def async_store(request):
+    """Asynchronous store fixture."""
+    return request.getfixturevalue(request.param)
@@ -3,8 +3,11 @@
 from functools import partial
 
 import pytest
+from prometheus_client import REGISTRY
 from pytest_xdocker.retry import retry
 
+from taramail.store import CachedStore, MemcachedHash, MemcachedStore, RedisConnectionPool, RedisStore
+
 
 def test_get_unknown(store, unique):
     """Getting an unknown key should return None."""
@@ -230,6 +233,25 @@ def test_hdel_twice(store, unique):
     assert store.hdel(key, field) == 0
 
 
+def test_hdel_expiration(store, unique):
+    """Deleting a field of a hash with an expiration should keep the expiration."""
+    key, field1, field2 = unique("text"), unique("text"), unique("text")
+    store.hset(key, field1, "", 1)
+    store.hset(key, field2, "", 1)
+    store.hdel(key, field1)
+    retry(partial(store.hget, key, field2)).until(None, delay=0.1)
+
+
+@pytest.mark.parametrize("store", ["memory_store", "redis_store"], indirect=True)
+def test_hset_field_expiration(store, unique):
+    """Setting a field with an expiration should only expire that field, Memcached expires the whole hash."""
+    key, field1, field2 = unique("text"), unique("text"), unique("text")
+    store.hset(key, field1, "", 1)
+    store.hset(key, field2, "")
+    retry(partial(store.hget, key, field1)).until(None, delay=0.1)
+    assert store.hget(key, field2) == ""
+
+
 def test_hdel_many(store, unique):
     """Deleting many fields should return the number of deleted fields."""
     key, field1, field2, field3 = unique("text"), unique("text"), unique("text"), unique("text")
@@ -238,9 +260,196 @@ def test_hdel_many(store, unique):
     assert store.hdel(key, field1, field2, field3) == 2
 
 
+def test_incr_unknown(store, unique):
+    """Incrementing an unknown key should start from zero."""
+    key = unique("text")
+    assert store.incr(key) == 1
+    assert store.incr(key) == 2
+    assert store.get(key) == "2"
+
+
+def test_incr_amount(store, unique):
+    """Incrementing a key by an amount should add the amount."""
+    key = unique("text")
+    assert store.incr(key, amount=3) == 3
+    assert store.incr(key, amount=2) == 5
+
+
+def test_incr_expiration(store, unique):
+    """Incrementing a key with an expiration should expire the key from its creation."""
+    key = unique("text")
+    store.incr(key, 1)
+    store.incr(key, 1)
+    retry(partial(store.get, key)).until(None, delay=0.1)
+
+
+def test_incr_hset(store, unique):
+    """Incrementing a hash should raise a TypeError."""
+    key, field = unique("text"), unique("text")
+    store.hset(key, field, "")
+    with pytest.raises(TypeError):
+        store.incr(key)
+
+
 def test_flushall(store, unique):
     """Flushing all should delete all keys from the existing databases."""
     key, value = unique("text"), unique("text")
     store.set(key, value)
     store.flushall()
     assert store.get(key) is None
+
+
+def test_mget(store, unique):
+    """Getting many keys should return None for missing keys and hashes."""
+    key, value, hash_key = unique("text"), unique("text"), unique("text")
+    store.set(key, value)
+    store.hset(hash_key, "field", unique("text"))
+    assert store.mget(key, unique("text"), hash_key) == [value, None, None]
+
+
+def test_hmget(store, unique):
+    """Getting many hash fields should return None for missing fields."""
+    key, value = unique("text"), unique("text")
+    store.hset(key, "field", value)
+    assert store.hmget(key, "field", "missing") == [value, None]
+
+
+def test_hmget_wrong_type(store, unique):
+    """Getting many hash fields from a string should raise a TypeError."""
+    key = unique("text")
+    store.set(key, unique("text"))
+    with pytest.raises(TypeError):
+        store.hmget(key, "field")
+
+
+def test_hset_mapping(store, unique):
+    """Setting a mapping should set every field and count the new ones."""
+    key = unique("text")
+    store.hset(key, "a", "1")
+    assert store.hset(key, mapping={"a": "2", "b": "3"}) == 1
+    assert store.hgetall(key) == {"a": "2", "b": "3"}
+
+
+def test_batch(store, unique):
+    """Executing a batch should return the results of the queued calls."""
+    key, hash_key = unique("text"), unique("text")
+    pipe = store.batch()
+    pipe.set(key, "value")
+    pipe.incr(unique("text"), 60, 2)
+    pipe.hset(hash_key, "field", "value", 60)
+    pipe.hget(hash_key, "field")
+    assert pipe.execute() == [True, 2, 1, "value"]
+
+
+def test_batch_context(store, unique):
+    """Leaving a batch context should run the queued calls."""
+    key = unique("text")
+    with store.batch() as pipe:
+        pipe.hset(key, "a", "1")
+        pipe.hset(key, "b", "2")
+        assert store.hgetall(key) == {}
+
+    assert store.hgetall(key) == {"a": "1", "b": "2"}
+
+
+async def test_async_set_and_get(async_store, unique):
+    """Setting a key asynchronously, then getting it should return the value."""
+    key, value = unique("text"), unique("text")
+    assert await async_store.set(key, value) is True
+    assert await async_store.get(key) == value
+
+
+async def test_async_delete(async_store, unique):
+    """Deleting keys asynchronously should return the number of deleted keys."""
+    key = unique("text")
+    await async_store.set(key, unique("text"))
+    assert await async_store.delete(key, unique("text")) == 1
+
+
+async def test_async_incr(async_store, unique):
+    """Incrementing a key asynchronously should add the amount."""
+    key = unique("text")
+    assert await async_store.incr(key, 60) == 1
+    assert await async_store.incr(key, 60, 2) == 3
+
+
+async def test_async_hset_and_hgetall(async_store, unique):
+    """Setting hash fields asynchronously, then getting them should return the fields."""
+    key, value = unique("text"), unique("text")
+    assert await async_store.hset(key, "field", value) == 1
+    assert await async_store.hget(key, "field") == value
+    assert await async_store.hgetall(key) == {"field": value}
+    assert await async_store.hkeys(key) == ["field"]
+    assert await async_store.hdel(key, "field") == 1
+
+
+async def test_async_get_wrong_type(async_store, unique):
+    """Getting a hash asynchronously should raise a TypeError."""
+    key = unique("text")
+    await async_store.hset(key, "field", unique("text"))
+    with pytest.raises(TypeError):
+        await async_store.get(key)
+
+
+def test_memcached_store_sharded_hash(memcached_service, unique):
+    """Setting more fields than the shard threshold should store each field in its own key."""
+    store = MemcachedStore.from_url(f"memcached://{memcached_service.ip}:11211?shard_threshold=2")
+    key, fields = unique("text"), [unique("text") for _ in range(3)]
+    store.hset(key, mapping=dict.fromkeys(fields[:2], "1"))
+    store.hset(key, fields[2], "2")
+    versions = MemcachedHash.decode(store.client.get(key)).fields
+    assert store.client.get(store.field_key(key, fields[2], versions[fields[2]])) == b"2"
+    assert store.hgetall(key) == {fields[0]: "1", fields[1]: "1", fields[2]: "2"}
+    assert store.hmget(key, fields[0], "unknown") == ["1", None]
+
+    store.hset(key, fields[2], "3")
+    assert store.hget(key, fields[2]) == "3"
+    assert store.client.get(store.field_key(key, fields[2], versions[fields[2]])) is None
+
+    assert store.hdel(key, fields[0]) == 1
+    assert store.hkeys(key) == fields[1:]
+    assert store.client.get(store.field_key(key, fields[0], versions[fields[0]])) is None
+
+    store.delete(key)
+    assert store.client.get(store.field_key(key, fields[1], versions[fields[1]])) is None
+
+
+def test_memcached_store_hdel_empty_hash(memcached_store, unique):
+    """Deleting the last field of a hash should delete the hash."""
+    key = unique("text")
+    memcached_store.hset(key, "a", "1")
+    assert memcached_store.hdel(key, "a") == 1
+    assert memcached_store.client.get(key) is None
+
+
+def test_memcached_store_json_hash(memcached_store, unique):
+    """Getting a hash stored as JSON should decode the legacy encoding."""
+    key = unique("text")
+    memcached_store.client.set(key, '{"a": "1"}')
+    assert memcached_store.hgetall(key) == {"a": "1"}
+    memcached_store.hset(key, "b", "2")
+    assert memcached_store.hgetall(key) == {"a": "1", "b": "2"}
+
+
+def test_redis_store_from_pool(redis_service, env_vars, unique):
+    """Stores made from the same pool should share its connections and export its metrics."""
+    name = unique("text")
+    pool = RedisConnectionPool(name, host=redis_service.ip, password=env_vars["REDIS_PASSWORD"], decode_responses=True)
+    key, value = unique("text"), unique("text")
+
+    RedisStore.from_pool(pool).set(key, value)
+    assert RedisStore.from_pool(pool).get(key) == value
+
+    assert REGISTRY.get_sample_value("redis_pool_wait_seconds_count", {"pool": name}) == 2
+    assert REGISTRY.get_sample_value("redis_pool_connections_in_use", {"pool": name}) == 0
+
+
+def test_cached_redis_store_invalidation(redis_store, unique):
+    """A hash cached in front of Redis should be invalidated when another client changes it."""
+    key, value = unique("text"), unique("text")
+    cached_store = CachedStore(redis_store, keys=[key], ttl=60).start()
+    assert cached_store.hget(key, "field") is None
+
+    redis_store.hset(key, "field", value)
+
+    retry(partial(cached_store.hget, key, "field")).until(value, delay=0.1)
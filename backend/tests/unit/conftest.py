@@ -3,10 +3,11 @@
 import pytest
 
 from taramail.spf import FakeResolver
-from taramail.store import MemoryStore
+from taramail.store import AsyncMemoryStore, MemoryStore
 
 redis_queue = pytest.fixture(lambda memory_queue: memory_queue)
 redis_store = pytest.fixture(lambda: MemoryStore())
+async_redis_store = pytest.fixture(lambda: AsyncMemoryStore())
 memcached_store = pytest.fixture(lambda: MemoryStore())
 
 
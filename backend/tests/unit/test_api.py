@@ -1,5 +1,7 @@
 """Unit tests for the api module."""
 
+from unittest.mock import AsyncMock, Mock
+
 from hamcrest import (
     assert_that,
     contains_string,
@@ -13,6 +15,7 @@
     starts_with,
 )
 
+from taramail.deps import get_f2b_stream
 from taramail.models import (
     AliasModel,
     DomainModel,
@@ -399,3 +402,12 @@ def test_api_transports_delete(api_app, unique):
     api_app.delete(f"/api/transports/{transport_id}")
     response = api_app.get(f"/api/transports/{transport_id}")
     assert response.status_code == 404
+
+
+def test_rspamd_error_stream(api_app):
+    """An rspamd UI login error should also be written to the fail2ban stream when netfilter reads it."""
+    f2b_stream = Mock(publish=AsyncMock())
+    api_app.app.dependency_overrides[get_f2b_stream] = lambda: f2b_stream
+    response = api_app.get("/rspamd/error")
+    assert response.status_code == 401
+    f2b_stream.publish.assert_awaited_once_with("Rspamd UI: Invalid password by testclient")
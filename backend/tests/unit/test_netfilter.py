@@ -1,26 +1,56 @@
 """Unit tests for the netfilter module."""
 
-from unittest.mock import ANY, AsyncMock, Mock, patch
-
+import asyncio
+import ipaddress
+import sys
+import threading
+import time
+from unittest.mock import AsyncMock, Mock, patch
+
+import dns.resolver
 import pytest
 from hamcrest import (
     assert_that,
+    contains_exactly,
     empty,
+    has_entries,
+    has_entry,
     has_item,
     has_items,
+    has_key,
 )
+from redis.exceptions import ResponseError
 
 from taramail.netfilter import (
+    F2B_REGEX,
+    AddressResolver,
+    AsyncNetfilterTables,
+    AttemptTracker,
+    BanCluster,
+    BanScheduler,
+    F2BMatcher,
+    F2BOptions,
+    F2BStream,
     Netfilter,
+    NetfilterError,
     NetfilterService,
     NetfilterTables,
+    NetworkMatcher,
+    RulesetMonitor,
     get_ip,
     is_ip,
     main,
+    registry,
     resolve_addresses,
 )
 
 
+def make_tables(family="ip"):
+    """Make asynchronous tables with a mock nft that always succeeds."""
+    nft = Mock(json_cmd=Mock(return_value=(0, {"nftables": []}, None)))
+    return AsyncNetfilterTables(NetfilterTables("MAIL", "mail", family, nft))
+
+
 def test_get_ip():
     """Getting an IP should return an IP object or None."""
     ip = get_ip("8.8.8.8")
@@ -56,6 +86,581 @@ async def test_resolve_addresses(addresses, matches):
     assert_that(result, matches)
 
 
+async def test_address_resolver_cache():
+    """Resolving a host name twice should only query it once until it expires."""
+    answer = [Mock(to_text=Mock(return_value="1.2.3.4"))]
+    resolver = Mock(resolve=AsyncMock(return_value=Mock(__iter__=lambda _: iter(answer), expiration=time.time() + 60)))
+    address_resolver = AddressResolver(resolver)
+
+    assert await address_resolver.resolve(["example.com"]) == {"1.2.3.4"}
+    assert await address_resolver.resolve(["example.com"]) == {"1.2.3.4"}
+    assert resolver.resolve.call_count == 2
+
+    address_resolver.cache = {key: (0, ips) for key, ips in address_resolver.cache.items()}
+    await address_resolver.resolve(["example.com"])
+    assert resolver.resolve.call_count == 4
+
+
+async def test_address_resolver_concurrency():
+    """Resolving host names should not run more queries than the concurrency."""
+    running, peak = 0, 0
+
+    async def resolve(**kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0)
+        running -= 1
+        raise dns.resolver.NoAnswer
+
+    address_resolver = AddressResolver(Mock(resolve=resolve), concurrency=2)
+    await address_resolver.resolve([f"host{i}.example.com" for i in range(5)])
+
+    assert peak == 2
+
+
+@pytest.mark.parametrize(
+    "networks, address, expected",
+    [
+        ([], "1.2.3.4", None),
+        (["1.2.3.4"], "1.2.3.4", "1.2.3.4/32"),
+        (["1.2.3.4"], "1.2.3.5", None),
+        (["1.2.0.0/16", "1.2.3.0/24"], "1.2.3.4", "1.2.3.0/24"),
+        (["1.2.0.0/16", "1.2.3.0/24"], "1.2.4.4", "1.2.0.0/16"),
+        (["1.2.3.4/16"], "1.2.255.255", "1.2.0.0/16"),
+        (["0.0.0.0/0"], "1.2.3.4", "0.0.0.0/0"),
+        (["1.2.3.0/24"], "::1.2.3.4", None),
+        (["2001:db8::/32"], "2001:db8::1", "2001:db8::/32"),
+        (["invalid", "2001:db8::1"], "2001:db8::1", "2001:db8::1/128"),
+    ],
+)
+def test_network_matcher_lookup(networks, address, expected):
+    """Looking up an address should return the longest network containing it."""
+    matcher = NetworkMatcher.from_networks(networks)
+    result = matcher.lookup(address)
+    assert (str(result) if result else None) == expected
+
+
+@pytest.mark.parametrize(
+    "networks, network, expected",
+    [
+        (["1.2.3.0/24"], "1.2.3.4/32", "1.2.3.0/24"),
+        (["1.2.3.0/24"], "1.2.3.0/24", "1.2.3.0/24"),
+        (["1.2.3.4"], "1.2.3.0/24", None),
+        (["1.2.0.0/16", "1.2.3.4"], "1.2.3.0/24", "1.2.0.0/16"),
+    ],
+)
+def test_network_matcher_covering(networks, network, expected):
+    """Looking up a network should return the longest network containing all of it."""
+    matcher = NetworkMatcher.from_networks(networks)
+    result = matcher.covering(ipaddress.ip_network(network))
+    assert (str(result) if result else None) == expected
+
+
+async def test_netfilter_ban_whitelisted(async_memory_store):
+    """Banning a whitelisted address should not count attempts."""
+    netfilter = Netfilter(async_memory_store, None, None, whitelist_matcher=NetworkMatcher.from_networks(["8.8.0.0/16"]))
+    await netfilter.ban("8.8.8.8")
+    assert len(netfilter.bans) == 0
+
+
+async def test_netfilter_ban_count(async_memory_store):
+    """Banning with a count of attempts should ban once the count reaches the maximum."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    await netfilter.ban("1.2.3.4", netfilter.options.max_attempts)
+    assert netfilter.bans.banned_nets == {"1.2.3.4/32"}
+
+
+async def test_netfilter_ban_all(async_memory_store):
+    """Banning addresses at once should count their attempts per network, skipping private and whitelisted addresses."""
+    netfilter = Netfilter(
+        async_memory_store,
+        make_tables("ip"),
+        make_tables("ip6"),
+        whitelist_matcher=NetworkMatcher.from_networks(["1.2.3.9"]),
+    )
+    netfilter.options = F2BOptions(max_attempts=2, netban_ipv4=24)
+
+    await netfilter.ban_all(["1.2.3.4", "1.2.3.9", "10.0.0.1", "5.6.7.8", "1.2.3.5"])
+
+    assert netfilter.bans.banned_nets == {"1.2.3.0/24"}
+    assert netfilter.bans["5.6.7.0/24"].attempts == 1
+
+
+def test_attempt_tracker_attempt():
+    """Attempting should count attempts within the retry window."""
+    tracker = AttemptTracker()
+    tracker.attempt("1.2.3.4/32", 10, now=0)
+    record = tracker.attempt("1.2.3.4/32", 10, now=5)
+    assert record.attempts == 2
+
+    record = tracker.attempt("1.2.3.4/32", 10, now=20)
+    assert record.attempts == 1
+
+
+def test_attempt_tracker_prune():
+    """Pruning should only remove entries that are not banned nor banned before."""
+    tracker = AttemptTracker()
+    tracker.attempt("1.1.1.1/32", 10, now=0)
+    tracker.attempt("2.2.2.2/32", 10, now=0)
+    tracker.ban("2.2.2.2/32")
+    tracker.attempt("3.3.3.3/32", 10, now=0)
+    tracker.ban("3.3.3.3/32")
+    tracker.unban("3.3.3.3/32")
+    tracker.attempt("4.4.4.4/32", 10, now=15)
+
+    assert tracker.prune(10, 100, now=20) == 1
+    assert list(tracker.entries) == ["2.2.2.2/32", "3.3.3.3/32", "4.4.4.4/32"]
+
+    assert tracker.prune(10, 100, now=200) == 2
+    assert list(tracker.entries) == ["2.2.2.2/32"]
+
+
+def test_attempt_tracker_evict():
+    """Attempting above the maximum size should evict the least recent entry that is not banned."""
+    tracker = AttemptTracker(max_size=2)
+    tracker.attempt("1.1.1.1/32", 10, now=0)
+    tracker.ban("1.1.1.1/32")
+    tracker.attempt("2.2.2.2/32", 10, now=1)
+    tracker.attempt("3.3.3.3/32", 10, now=2)
+    assert list(tracker.entries) == ["1.1.1.1/32", "3.3.3.3/32"]
+
+
+def test_ban_scheduler_pop_due():
+    """Popping due bans should return the networks whose deadline passed in order."""
+    scheduler = BanScheduler()
+    scheduler.schedule("2.2.2.2/32", 20)
+    scheduler.schedule("1.1.1.1/32", 10)
+    scheduler.schedule("3.3.3.3/32", 30)
+    assert scheduler.pop_due(now=25) == ["1.1.1.1/32", "2.2.2.2/32"]
+    assert len(scheduler) == 1
+
+
+def test_ban_scheduler_reschedule():
+    """Rescheduling or cancelling a ban should skip its previous deadline."""
+    scheduler = BanScheduler()
+    scheduler.schedule("1.1.1.1/32", 10)
+    scheduler.schedule("1.1.1.1/32", 30)
+    scheduler.schedule("2.2.2.2/32", 20)
+    scheduler.cancel("2.2.2.2/32")
+    assert scheduler.pop_due(now=25) == []
+    assert scheduler.next_deadline() == 30
+
+
+async def test_ban_scheduler_wait():
+    """Waiting should return when an earlier deadline is scheduled."""
+    scheduler = BanScheduler()
+    task = asyncio.create_task(scheduler.wait(60))
+    await asyncio.sleep(0)
+    scheduler.schedule("1.1.1.1/32", 0)
+    await asyncio.wait_for(task, 1)
+
+
+async def test_netfilter_batch_rollback(async_memory_store):
+    """A failed transaction should restore the tracker and the scheduler of its family, without writing the store."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    expires = round(time.time()) + 60
+    await netfilter.apply_ban("1.2.3.4/32", expires)
+    netfilter.ipv4_tables.tables.nft.json_cmd.return_value = (1, "", "Error")
+
+    with pytest.raises(NetfilterError):
+        async with netfilter.batch():
+            await netfilter.unban("1.2.3.4/32")
+            await netfilter.apply_ban("5.6.7.8/32", expires)
+            await netfilter.apply_ban("2001:db8::/64", expires)
+
+    assert netfilter.bans.banned_nets == {"1.2.3.4/32", "2001:db8::/64"}
+    assert "5.6.7.8/32" not in netfilter.bans
+    assert netfilter.scheduler.expiries == {"1.2.3.4/32": expires, "2001:db8::/64": expires}
+    assert await async_memory_store.hgetall("F2B_ACTIVE_BANS") == {
+        "1.2.3.4/32": str(expires),
+        "2001:db8::/64": str(expires),
+    }
+
+
+async def test_netfilter_batch_cancelled(async_memory_store):
+    """Cancelling a batch while its transaction runs should keep the changes once it committed."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    started = threading.Event()
+
+    def json_cmd(cmd):
+        started.set()
+        time.sleep(0.1)
+        return 0, {"nftables": []}, None
+
+    netfilter.ipv4_tables.tables.nft.json_cmd.side_effect = json_cmd
+    expires = round(time.time()) + 60
+
+    async def ban():
+        async with netfilter.batch():
+            await netfilter.apply_ban("1.2.3.4/32", expires)
+
+    task = asyncio.create_task(ban())
+    await asyncio.to_thread(started.wait)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert netfilter.bans.banned_nets == {"1.2.3.4/32"}
+    assert netfilter.ipv4_tables.tables.index.elements.keys() == {"1.2.3.4/32"}
+    assert await async_memory_store.hkeys("F2B_ACTIVE_BANS") == ["1.2.3.4/32"]
+
+
+async def test_netfilter_autopurge_error(async_memory_store):
+    """A failed autopurge should leave the expired bans due for the next one."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    await netfilter.apply_ban("8.8.8.8/32", round(time.time()) + 60)
+    netfilter.scheduler.schedule("8.8.8.8/32", 0)
+    netfilter.ipv4_tables.tables.nft.json_cmd.return_value = (1, "", "Error")
+
+    with pytest.raises(NetfilterError):
+        await netfilter.autopurge()
+
+    assert netfilter.bans.banned_nets == {"8.8.8.8/32"}
+    assert await async_memory_store.hkeys("F2B_ACTIVE_BANS") == ["8.8.8.8/32"]
+
+    netfilter.ipv4_tables.tables.nft.json_cmd.return_value = (0, {"nftables": []}, None)
+    await netfilter.autopurge()
+    assert netfilter.bans.banned_nets == set()
+    assert await async_memory_store.hkeys("F2B_ACTIVE_BANS") == []
+
+
+async def test_netfilter_autopurge(async_memory_store):
+    """Autopurging should unban the networks whose ban expired."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    for _ in range(netfilter.options.max_attempts):
+        await netfilter.ban("8.8.8.8")
+
+    netfilter.scheduler.schedule("8.8.8.8/32", 0)
+    await netfilter.autopurge()
+
+    command = netfilter.ipv4_tables.tables.nft.json_cmd.call_args.args[0]["nftables"][1]
+    assert_that(command, has_key("delete"))
+    assert netfilter.bans.banned() == []
+
+
+async def ban_addresses(netfilter, addresses):
+    for address in addresses:
+        for _ in range(netfilter.options.max_attempts):
+            await netfilter.ban(address)
+
+
+async def test_netfilter_aggregate(async_memory_store):
+    """Autopurging should swap dense bans for their covering network in one transaction."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    await ban_addresses(netfilter, [f"1.2.3.{i}" for i in range(16)])
+
+    await netfilter.autopurge()
+
+    assert netfilter.bans.banned_nets == {"1.2.3.0/24"}
+    assert netfilter.scheduler.expiries.keys() == {"1.2.3.0/24"}
+    assert (await async_memory_store.hgetall("F2B_ACTIVE_BANS")).keys() == {"1.2.3.0/24"}
+    commands = netfilter.ipv4_tables.tables.nft.json_cmd.call_args.args[0]["nftables"]
+    assert len([command for command in commands if "delete" in command]) == 16
+
+
+async def test_netfilter_aggregate_expiring(async_memory_store, fake_nftables):
+    """Aggregating should replace a member whose ban is about to expire."""
+    ipv4_tables = NetfilterTables("MAIL", "mail", "ip", fake_nftables).init_chains()
+    ipv4_tables.insert_mail_chains()
+    netfilter = Netfilter(async_memory_store, AsyncNetfilterTables(ipv4_tables), make_tables("ip6"))
+    netfilter.options = F2BOptions(aggregate_threshold=2)
+    expires = round(time.time()) + 60
+    await netfilter.apply_ban("11.1.1.1/32", expires)
+    await netfilter.apply_ban("11.1.1.2/32", round(time.time()) + 1)
+    await netfilter.apply_ban("12.0.0.1/32", expires)
+    netfilter.scheduler.schedule("12.0.0.1/32", 0)
+
+    await netfilter.autopurge()
+
+    assert fake_nftables.elements["ip", "filter", "MAIL_BANS"].keys() == {"11.1.1.0/24"}
+    assert netfilter.bans.banned_nets == {"11.1.1.0/24"}
+    assert await async_memory_store.hkeys("F2B_ACTIVE_BANS") == ["11.1.1.0/24"]
+    assert netfilter.covering_ban(ipaddress.ip_network("11.1.1.200/32")) == "11.1.1.0/24"
+
+
+async def test_netfilter_aggregate_error(async_memory_store):
+    """A failed aggregation should leave the tracker, the scheduler and the store unchanged."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    await ban_addresses(netfilter, [f"1.2.3.{i}" for i in range(16)])
+    expiries = dict(netfilter.scheduler.expiries)
+    netfilter.ipv4_tables.tables.nft.json_cmd.return_value = (1, "", "Error")
+
+    with pytest.raises(NetfilterError):
+        await netfilter.autopurge()
+
+    assert len(netfilter.bans.banned_nets) == 16
+    assert netfilter.scheduler.expiries == expiries
+    assert (await async_memory_store.hgetall("F2B_ACTIVE_BANS")).keys() == expiries.keys()
+
+
+async def test_netfilter_aggregate_below_threshold(async_memory_store):
+    """Autopurging should not aggregate bans below the density threshold."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    await ban_addresses(netfilter, [f"1.2.3.{i}" for i in range(15)])
+
+    await netfilter.autopurge()
+
+    assert len(netfilter.bans.banned_nets) == 15
+
+
+async def test_netfilter_aggregate_whitelist(async_memory_store):
+    """Autopurging should not aggregate over a whitelisted network."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    await ban_addresses(netfilter, [f"1.2.3.{i}" for i in range(16)])
+    netfilter.whitelist = {"1.2.3.200"}
+
+    await netfilter.autopurge()
+
+    assert "1.2.3.0/24" not in netfilter.bans.banned_nets
+
+
+async def test_netfilter_aggregate_collapse(async_memory_store):
+    """Aggregating adjacent dense networks should collapse them into one network."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    await ban_addresses(netfilter, [f"1.2.{i}.{j}" for i in (2, 3) for j in range(16)])
+
+    await netfilter.autopurge()
+
+    assert netfilter.bans.banned_nets == {"1.2.2.0/23"}
+
+
+async def test_netfilter_ban_covered(async_memory_store):
+    """Banning an address covered by a banned network should not add a ban."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    await ban_addresses(netfilter, [f"1.2.3.{i}" for i in range(16)])
+    await netfilter.autopurge()
+
+    await ban_addresses(netfilter, ["1.2.3.100"])
+
+    assert netfilter.bans.banned_nets == {"1.2.3.0/24"}
+
+
+def test_f2b_options_from_mapping():
+    """Making options from a mapping should convert values and skip invalid ones."""
+    options = F2BOptions.from_mapping({
+        "ban_time": "60",
+        "ban_time_increment": "0",
+        "manage_external": "1",
+        "max_attempts": "invalid",
+        "unknown": "1",
+    })
+    assert options.ban_time == 60
+    assert options.ban_time_increment is False
+    assert options.manage_external is True
+    assert options.max_attempts == 10
+
+
+async def test_f2b_options_refresh(async_memory_store):
+    """Refreshing options should only read the store when the version changed."""
+    options = await F2BOptions.from_store(async_memory_store)
+    await async_memory_store.hset("F2B_OPTIONS", "max_attempts", "3")
+    assert await options.refresh(async_memory_store) is options
+
+    await async_memory_store.set("F2B_OPTIONS_VERSION", "1")
+    result = await options.refresh(async_memory_store)
+    assert result.max_attempts == 3
+    assert result.version == "1"
+    assert result.banlist_id == options.banlist_id
+
+
+async def test_netfilter_update_options(async_memory_store):
+    """Updating the options should apply the options from the store."""
+    netfilter = Netfilter(async_memory_store, None, None)
+    await async_memory_store.hset("F2B_OPTIONS", "retry_window", "60")
+    await async_memory_store.set("F2B_OPTIONS_VERSION", "1")
+
+    await netfilter.update_options()
+
+    assert netfilter.options.retry_window == 60
+
+
+async def test_netfilter_cluster_ban(async_memory_store):
+    """Banning in a cluster should publish once when the attempts reach the maximum."""
+    cluster = BanCluster(async_memory_store, AsyncMock())
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"), cluster=cluster)
+    other = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"), cluster=cluster)
+
+    for _ in range(netfilter.options.max_attempts // 2):
+        await netfilter.ban("1.2.3.4")
+        await other.ban("1.2.3.4")
+    await other.ban("1.2.3.4")
+
+    cluster.client.xadd.assert_called_once()
+    assert_that(cluster.client.xadd.call_args.args[1], has_entries(action="ban", net="1.2.3.4/32"))
+    assert netfilter.bans.banned() == []
+
+
+async def test_netfilter_cluster_ban_count(async_memory_store):
+    """Banning in a cluster should publish when coalesced attempts cross the maximum."""
+    cluster = BanCluster(async_memory_store, AsyncMock())
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"), cluster=cluster)
+
+    await netfilter.ban("1.2.3.4", netfilter.options.max_attempts - 1)
+    await netfilter.ban("1.2.3.4", 3)
+    await netfilter.ban("1.2.3.4", 3)
+
+    cluster.client.xadd.assert_called_once()
+
+
+async def test_netfilter_cluster_apply(async_memory_store):
+    """Applying decisions from the cluster should ban and unban locally."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"), cluster=Mock())
+    expires = round(time.time()) + 60
+
+    await netfilter.apply({"action": "ban", "net": "1.2.3.4/32", "expires": str(expires)})
+    assert netfilter.bans.banned_nets == {"1.2.3.4/32"}
+    assert netfilter.scheduler.expiries == {"1.2.3.4/32": expires}
+
+    await netfilter.apply({"action": "unban", "net": "1.2.3.4/32", "expires": "0"})
+    assert netfilter.bans.banned_nets == set()
+
+
+async def test_netfilter_cluster_reconcile(async_memory_store):
+    """Reconciling should apply the active bans from the store that did not expire."""
+    cluster = BanCluster(async_memory_store, AsyncMock(xrevrange=AsyncMock(return_value=[("1-0", {})])))
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"), cluster=cluster)
+    await async_memory_store.hset("F2B_ACTIVE_BANS", "1.2.3.4/32", round(time.time()) + 60)
+    await async_memory_store.hset("F2B_ACTIVE_BANS", "5.6.7.8/32", 1)
+
+    await netfilter.reconcile()
+
+    assert netfilter.bans.banned_nets == {"1.2.3.4/32"}
+    assert cluster.last_id == "1-0"
+
+
+async def test_netfilter_cluster_unban_queued(async_memory_store):
+    """Unbanning queued networks in a cluster should publish the unban decisions."""
+    cluster = BanCluster(async_memory_store, AsyncMock())
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"), cluster=cluster)
+    await async_memory_store.hset("F2B_QUEUE_UNBAN", "1.2.3.4/32", 1)
+
+    await netfilter.unban_queued()
+
+    assert_that(cluster.client.xadd.call_args.args[1], has_entries(action="unban", net="1.2.3.4/32"))
+    assert await async_memory_store.hgetall("F2B_QUEUE_UNBAN") == {}
+
+
+async def test_netfilter_cluster_clear(async_memory_store):
+    """Clearing in a cluster should keep the active bans in the store."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"), cluster=Mock())
+    await netfilter.apply_ban("1.2.3.4/32", round(time.time()) + 60)
+
+    await netfilter.clear()
+
+    assert netfilter.bans.banned() == []
+    assert_that(await async_memory_store.hgetall("F2B_ACTIVE_BANS"), has_key("1.2.3.4/32"))
+
+
+async def test_ban_cluster_receive():
+    """Receiving from the cluster should return the decisions after the last one read."""
+    client = AsyncMock(xread=AsyncMock(return_value=[["F2B_BANS", [("2-0", {"action": "ban"})]]]))
+    cluster = BanCluster(None, client, last_id="1-0")
+
+    assert await cluster.receive(timeout=1) == [{"action": "ban"}]
+    assert cluster.last_id == "2-0"
+    client.xread.assert_called_once_with({"F2B_BANS": "1-0"}, block=1000)
+
+
+def test_attempt_tracker_snapshot_restore():
+    """Restoring a snapshot should keep the attempts, their order and the bans."""
+    tracker = AttemptTracker()
+    tracker.attempt("1.2.3.4/32", 60, now=1)
+    tracker.attempt("5.6.7.8/32", 60, now=2)
+    tracker.ban("1.2.3.4/32")
+
+    restored = AttemptTracker()
+    restored.restore(tracker.snapshot())
+
+    assert list(restored.entries) == ["1.2.3.4/32", "5.6.7.8/32"]
+    assert restored.banned_nets == {"1.2.3.4/32"}
+    assert restored["5.6.7.8/32"].attempts == 1
+
+
+async def test_netfilter_snapshot_restore(async_memory_store):
+    """Restoring should bring back the bans, expiries and blacklist of the snapshot."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    await ban_addresses(netfilter, ["1.2.3.4"])
+    netfilter.blacklist = {"5.6.7.0/24"}
+    await netfilter.snapshot()
+
+    restored = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    assert await restored.restore() is True
+    assert restored.bans.banned_nets == {"1.2.3.4/32"}
+    assert restored.scheduler.expiries == netfilter.scheduler.expiries
+    assert restored.blacklist == {"5.6.7.0/24"}
+    assert await restored.restore() is False
+
+
+async def test_netfilter_restore_invalid(async_memory_store):
+    """Restoring an invalid snapshot should start from scratch."""
+    await async_memory_store.set("F2B_SNAPSHOT", "{}")
+    netfilter = Netfilter(async_memory_store, None, None)
+    assert await netfilter.restore() is False
+    assert len(netfilter.bans) == 0
+
+
+async def test_netfilter_sync_bans(async_memory_store, fake_nftables):
+    """Syncing bans should make the kernel set match the restored bans and blacklist."""
+    tables = NetfilterTables("MAIL", "mail", "ip", fake_nftables).init_chains()
+    tables.insert_mail_chains()
+    tables.ban("9.9.9.9", 60)
+    tables.ban("1.2.3.4", 60)
+    netfilter = Netfilter(async_memory_store, AsyncNetfilterTables(tables), make_tables("ip6"))
+    netfilter.blacklist = {"5.6.7.0/24"}
+    netfilter.scheduler.schedule("1.2.3.4/32", time.time() + 60)
+    netfilter.scheduler.schedule("8.8.8.8/32", time.time() + 60)
+
+    await netfilter.sync_bans()
+
+    elements = fake_nftables.elements["ip", "filter", "MAIL_BANS"]
+    assert elements.keys() == {"1.2.3.4/32", "8.8.8.8/32"}
+    assert tables.index.elements.keys() == elements.keys()
+    blacklist = fake_nftables.elements["ip", "filter", "MAIL_BLACKLIST"]
+    assert blacklist.keys() == {"5.6.7.0/24"}
+    assert tables.index.blacklist == blacklist.keys()
+
+
+def test_netfilter_tables_ban_in_blacklist(fake_nftables):
+    """Banning a network inside a blacklisted network should not conflict with it."""
+    tables = NetfilterTables("MAIL", "mail", "ip", fake_nftables).init_chains()
+    tables.insert_mail_chains()
+    tables.perm_ban("8.8.8.0/24")
+    tables.ban("8.8.8.8", 60)
+    assert fake_nftables.elements["ip", "filter", "MAIL_BANS"].keys() == {"8.8.8.8/32"}
+
+
+def test_netfilter_tables_unban_blacklisted(fake_nftables):
+    """Unbanning a blacklisted network should keep it in the blacklist set."""
+    tables = NetfilterTables("MAIL", "mail", "ip", fake_nftables).init_chains()
+    tables.insert_mail_chains()
+    tables.perm_ban("8.8.8.8")
+    tables.ban("8.8.8.8", 60)
+    assert tables.unban("8.8.8.8") is True
+    assert fake_nftables.elements["ip", "filter", "MAIL_BANS"] == {}
+    assert fake_nftables.elements["ip", "filter", "MAIL_BLACKLIST"].keys() == {"8.8.8.8/32"}
+
+
+async def test_netfilter_ban_blacklisted(async_memory_store):
+    """Banning an address inside a blacklisted network should skip it."""
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    netfilter.blacklist_matcher = NetworkMatcher.from_networks(["8.8.8.0/24"])
+    for _ in range(netfilter.options.max_attempts):
+        await netfilter.ban("8.8.8.8")
+
+    assert netfilter.bans.banned_nets == set()
+    netfilter.ipv4_tables.tables.nft.json_cmd.assert_not_called()
+
+
+async def test_netfilter_service_before_exit_warm_start():
+    """The service should save a snapshot instead of clearing on a warm start."""
+    netfilter = AsyncMock()
+    service = NetfilterService(netfilter, AsyncMock(), clear_before_exit=True, warm_start=True)
+    await service.before_exit()
+    netfilter.snapshot.assert_awaited_once_with()
+    netfilter.clear.assert_not_called()
+
+
 @pytest.mark.parametrize(
     "ban_counter, net_ban_time",
     [
@@ -71,6 +676,44 @@ def test_netfilter_calc_net_ban_time(ban_counter, net_ban_time):
     assert result == net_ban_time
 
 
+@pytest.mark.parametrize(
+    "message, expected",
+    [
+        ("mail UI: Invalid password for .+ by 1.2.3.4", ("1", "1.2.3.4")),
+        ("Rspamd UI: Invalid password by 1.2.3.4", ("2", "1.2.3.4")),
+        (
+            "warning: unknown[1.2.3.4]: SASL LOGIN authentication failed: UGFzc3dvcmQ6",
+            ("3", "1.2.3.4"),
+        ),
+        (
+            "warning: unknown[1.2.3.4]: SASL LOGIN authentication failed: Connection lost to authentication server",
+            None,
+        ),
+        ("imap-login: Aborted login by client (auth failed 1 attempts): user=<a>, rip=::1, lip=::2", ("7", "::1")),
+        ('1.2.3.4 "GET /SOGo/so/ HTTP/1.1" 403 123', ("10", "1.2.3.4")),
+        ("postfix/smtpd: connect from unknown[1.2.3.4]", None),
+    ],
+)
+def test_f2b_matcher_match(message, expected):
+    """Matching a message should return the rule id and the address."""
+    matcher = F2BMatcher.from_rules(F2B_REGEX)
+    assert matcher.match(message) == expected
+
+
+@pytest.mark.parametrize(
+    "rule_regex",
+    [
+        "(unbalanced",
+        "no address group",
+    ],
+)
+def test_f2b_matcher_invalid_rule(rule_regex):
+    """Building a matcher should skip invalid rules."""
+    matcher = F2BMatcher.from_rules({"1": rule_regex, "2": "by ([0-9.]+)"})
+    assert matcher.rules == {"2": "by ([0-9.]+)"}
+    assert matcher.match("by 1.2.3.4") == ("2", "1.2.3.4")
+
+
 def test_netfilter_tables_init_chains():
     """Initializing chains should set names with lowest priority."""
     nft = Mock(
@@ -146,12 +789,157 @@ def test_netfilter_tables_get_rule_handles():
     assert result == ["handle"]
 
 
+def test_netfilter_tables_insert_mail_chains():
+    """Inserting mail chains should create the ban set and the rule matching against it."""
+    nft = Mock(json_cmd=Mock(return_value=(0, {"nftables": []}, None)))
+    netfilter = NetfilterTables("MAIL", "mail", "ip", nft)
+    netfilter.insert_mail_chains()
+    commands = [call.args[0]["nftables"][1] for call in nft.json_cmd.call_args_list]
+    assert_that(
+        commands,
+        has_items(
+            has_entry("add", has_entry("set", has_entries(name="MAIL_BANS", type="ipv4_addr"))),
+            has_entry("insert", has_entry("rule", has_entries(chain="MAIL", comment="mail bans"))),
+            has_entry("add", has_entry("set", has_entries(name="MAIL_BLACKLIST", flags=["interval"]))),
+            has_entry("insert", has_entry("rule", has_entries(chain="MAIL", comment="mail blacklist"))),
+        ),
+    )
+
+
 def test_netfilter_tables_ban():
-    """Banning should insert a filter rule."""
-    netfilter = NetfilterTables(None, None, "family")
-    with patch.object(NetfilterTables, "insert_rule") as insert_rule:
-        netfilter.ban("127.0.0.1")
-        insert_rule.assert_called_once_with("filter", netfilter.name, ANY)
+    """Banning should add an element to the ban set."""
+    nft = Mock(json_cmd=Mock(return_value=(0, "", None)))
+    netfilter = NetfilterTables("MAIL", None, "ip", nft)
+    netfilter.ban("1.2.3.4/32")
+    nft.json_cmd.assert_called_once_with(
+        {
+            "nftables": [
+                {
+                    "metainfo": {
+                        "json_schema_version": 1,
+                    },
+                },
+                {
+                    "add": {
+                        "element": {
+                            "family": "ip",
+                            "table": "filter",
+                            "name": "MAIL_BANS",
+                            "elem": [
+                                {
+                                    "prefix": {
+                                        "addr": "1.2.3.4",
+                                        "len": 32,
+                                    },
+                                },
+                            ],
+                        },
+                    },
+                },
+            ]
+        }
+    )
+
+
+def test_netfilter_tables_ban_timeout():
+    """Banning with a timeout should let the kernel expire the element."""
+    nft = Mock(json_cmd=Mock(return_value=(0, "", None)))
+    netfilter = NetfilterTables("MAIL", None, "ip", nft)
+    netfilter.ban("1.2.3.0/24", 60)
+    command = nft.json_cmd.call_args.args[0]["nftables"][1]
+    assert command["add"]["element"]["elem"] == [
+        {
+            "elem": {
+                "val": {"prefix": {"addr": "1.2.3.0", "len": 24}},
+                "timeout": 60,
+            },
+        },
+    ]
+
+
+def test_netfilter_tables_unban():
+    """Unbanning should delete the element from the ban set."""
+    nft = Mock(json_cmd=Mock(return_value=(0, "", None)))
+    netfilter = NetfilterTables("MAIL", None, "ip6", nft)
+    netfilter.ban("2001:db8::1/128")
+    netfilter.unban("2001:db8::1/128")
+    command = nft.json_cmd.call_args.args[0]["nftables"][1]
+    assert command == {
+        "delete": {
+            "element": {
+                "family": "ip6",
+                "table": "filter",
+                "name": "MAIL_BANS",
+                "elem": [{"prefix": {"addr": "2001:db8::1", "len": 128}}],
+            },
+        },
+    }
+
+
+def test_netfilter_tables_unban_unknown():
+    """Unbanning a network that was never banned should not run a command."""
+    nft = Mock(json_cmd=Mock(return_value=(0, "", None)))
+    netfilter = NetfilterTables("MAIL", None, "ip", nft)
+    assert netfilter.unban("1.2.3.4") is False
+    nft.json_cmd.assert_not_called()
+
+
+def test_netfilter_tables_get_rule_handles_echo():
+    """Getting rule handles should use the handles echoed when inserting rules."""
+    nft = Mock(json_cmd=Mock(return_value=(0, {"nftables": [{"chain": {"table": "filter", "name": "chain"}}]}, None)))
+    netfilter = NetfilterTables(None, None, "family", nft)
+    netfilter.list_chain(table="filter", name="chain")
+
+    rule = {"family": "family", "table": "filter", "chain": "chain", "comment": "comment", "handle": 3}
+    nft.json_cmd.return_value = (0, {"nftables": [{"insert": {"rule": rule}}]}, None)
+    netfilter.insert_rule("filter", "chain", [], comment="comment")
+
+    nft.json_cmd.reset_mock()
+    result = netfilter.get_rule_handles("filter", "chain", "comment")
+    assert result == [3]
+    nft.json_cmd.assert_not_called()
+
+
+def test_netfilter_tables_sync_index():
+    """Syncing the index should forget chains that were recreated in the kernel."""
+    chain = {"family": "family", "table": "filter", "name": "chain", "handle": 1}
+    nft = Mock(json_cmd=Mock(return_value=(0, {"nftables": [{"chain": chain}]}, None)))
+    netfilter = NetfilterTables(None, None, "family", nft)
+    netfilter.list_chain(table="filter", name="chain")
+
+    nft.json_cmd.return_value = (0, {"nftables": [{"chain": {**chain, "handle": 2}}]}, None)
+    netfilter.sync_index()
+
+    assert netfilter.get_chain_handle("filter", "chain") == 2
+
+
+def test_netfilter_tables_check_index(fake_nftables):
+    """Checking the chain order should answer from the index until the base chains are forgotten."""
+    tables = NetfilterTables("MAIL", "mail", "ip", fake_nftables).init_chains()
+    tables.insert_mail_chains()
+    assert tables.check("input") == 0
+
+    # Docker inserts a rule without the index seeing it.
+    fake_nftables.insert_rule({"family": "ip", "table": "filter", "chain": "INPUT", "expr": []}, [])
+    with patch.object(fake_nftables, "json_cmd", wraps=fake_nftables.json_cmd) as json_cmd:
+        assert tables.check("input") == 0
+        json_cmd.assert_not_called()
+
+        tables.forget_base_rules()
+        assert tables.check("input") == 1
+        json_cmd.assert_called_once()
+
+
+def test_netfilter_tables_snat_index(fake_nftables):
+    """Checking the SNAT rule again should answer from the index."""
+    tables = NetfilterTables("MAIL", "mail", "ip", fake_nftables).init_chains()
+    tables.snat("1.2.3.4", "172.22.1.0/24")
+    with patch.object(fake_nftables, "json_cmd", wraps=fake_nftables.json_cmd) as json_cmd:
+        tables.snat("1.2.3.4", "172.22.1.0/24")
+        json_cmd.assert_not_called()
+
+    tables.snat("5.6.7.8", "172.22.1.0/24")
+    assert fake_nftables.rules["ip", "nat", "POSTROUTING"] == []
 
 
 def test_netfilter_tables_flush_chain():
@@ -299,10 +1087,59 @@ def test_netfilter_tables_run_cmd():
     )
 
 
-async def test_netfilter_update_blacklist(redis_store):
+def test_netfilter_tables_batch():
+    """Running commands in a batch should submit them in a single transaction."""
+    nft = Mock(json_cmd=Mock(return_value=(0, "", None)))
+    netfilter = NetfilterTables("MAIL", None, "ip", nft)
+    with netfilter.batch():
+        netfilter.ban("1.2.3.4")
+        netfilter.unban("1.2.3.4")
+        nft.json_cmd.assert_not_called()
+
+    nft.json_cmd.assert_called_once()
+    commands = nft.json_cmd.call_args.args[0]["nftables"]
+    assert_that(commands[1:], contains_exactly(has_key("add"), has_key("delete")))
+
+
+def test_netfilter_tables_batch_list():
+    """Listing in a batch should run immediately."""
+    nft = Mock(json_cmd=Mock(return_value=(0, {"nftables": []}, None)))
+    netfilter = NetfilterTables("MAIL", None, "ip", nft)
+    with netfilter.batch():
+        netfilter.ban("1.2.3.4")
+        netfilter.list_chains()
+        nft.json_cmd.assert_called_once()
+
+    assert nft.json_cmd.call_count == 2
+
+
+def test_netfilter_tables_batch_error():
+    """Raising in a batch should discard the pending commands."""
+    nft = Mock(json_cmd=Mock(return_value=(0, "", None)))
+    netfilter = NetfilterTables("MAIL", None, "ip", nft)
+    with pytest.raises(ValueError), netfilter.batch():
+        netfilter.ban("1.2.3.4")
+        raise ValueError
+
+    nft.json_cmd.assert_not_called()
+
+
+def test_netfilter_tables_batch_nested():
+    """Nesting batches should submit the commands when the outer batch exits."""
+    nft = Mock(json_cmd=Mock(return_value=(0, "", None)))
+    netfilter = NetfilterTables("MAIL", None, "ip", nft)
+    with netfilter.batch():
+        with netfilter.batch():
+            netfilter.ban("1.2.3.4")
+        netfilter.ban("5.6.7.8")
+
+    nft.json_cmd.assert_called_once()
+
+
+async def test_netfilter_update_blacklist(async_redis_store):
     """Updating the blacklist should get from F2B_BLACKLIST."""
-    redis_store.hset("F2B_BLACKLIST", "127.0.0.1", 1)
-    netfilter = Netfilter(redis_store, None, None)
+    await async_redis_store.hset("F2B_BLACKLIST", "127.0.0.1", 1)
+    netfilter = Netfilter(async_redis_store, make_tables("ip"), make_tables("ip6"))
     assert netfilter.whitelist == set()
 
     with patch.object(Netfilter, "perm_ban", new_callable=AsyncMock) as perm_ban:
@@ -312,19 +1149,184 @@ async def test_netfilter_update_blacklist(redis_store):
     assert netfilter.blacklist == {"127.0.0.1"}
 
 
-async def test_netfilter_update_whitelist(redis_store):
+async def test_netfilter_update_blacklist_covering_bans(async_memory_store, fake_nftables):
+    """Blacklisting a network should unban the banned networks it covers in the same transaction."""
+    tables = NetfilterTables("MAIL", "mail", "ip", fake_nftables).init_chains()
+    tables.insert_mail_chains()
+    netfilter = Netfilter(async_memory_store, AsyncNetfilterTables(tables), make_tables("ip6"))
+    await ban_addresses(netfilter, ["8.8.8.8", "9.9.9.9"])
+    await async_memory_store.hset("F2B_BLACKLIST", "8.8.8.0/24", 1)
+
+    await netfilter.update_blacklist()
+
+    assert netfilter.bans.banned_nets == {"9.9.9.9/32"}
+    assert fake_nftables.elements["ip", "filter", "MAIL_BANS"].keys() == {"9.9.9.9/32"}
+    assert fake_nftables.elements["ip", "filter", "MAIL_BLACKLIST"].keys() == {"8.8.8.0/24"}
+    assert netfilter.blacklist == {"8.8.8.0/24"}
+
+
+async def test_netfilter_update_blacklist_error(async_memory_store):
+    """Failing to update the blacklist should try again on the next update."""
+    await async_memory_store.hset("F2B_BLACKLIST", "8.8.8.0/24", 1)
+    netfilter = Netfilter(async_memory_store, make_tables("ip"), make_tables("ip6"))
+    netfilter.ipv4_tables.tables.nft.json_cmd.return_value = (1, "", "Error")
+
+    with pytest.raises(NetfilterError):
+        await netfilter.update_blacklist()
+
+    assert netfilter.blacklist == set()
+    assert netfilter.ipv4_tables.tables.index.blacklist == set()
+
+
+async def test_netfilter_update_whitelist(async_redis_store):
     """Updating the whitelist should get from F2B_WHITELIST."""
-    redis_store.hset("F2B_WHITELIST", "127.0.0.1", 1)
-    netfilter = Netfilter(redis_store, None, None)
+    await async_redis_store.hset("F2B_WHITELIST", "127.0.0.1", 1)
+    netfilter = Netfilter(async_redis_store, None, None)
     assert netfilter.whitelist == set()
 
     await netfilter.update_whitelist()
     assert netfilter.whitelist == {"127.0.0.1"}
+    assert netfilter.whitelist_matcher.lookup("127.0.0.1")
+
+
+async def test_async_netfilter_tables_run():
+    """Running a command should return the result from the executor."""
+    tables = make_tables()
+    assert await tables.ban("1.2.3.4") is True
+    assert tables.tables.index.elements.keys() == {"1.2.3.4/32"}
+
+
+async def test_async_netfilter_tables_batch():
+    """Running commands in a batch should submit them in a single transaction."""
+    tables = make_tables()
+    async with tables.batch():
+        await tables.ban("1.2.3.4")
+        await tables.ban("5.6.7.8")
+        tables.tables.nft.json_cmd.assert_not_called()
+
+    tables.tables.nft.json_cmd.assert_called_once()
+
+
+async def test_async_netfilter_tables_batch_other_task(fake_nftables):
+    """Commands run by other tasks while a batch awaits should not join it."""
+    tables = NetfilterTables("MAIL", "mail", "ip", fake_nftables).init_chains()
+    tables.insert_mail_chains()
+    tables = AsyncNetfilterTables(tables)
+    waiting, banned = asyncio.Event(), asyncio.Event()
+
+    async def rolled_back():
+        async with tables.batch():
+            await tables.ban("1.2.3.4", 60)
+            waiting.set()
+            await banned.wait()
+            raise ValueError
+
+    task = asyncio.create_task(rolled_back())
+    await waiting.wait()
+    await tables.ban("9.9.9.9", 60)
+    banned.set()
+    with pytest.raises(ValueError):
+        await task
+
+    assert fake_nftables.elements["ip", "filter", "MAIL_BANS"].keys() == {"9.9.9.9/32"}
+    assert tables.tables.index.elements.keys() == {"9.9.9.9/32"}
+
+
+def test_netfilter_tables_batch_error_index(fake_nftables):
+    """Failing to commit a batch should undo its changes to the index."""
+    tables = NetfilterTables("MAIL", "mail", "ip", fake_nftables).init_chains()
+    tables.insert_mail_chains()
+    tables.ban("1.2.3.4")
+    with pytest.raises(NetfilterError), tables.batch():
+        tables.unban("1.2.3.4")
+        tables.ban("5.6.7.8")
+        tables.perm_ban("1.2.3.0/24")
+        tables.perm_ban("1.2.3.4")
+
+    assert tables.index.elements.keys() == {"1.2.3.4/32"}
+    assert tables.index.blacklist == set()
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        ('{"add": {"rule": {"family": "ip", "table": "filter", "chain": "INPUT"}}}', True),
+        ('{"delete": {"chain": {"family": "ip6", "table": "nat", "name": "POSTROUTING"}}}', True),
+        ('{"add": {"table": {"family": "ip", "name": "filter"}}}', True),
+        ('{"add": {"rule": {"family": "ip", "table": "filter", "chain": "MAIL"}}}', False),
+        ('{"add": {"rule": {"family": "inet", "table": "filter", "chain": "INPUT"}}}', False),
+        ('{"add": {"rule": {"family": "ip", "table": "mangle", "chain": "INPUT"}}}', False),
+        ('{"add": {"element": {"family": "ip", "table": "filter", "name": "MAIL_BANS"}}}', False),
+        ('{"metainfo": {"version": "1.0.9"}}', False),
+        ("invalid", False),
+    ],
+)
+def test_ruleset_monitor_is_relevant(line, expected):
+    """Only changes to the checked tables outside the ignored chains should be relevant."""
+    monitor = RulesetMonitor(ignore_chains={"MAIL"})
+    assert monitor.is_relevant(line) is expected
+
+
+async def test_ruleset_monitor_run():
+    """Running the monitor should notify the subscribers of relevant changes."""
+    line = '{"add": {"rule": {"family": "ip", "table": "filter", "chain": "INPUT"}}}'
+    listener = AsyncMock()
+    monitor = RulesetMonitor(command=(sys.executable, "-c", f"print({line!r})"), listeners=[listener])
+    changed = monitor.subscribe()
+
+    await monitor.run()
+
+    assert changed.is_set()
+    assert monitor.running is False
+    listener.assert_awaited_once_with({("ip", "filter", "INPUT")})
+
+
+async def test_ruleset_monitor_run_missing():
+    """Running the monitor without nft should fall back to polling."""
+    monitor = RulesetMonitor(command=("/nonexistent/nft",))
+    await monitor.run()
+    assert monitor.running is False
+
+
+async def test_ruleset_monitor_wait():
+    """Waiting should return early on a change and clear it."""
+    monitor = RulesetMonitor(running=True, debounce=0)
+    changed = monitor.subscribe()
+    changed.set()
+
+    assert await asyncio.wait_for(monitor.wait(changed, 10, 10), 1) is True
+    assert not changed.is_set()
+
+
+async def test_ruleset_monitor_wait_timeout():
+    """Waiting should tell when changes may have gone unnoticed."""
+    monitor = RulesetMonitor(debounce=0)
+    changed = monitor.subscribe()
+    assert await monitor.wait(changed, 0, 10) is False
+
+
+async def test_netfilter_forget_rules():
+    """Forgetting changed chains should forget their rules in the tables of their family."""
+    netfilter = Netfilter(None, AsyncMock(), AsyncMock())
+    await netfilter.forget_rules({("ip6", "nat", "POSTROUTING")})
+    netfilter.ipv4_tables.forget_rules.assert_not_called()
+    netfilter.ipv6_tables.forget_rules.assert_awaited_once_with("nat", "POSTROUTING")
+
+
+async def test_netfilter_service_chain_order_polled():
+    """Checking the chain order after polling should forget the base chains first."""
+    netfilter = AsyncMock()
+    service = NetfilterService(netfilter, None)
+    netfilter.chain_order.side_effect = lambda: service.stop_event.set()
+
+    await service.chain_order(0)
+
+    netfilter.forget_base_rules.assert_awaited_once()
 
 
 async def test_netfilter_service_snat4():
     """Calling the service snat4 should call on the ipv4 tables."""
-    netfilter = Mock(lock=AsyncMock())
+    netfilter = AsyncMock()
     service = NetfilterService(netfilter, None)
 
     netfilter.ipv4_tables.snat.side_effect = lambda *_: service.stop_event.set()
@@ -336,7 +1338,7 @@ async def test_netfilter_service_snat4():
 
 async def test_netfilter_service_snat6():
     """Calling the service snat6 should call on the ipv6 tables."""
-    netfilter = Mock(lock=AsyncMock())
+    netfilter = AsyncMock()
     service = NetfilterService(netfilter, None)
 
     netfilter.ipv6_tables.snat.side_effect = lambda *_: service.stop_event.set()
@@ -358,6 +1360,34 @@ async def test_netfilter_service_autopurge():
     netfilter.autopurge.assert_called_once()
 
 
+async def test_netfilter_service_unban():
+    """Calling the service unban should poll the unban queue."""
+    netfilter = AsyncMock()
+    service = NetfilterService(netfilter, None)
+
+    netfilter.unban_queued.side_effect = lambda: netfilter.unban_queued.call_count > 2 and service.stop_event.set()
+    await asyncio.wait_for(service.unban(0.01), 1)
+
+    assert netfilter.unban_queued.call_count == 3
+
+
+async def test_netfilter_service_blacklist_error():
+    """An error updating the blacklist should be logged without stopping the service."""
+    netfilter = AsyncMock()
+    service = NetfilterService(netfilter, None)
+
+    def update_blacklist():
+        if netfilter.update_blacklist.call_count == 1:
+            raise NetfilterError("error")
+        service.stop_event.set()
+
+    netfilter.update_blacklist.side_effect = update_blacklist
+    await service.blacklist(0.01)
+
+    assert netfilter.update_blacklist.call_count == 2
+    assert service.exit_code == 0
+
+
 async def test_netfilter_service_whitelist():
     """Calling the service whitelist should update the netfilter whitelist."""
     netfilter = AsyncMock()
@@ -401,7 +1431,7 @@ async def test_netfilter_service_watch(memory_queue):
     netfilter = AsyncMock()
     service = NetfilterService(netfilter, memory_queue)
 
-    netfilter.ban.side_effect = lambda _: service.stop_event.set()
+    netfilter.ban_all.side_effect = lambda *_: service.stop_event.set()
     await memory_queue.publish(
         "F2B_CHANNEL",
         "mail UI: Invalid password for .+ by 1.2.3.4",
@@ -409,7 +1439,221 @@ async def test_netfilter_service_watch(memory_queue):
 
     await service.watch()
 
-    netfilter.ban.assert_called_once()
+    netfilter.ban_all.assert_called_once_with(["1.2.3.4"])
+
+
+async def test_netfilter_service_match_messages():
+    """Matching queued messages should pass the matched addresses to the ban applier."""
+    service = NetfilterService(AsyncMock(), None)
+    service.messages.put_nowait("unrelated")
+    service.messages.put_nowait("mail UI: Invalid password for .+ by 1.2.3.4")
+
+    worker = asyncio.create_task(service.match_messages())
+    await service.messages.join()
+    worker.cancel()
+
+    assert service.hits.get_nowait() == "1.2.3.4"
+    assert service.hits.empty()
+
+
+async def test_netfilter_service_apply_hits():
+    """Applying hits should ban at once from the hits in the window."""
+    netfilter = AsyncMock()
+    service = NetfilterService(netfilter, None, coalesce_window=0)
+    for addr in ["1.2.3.4", "5.6.7.8", "1.2.3.4"]:
+        service.hits.put_nowait(addr)
+
+    worker = asyncio.create_task(service.apply_hits())
+    await service.hits.join()
+    worker.cancel()
+
+    netfilter.ban_all.assert_called_once_with(["1.2.3.4", "5.6.7.8", "1.2.3.4"])
+
+
+async def test_netfilter_service_apply_hits_error():
+    """Failing to apply hits should stop the service."""
+    netfilter = AsyncMock()
+    netfilter.ban_all.side_effect = NetfilterError("nft failed")
+    service = NetfilterService(netfilter, None, coalesce_window=0)
+    service.hits.put_nowait("1.2.3.4")
+
+    worker = asyncio.create_task(service.apply_hits())
+    await service.hits.join()
+    worker.cancel()
+
+    assert service.stop_event.is_set()
+    assert service.exit_code == 2
+
+
+async def test_netfilter_service_enqueue_drop():
+    """Enqueuing in a full queue with the drop policy should drop the new message."""
+    service = NetfilterService(AsyncMock(), None, queue_size=1, queue_policy="drop")
+    dropped = registry.get_sample_value("netfilter_dropped_messages_total") or 0
+
+    await service.enqueue("first")
+    await service.enqueue("second")
+
+    assert service.messages.get_nowait() == "first"
+    assert registry.get_sample_value("netfilter_dropped_messages_total") == dropped + 1
+    assert registry.get_sample_value("netfilter_ingest_queue_depth") == 1
+
+
+async def test_netfilter_service_enqueue_sample():
+    """Enqueuing in a full queue with the sample policy should keep one in sample_rate messages."""
+    service = NetfilterService(AsyncMock(), None, queue_size=1, queue_policy="sample", sample_rate=2)
+
+    for message in ["first", "second", "third"]:
+        await service.enqueue(message)
+
+    assert service.messages.get_nowait() == "third"
+
+
+def test_netfilter_service_from_env_queue_policy():
+    """Making the service from an unknown queue policy should raise."""
+    with pytest.raises(ValueError):
+        NetfilterService.from_env(AsyncMock(), {"NETFILTER_QUEUE_POLICY": "unknown"})
+
+
+async def test_f2b_stream_subscribe():
+    """Subscribing should create the consumer group at the end of the stream."""
+    client = AsyncMock()
+    await F2BStream(client).subscribe()
+    client.xgroup_create.assert_awaited_once_with("F2B_STREAM", "netfilter", id="$", mkstream=True)
+
+
+async def test_f2b_stream_subscribe_existing_group():
+    """Subscribing should ignore a consumer group that already exists."""
+    client = AsyncMock()
+    client.xgroup_create.side_effect = ResponseError("BUSYGROUP Consumer Group name already exists")
+    await F2BStream(client).subscribe()
+
+
+async def test_f2b_stream_receive_pending_first():
+    """Receiving should read pending entries before new entries."""
+    client = AsyncMock()
+    client.xreadgroup.side_effect = [
+        [["F2B_STREAM", [("1-0", {"message": "pending"})]]],
+        [["F2B_STREAM", []]],
+        [["F2B_STREAM", [("2-0", {"message": "new"})]]],
+    ]
+    stream = F2BStream(client, consumer="test")
+
+    assert await stream.receive() == [("1-0", "pending")]
+    assert await stream.receive() == []
+    assert await stream.receive(timeout=1) == [("2-0", "new")]
+    assert [c.args[2] for c in client.xreadgroup.call_args_list] == [
+        {"F2B_STREAM": "0"},
+        {"F2B_STREAM": "0"},
+        {"F2B_STREAM": ">"},
+    ]
+
+
+async def test_f2b_stream_receive_claim():
+    """Receiving should claim the entries left pending for longer than the claim interval."""
+    client = AsyncMock()
+    client.xreadgroup.return_value = [["F2B_STREAM", []]]
+    client.xautoclaim.side_effect = [
+        ["2-0", [("1-0", {"message": "failed"})], []],
+        ["0-0", [("2-0", {"message": "other"})], []],
+    ]
+    stream = F2BStream(client, consumer="test", claim_interval=0)
+
+    assert await stream.receive() == []
+    assert await stream.receive() == [("1-0", "failed")]
+    assert await stream.receive() == [("2-0", "other")]
+    assert [c.args[4] for c in client.xautoclaim.call_args_list] == ["0-0", "2-0"]
+    client.xautoclaim.assert_awaited_with("F2B_STREAM", "netfilter", "test", 0, "2-0", count=100)
+
+
+async def test_f2b_stream_ack():
+    """Acknowledging should send all the entry ids in a single command."""
+    client = AsyncMock()
+    await F2BStream(client).ack(["1-0", "2-0"])
+    client.xack.assert_called_once_with("F2B_STREAM", "netfilter", "1-0", "2-0")
+
+
+async def test_netfilter_service_watch_stream():
+    """Watching a stream should ban on matches through the queue and acknowledge the batch."""
+    netfilter = AsyncMock()
+    stream = AsyncMock(receive=AsyncMock(return_value=[
+        ("1-0", "mail UI: Invalid password for .+ by 1.2.3.4"),
+        ("2-0", "unrelated"),
+    ]))
+    service = NetfilterService(netfilter, None, stream=stream, coalesce_window=0)
+    stream.ack.side_effect = lambda _: service.stop_event.set()
+
+    await service.watch()
+
+    netfilter.ban_all.assert_called_once_with(["1.2.3.4"])
+    stream.ack.assert_called_once_with(["1-0", "2-0"])
+
+
+async def test_netfilter_service_watch_stream_drop():
+    """Watching a stream should apply the queue policy to its entries."""
+    netfilter = AsyncMock()
+    stream = AsyncMock(receive=AsyncMock(return_value=[
+        ("1-0", "mail UI: Invalid password for .+ by 1.2.3.4"),
+        ("2-0", "mail UI: Invalid password for .+ by 5.6.7.8"),
+    ]))
+    service = NetfilterService(netfilter, None, stream=stream, queue_size=1, queue_policy="drop", coalesce_window=0)
+    stream.ack.side_effect = lambda _: service.stop_event.set()
+    dropped = registry.get_sample_value("netfilter_dropped_messages_total") or 0
+
+    await service.watch()
+
+    netfilter.ban_all.assert_called_once_with(["1.2.3.4"])
+    assert registry.get_sample_value("netfilter_dropped_messages_total") == dropped + 1
+
+
+async def test_netfilter_service_watch_stream_error():
+    """Watching a stream should not acknowledge a batch when a ban fails."""
+    netfilter = AsyncMock()
+    netfilter.ban_all.side_effect = NetfilterError("failed")
+    stream = AsyncMock(receive=AsyncMock(return_value=[
+        ("1-0", "mail UI: Invalid password for .+ by 1.2.3.4"),
+    ]))
+    service = NetfilterService(netfilter, None, stream=stream, coalesce_window=0)
+
+    await service.watch()
+
+    stream.ack.assert_not_called()
+    assert service.exit_code == 2
+
+
+def test_netfilter_service_match_metrics():
+    """Matching a message should count it and its matching rule."""
+    service = NetfilterService(AsyncMock(), None)
+    consumed = registry.get_sample_value("netfilter_consumed_messages_total") or 0
+    matches = registry.get_sample_value("netfilter_rule_matches_total", {"rule": "1"}) or 0
+
+    service.match("unrelated")
+    service.match("mail UI: Invalid password for .+ by 10.0.0.1")
+
+    assert registry.get_sample_value("netfilter_consumed_messages_total") == consumed + 2
+    assert registry.get_sample_value("netfilter_rule_matches_total", {"rule": "1"}) == matches + 1
+
+
+def test_netfilter_tables_nft_metrics():
+    """Running nft commands should observe their time per operation."""
+    nft = Mock(json_cmd=Mock(return_value=(0, {"nftables": []}, None)))
+    tables = NetfilterTables("MAIL", "mail", "ip", nft)
+    count = registry.get_sample_value("netfilter_nft_seconds_count", {"operation": "transaction"}) or 0
+
+    with tables.batch():
+        tables.ban("1.2.3.4")
+        tables.ban("5.6.7.8")
+
+    assert registry.get_sample_value("netfilter_nft_seconds_count", {"operation": "transaction"}) == count + 1
+
+
+async def test_netfilter_service_update_f2bregex(async_memory_store):
+    """Updating the fail2ban rules should add the rules from F2B_REGEX."""
+    await async_memory_store.hset("F2B_REGEX", "custom", "Custom failure from ([0-9.]+)")
+    service = NetfilterService(Mock(store=async_memory_store), None)
+
+    await service.update_f2bregex()
+
+    assert service.matcher.match("Custom failure from 1.2.3.4") == ("custom", "1.2.3.4")
 
 
 @patch("sys.stdout")
@@ -0,0 +1,369 @@
+"""Unit tests for the store module."""
+
+from unittest.mock import ANY, MagicMock, Mock, call, patch
+
+import pytest
+from prometheus_client import REGISTRY
+from pymemcache.test.utils import MockMemcacheClient
+from redis.client import Pipeline
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import ResponseError
+
+from taramail.store import (
+    CachedStore,
+    InstrumentedStore,
+    MemcachedHash,
+    MemcachedStore,
+    MemoryStore,
+    RedisStore,
+    Store,
+    StoreConflictError,
+    key_prefix,
+)
+
+
+@pytest.fixture
+def cached_store():
+    return CachedStore(MemoryStore(), keys=["HOT"], ttl=60)
+
+
+def test_cached_store_from_url():
+    """Making a store from a cached URL should wrap the store of the other scheme."""
+    store = Store.from_url("cached+memory:/?ttl=1&max_size=10&keys=A,B")
+    assert isinstance(store.store, MemoryStore)
+    assert store.keys == {"A", "B"}
+    assert store.max_size == 10
+    assert store.ttl == 1
+
+
+def test_cached_store_from_url_store_query():
+    """Making a store from a cached URL should pass the query to the store behind the cache."""
+    store = Store.from_url("cached+memory:/?ttl=1&max_entries=5")
+    assert store.store.max_entries == 5
+    assert store.ttl == 1
+
+
+def test_redis_store_pipeline():
+    """The Redis pipeline of a store should keep the options of redis-py."""
+    pipe = RedisStore.from_host("localhost").pipeline(transaction=False)
+    assert isinstance(pipe, Pipeline)
+    assert not pipe.transaction
+
+
+@pytest.mark.parametrize("error, expected", [
+    (ResponseError("WRONGTYPE Operation against a key holding the wrong kind of value"), TypeError),
+    (ResponseError("ERR value is not an integer or out of range"), ResponseError),
+])
+def test_redis_store_batch_error(error, expected):
+    """Executing a batch should only turn the results of the wrong type into type errors."""
+    store = RedisStore.from_host("localhost")
+    pipe = MagicMock(execute=Mock(return_value=["1", error]))
+    with patch.object(store, "pipeline", return_value=pipe), pytest.raises(expected):
+        store.batch().get("a").incr("b").execute()
+
+    pipe.execute.assert_called_once_with(raise_on_error=False)
+
+
+def test_cached_store_hget(cached_store):
+    """Getting a field of a cached hash should not read the store again."""
+    cached_store.store.hset("HOT", "a", "1")
+    assert cached_store.hget("HOT", "a") == "1"
+
+    cached_store.store.hset("HOT", "a", "2")
+    assert cached_store.hget("HOT", "a") == "1"
+    assert cached_store.hmget("HOT", "a", "b") == ["1", None]
+
+
+def test_cached_store_uncached_key(cached_store):
+    """Getting a key that is not cached should read the store."""
+    cached_store.store.set("COLD", "1")
+    assert cached_store.get("COLD") == "1"
+
+    cached_store.store.set("COLD", "2")
+    assert cached_store.get("COLD") == "2"
+    assert cached_store.entries == {}
+
+
+def test_cached_store_write_through(cached_store):
+    """Writing a cached key should write to the store and invalidate the key."""
+    assert cached_store.hgetall("HOT") == {}
+
+    cached_store.hset("HOT", "a", "1")
+
+    assert cached_store.store.hget("HOT", "a") == "1"
+    assert cached_store.hgetall("HOT") == {"a": "1"}
+
+
+def test_cached_store_batch(cached_store):
+    """Writing a cached key in a batch should invalidate the key."""
+    cached_store.hset("HOT", "a", "1")
+    assert cached_store.hkeys("HOT") == ["a"]
+
+    with cached_store.batch() as pipe:
+        pipe.hdel("HOT", "a")
+
+    assert cached_store.hkeys("HOT") == []
+
+
+def test_cached_store_expires(cached_store):
+    """Getting an expired key should read the store again."""
+    cached_store.ttl = 0
+    cached_store.store.set("HOT", "1")
+    assert cached_store.get("HOT") == "1"
+
+    cached_store.store.set("HOT", "2")
+    assert cached_store.get("HOT") == "2"
+
+
+def test_cached_store_evicts_least_recently_read():
+    """Caching more keys than the maximum should evict the least recently read."""
+    cached_store = CachedStore(MemoryStore(), keys=["A", "B", "C"], max_size=2, ttl=60)
+    for key in ["A", "B", "A", "C"]:
+        cached_store.get(key)
+
+    assert list(cached_store.entries) == [("A", "string"), ("C", "string")]
+
+
+def test_cached_store_wrong_type(cached_store):
+    """Getting a cached hash as a string should raise a TypeError."""
+    cached_store.hset("HOT", "a", "1")
+    cached_store.hgetall("HOT")
+    with pytest.raises(TypeError):
+        cached_store.get("HOT")
+
+
+def test_cached_store_listen():
+    """Listening should track the cached keys and invalidate those broadcast by Redis."""
+    listener = Mock(
+        can_read=Mock(side_effect=[True, True, RedisConnectionError()]),
+        read_response=Mock(side_effect=[
+            42,
+            ["subscribe", "__redis__:invalidate", 1],
+            ["message", "__redis__:invalidate", ["HOT"]],
+            ["message", "__redis__:invalidate", None],
+        ]),
+    )
+    tracker = Mock()
+    pool = Mock(connection_class=Mock(side_effect=[listener, tracker]), connection_kwargs={})
+    cached_store = CachedStore(Mock(connection_pool=pool), keys=["HOT", "OTHER"])
+
+    with (
+        patch.object(CachedStore, "invalidate") as invalidate,
+        patch.object(CachedStore, "clear") as clear,
+        pytest.raises(RedisConnectionError),
+    ):
+        cached_store.listen()
+
+    tracker.send_command.assert_called_once_with(
+        "CLIENT", "TRACKING", "ON", "REDIRECT", 42, "BCAST", "PREFIX", "HOT", "PREFIX", "OTHER", check_health=False
+    )
+    invalidate.assert_called_once_with("HOT")
+    assert clear.call_count == 2
+    listener.disconnect.assert_called_once_with()
+    tracker.disconnect.assert_called_once_with()
+
+
+def test_memcached_hash_encode():
+    """Decoding an encoded Memcached hash should return the same hash."""
+    data = MemcachedHash({"a": "1", "é": ""}, expires=1234, sharded=True)
+    assert MemcachedHash.decode(data.encode()) == data
+
+
+def test_memcached_hash_decode_json():
+    """Decoding a JSON dict should read the legacy encoding of hashes."""
+    assert MemcachedHash.decode(b'{"a": "1"}') == MemcachedHash({"a": "1"})
+
+
+@pytest.mark.parametrize("payload", [b"1", b"[1]", b"text"])
+def test_memcached_hash_decode_wrong_type(payload):
+    """Decoding a value that is not a hash should raise."""
+    with pytest.raises(TypeError):
+        MemcachedHash.decode(payload)
+
+
+def test_memcached_store_hset_conflict():
+    """Setting a field should retry when the hash changed concurrently."""
+    client = Mock(gets=Mock(return_value=(MemcachedHash().encode(), b"1")))
+    client.cas.side_effect = [False, True]
+    store = MemcachedStore(client)
+    assert store.hset("key", "a", "1") == 1
+    assert client.cas.call_count == 2
+
+
+def test_memcached_store_hset_conflict_error():
+    """Setting a field should give up after too many conflicts."""
+    client = Mock(gets=Mock(return_value=(None, None)))
+    client.add.return_value = False
+    store = MemcachedStore(client, cas_retries=2)
+    with pytest.raises(StoreConflictError):
+        store.hset("key", "a", "1")
+
+
+def test_memcached_store_sharded_hset_conflict():
+    """Setting a field of a sharded hash should only delete the replaced value once the hash is stored."""
+    client = Mock(gets=Mock(return_value=(MemcachedHash({"a": "v1"}, sharded=True).encode(), b"1")))
+    client.cas.side_effect = [False, True]
+    store = MemcachedStore(client, shard_threshold=1)
+    assert store.hset("key", "a", "2") == 0
+
+    first, second = (list(c.args[0]) for c in client.set_many.call_args_list)
+    assert first != second
+    assert client.delete_many.call_args_list == [call(first), call([store.field_key("key", "a", "v1")])]
+
+
+class CasMemcacheClient(MockMemcacheClient):
+    """Mock client with gets and cas, using the value as its cas token."""
+
+    def gets(self, key):
+        value = self.get(key)
+        return value, value
+
+    def cas(self, key, value, cas, expire=0, noreply=True):
+        return self.get(key) == cas and self.set(key, value, expire, noreply)
+
+
+@pytest.mark.parametrize("read", [
+    lambda store: store.hgetall("key"),
+    lambda store: store.hget("key", "a"),
+])
+def test_memcached_store_evicted_field(read):
+    """Reading a sharded hash whose field key was evicted should drop the field from the hash."""
+    client = CasMemcacheClient()
+    store = MemcachedStore(client, shard_threshold=1)
+    store.hset("key", mapping={"a": "1", "b": "2"})
+    version = MemcachedHash.decode(client.get("key")).fields["a"]
+    client.delete(store.field_key("key", "a", version))
+
+    read(store)
+
+    assert store.hkeys("key") == ["b"]
+    assert store.hgetall("key") == {"b": "2"}
+
+
+def test_memcached_store_hdel_last_field():
+    """Deleting the last field of a hash should remove the hash unless it changed concurrently."""
+    client = Mock(gets=Mock(return_value=(MemcachedHash({"a": "1"}).encode(), b"1")))
+    client.cas.return_value = True
+    store = MemcachedStore(client)
+    assert store.hdel("key", "a") == 1
+    client.cas.assert_called_once_with("key", ANY, b"1", expire=-1, noreply=False)
+
+
+def test_memory_store_from_url():
+    """Making a memory store from a URL should read the bounds from the query."""
+    store = Store.from_url("memory:/?max_entries=10&max_bytes=100")
+    assert store.max_entries == 10
+    assert store.max_bytes == 100
+
+
+def test_memory_store_sweep():
+    """Writing to the store should remove the expired keys without reading them."""
+    store = MemoryStore()
+    store.set("a", "1", ttl=-1)
+    store.hset("b", mapping={"x": "1", "y": "2"}, ttl=-1)
+    store.hset("b", "z", "3")
+    store.set("c", "1")
+    assert list(store.records) == ["b", "c"]
+    assert store.records["b"].data == {"z": "3"}
+    assert store.expirations == 2
+    assert store.size == len("bz3c1")
+
+
+def test_memory_store_evict_entries():
+    """Setting more keys than the maximum entries should evict the least recently used."""
+    store = MemoryStore(max_entries=2)
+    store.set("a", "1")
+    store.set("b", "1")
+    store.get("a")
+    store.set("c", "1")
+    assert list(store.records) == ["a", "c"]
+    assert store.evictions == 1
+
+
+def test_memory_store_evict_bytes():
+    """Setting more bytes than the maximum bytes should evict the least recently used."""
+    store = MemoryStore(max_bytes=10)
+    store.hset("a", "x", "1234")
+    store.hset("a", "y", "1234")
+    assert list(store.records) == []
+    store.set("b", "1234")
+    store.set("c", "1234")
+    assert list(store.records) == ["b", "c"]
+
+
+def test_memory_store_counters():
+    """Reading keys should count the hits and misses."""
+    store = MemoryStore()
+    store.set("a", "1")
+    store.get("a")
+    store.get("b")
+    store.mget("a", "b")
+    assert (store.hits, store.misses) == (2, 2)
+
+
+@pytest.mark.parametrize(
+    "key, prefix",
+    [
+        ("DOMAIN_MAP", "DOMAIN_MAP"),
+        ("F2B_ATTEMPTS:192.0.2.0/24", "F2B_ATTEMPTS"),
+        ("session-1234", "other"),
+        ("", "other"),
+    ],
+)
+def test_key_prefix(key, prefix):
+    """The key prefix should drop the dynamic part of keys, grouping the other keys."""
+    assert key_prefix(key) == prefix
+
+
+@pytest.mark.parametrize(
+    "url, env, instrumented",
+    [
+        ("memory:/", {}, False),
+        ("memory:/?metrics=y", {}, True),
+        ("memory:/", {"STORE_METRICS": "y"}, True),
+        ("memory:/?metrics=n", {"STORE_METRICS": "y"}, False),
+    ],
+)
+def test_store_from_url_metrics(url, env, instrumented):
+    """Making a store from a URL should instrument it from the query or the environment."""
+    store = Store.from_url(url, env=env)
+    assert isinstance(store, InstrumentedStore) == instrumented
+
+
+def test_cached_store_from_url_metrics():
+    """Making a cached store with metrics should instrument the cache, not the store behind it."""
+    store = Store.from_url("cached+memory:/?metrics=y")
+    assert isinstance(store.store, CachedStore)
+    assert isinstance(store.store.store, MemoryStore)
+
+
+def test_instrumented_store_call():
+    """Calling an instrumented store should record the latency by method and key prefix."""
+    store = InstrumentedStore(MemoryStore(), "test-call")
+    labels = {"backend": "test-call", "method": "hset", "prefix": "DKIM_SELECTORS"}
+    assert store.hset("DKIM_SELECTORS", "a", "1") == 1
+    assert store.hgetall("DKIM_SELECTORS") == {"a": "1"}
+    assert REGISTRY.get_sample_value("store_operation_seconds_count", labels) == 1
+
+
+def test_instrumented_store_error():
+    """Calling an instrumented store should count the errors."""
+    store = InstrumentedStore(MemoryStore(), "test-error")
+    store.set("KEY", "a")
+    with pytest.raises(TypeError):
+        store.incr("KEY")
+
+    labels = {"backend": "test-error", "method": "incr", "prefix": "KEY"}
+    assert REGISTRY.get_sample_value("store_errors_total", labels) == 1
+
+
+def test_instrumented_store_batch():
+    """Executing the batch of an instrumented store should record a single call."""
+    store = InstrumentedStore(MemoryStore(), "test-batch")
+    with store.batch() as pipe:
+        pipe.set("A", "1").get("A")
+
+    assert store.store.get("A") == "1"
+    labels = {"backend": "test-batch", "method": "batch", "prefix": "A"}
+    assert REGISTRY.get_sample_value("store_operation_seconds_count", labels) == 1
+    assert REGISTRY.get_sample_value("store_operation_seconds_count", {**labels, "method": "set"}) is None
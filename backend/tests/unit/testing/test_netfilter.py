@@ -0,0 +1,104 @@
+"""Unit tests for the netfilter testing module."""
+
+import time
+
+import pytest
+from hamcrest import (
+    assert_that,
+    contains_exactly,
+    has_entries,
+    has_properties,
+)
+
+from taramail.netfilter import (
+    NetfilterError,
+    NetfilterTables,
+)
+from taramail.testing.netfilter import (
+    replay,
+    synthetic_corpus,
+)
+
+
+@pytest.fixture
+def tables(fake_nftables):
+    tables = NetfilterTables("MAIL", "mail", "ip", fake_nftables).init_chains()
+    tables.insert_mail_chains()
+    return tables
+
+
+def test_fake_nftables_init_chains(tables):
+    """Initializing chains should find the base chains of the fake."""
+    assert tables.chains == {
+        "filter": {"input": "INPUT", "forward": "FORWARD"},
+        "nat": {"postrouting": "POSTROUTING"},
+    }
+
+
+def test_fake_nftables_insert_mail_chains(tables, fake_nftables):
+    """Inserting the mail chains should jump to the mail chain first."""
+    assert tables.check("input") == 0
+    assert tables.check("forward") == 0
+    assert_that(
+        fake_nftables.rules["ip", "filter", "MAIL"],
+        contains_exactly(has_entries(comment="mail blacklist"), has_entries(comment="mail bans")),
+    )
+
+
+def test_fake_nftables_ban(tables, fake_nftables):
+    """Banning should add an element expiring after the timeout."""
+    tables.ban("1.2.3.4", 60)
+    elements = fake_nftables.elements["ip", "filter", "MAIL_BANS"]
+    assert elements.keys() == {"1.2.3.4/32"}
+    assert elements["1.2.3.4/32"] > time.time()
+
+    tables.unban("1.2.3.4")
+    assert elements == {}
+
+
+def test_fake_nftables_conflicting_intervals(tables, fake_nftables):
+    """Banning a network overlapping a banned network should fail the whole transaction."""
+    tables.ban("1.2.3.4")
+    with pytest.raises(NetfilterError), tables.batch():
+        tables.ban("5.6.7.8")
+        tables.ban("1.2.3.0/24")
+
+    assert fake_nftables.elements["ip", "filter", "MAIL_BANS"].keys() == {"1.2.3.4/32"}
+
+
+def test_fake_nftables_delete_missing_element(tables, fake_nftables):
+    """Deleting an element missing from the set should fail, like the kernel."""
+    with pytest.raises(NetfilterError):
+        tables.delete_element("filter", "MAIL_BANS", [tables.get_set_element("1.2.3.4")])
+
+
+def test_fake_nftables_clear(tables, fake_nftables):
+    """Clearing should remove the mail chain, its jumps and the ban set."""
+    tables.ban("1.2.3.4")
+    tables.clear()
+
+    assert ("ip", "filter", "MAIL") not in fake_nftables.chains
+    assert ("ip", "filter", "MAIL_BANS") not in fake_nftables.sets
+    assert ("ip", "filter", "MAIL_BLACKLIST") not in fake_nftables.sets
+    assert fake_nftables.rules["ip", "filter", "INPUT"] == []
+
+
+def test_fake_nftables_delete_referenced_chain(tables):
+    """Deleting a chain that is still jumped to should fail."""
+    handle = tables.get_chain_handle("filter", "MAIL")
+    with pytest.raises(NetfilterError):
+        tables.delete_chain("filter", "MAIL", handle)
+
+
+def test_synthetic_corpus():
+    """The synthetic corpus should repeat each attacker for every attempt."""
+    corpus = list(synthetic_corpus(3, attempts=2))
+    assert len(corpus) == 6
+    assert len(set(corpus)) == 3
+
+
+async def test_replay():
+    """Replaying a corpus should ban every attacker reaching the maximum attempts."""
+    report = await replay(synthetic_corpus(20))
+    assert_that(report, has_properties(lines=200, bans=20))
+    assert report.lines_per_second > 0
@@ -423,4 +423,11 @@ if [[ ! -z ${REDIS_SLAVEOF_IP} ]]; then
   cp /etc/syslog-ng/syslog-ng-redis_slave.conf /etc/syslog-ng/syslog-ng.conf
 fi
 
+# Only write fail2ban messages to the stream when netfilter reads it, capped like netfilter caps it
+if [[ "${NETFILTER_INGEST}" != "stream" ]]; then
+  sed -i '/destination(d_redis_f2b_stream);/d' /etc/syslog-ng/syslog-ng.conf
+else
+  sed -i "s/\"MAXLEN\" \"~\" \"[0-9]*\"/\"MAXLEN\" \"~\" \"${NETFILTER_STREAM_MAXLEN:-100000}\"/" /etc/syslog-ng/syslog-ng.conf
+fi
+
 exec "$@"
@@ -4,6 +4,13 @@ if [[ ! -z ${REDIS_SLAVEOF_IP} ]]; then
   cp /etc/syslog-ng/syslog-ng-redis_slave.conf /etc/syslog-ng/syslog-ng.conf
 fi
 
+# Only write fail2ban messages to the stream when netfilter reads it, capped like netfilter caps it
+if [[ "${NETFILTER_INGEST}" != "stream" ]]; then
+  sed -i '/destination(d_redis_f2b_stream);/d' /etc/syslog-ng/syslog-ng.conf
+else
+  sed -i "s/\"MAXLEN\" \"~\" \"[0-9]*\"/\"MAXLEN\" \"~\" \"${NETFILTER_STREAM_MAXLEN:-100000}\"/" /etc/syslog-ng/syslog-ng.conf
+fi
+
 # Fix OpenSSL 3.X TLS1.0, 1.1 support (https://community.mailcow.email/d/4062-hi-all/20)
 if grep -qE '\!SSLv2|\!SSLv3|>=TLSv1(\.[0-1])?$' /opt/postfix/conf/main.cf /opt/postfix/conf/extra.cf; then
     sed -i '/\[openssl_init\]/a ssl_conf = ssl_configuration' /etc/ssl/openssl.cnf